@@ -0,0 +1,268 @@
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+from contextvars import ContextVar
+from sqlalchemy import event
+import context
+from constants import OverloadError, POSTGRES_POOL_SIZE, POSTGRES_MAX_OVERFLOW
+
+################################################################################
+# admission control
+################################################################################
+
+def _groups(connections: int) -> dict:
+    """Параметры групп для пула из connections соединений.
+
+    max_limit групп делят пул в отношении 7:5:3, сумма не превышает размера
+    пула (если он не меньше суммы min_limit), чтобы ожидание шло в очереди,
+    а не в пуле; начальный лимит на единицу меньше максимального.
+    """
+    shares = {"reads": (7, 2, 64), "writes": (5, 1, 32), "auth": (3, 1, 32)}
+    total = sum(share for share, _, _ in shares.values())
+    groups = {}
+    for name, (share, min_limit, queue) in shares.items():
+        max_limit = max(min_limit, connections * share // total)
+        groups[name] = {"limit": max(min_limit, max_limit - 1), "min_limit": min_limit,
+            "max_limit": max_limit, "queue": queue}
+    return groups
+
+
+# группы маршрутов: начальный, минимальный и максимальный лимит одновременных
+# запросов и длина очереди ожидания (по умолчанию пул 5 + 10 overflow: лимиты 6/4/2, не больше 7/5/3)
+GROUPS = _groups(POSTGRES_POOL_SIZE + POSTGRES_MAX_OVERFLOW)
+
+# группа текущего запроса - для учёта латентности БД
+_current: ContextVar = ContextVar("admission_group", default = None)
+
+
+def _timed_task(loop, coro, **kwargs) -> asyncio.Task:
+    """Фабрика задач цикла событий, запоминающая время создания задачи.
+
+    Сервер создаёт задачу на каждый запрос, как только прочитаны заголовки;
+    разница между созданием и началом выполнения - время ожидания запроса
+    в очереди цикла событий, пока выполняются другие обработчики.
+    """
+    task = asyncio.Task(coro, loop = loop, **kwargs)
+    task.created = loop.time()
+    return task
+
+
+def _loop_wait() -> float:
+    # время создания есть у задач после AdmissionControl.start()
+    created = getattr(asyncio.current_task(), "created", None)
+    return asyncio.get_running_loop().time() - created if created is not None else 0.0
+
+
+def admission_group(name: str):
+    """Декоратор маршрута - отнести маршрут к группе допуска (GROUPS).
+    """
+    def decorator(func):
+        func.admission_group = name
+        return func
+    return decorator
+
+
+class AdmissionGroup:
+    """Ограничитель одновременных запросов группы с очередью ожидания.
+
+    Лимит подстраивается по латентности SQL-запросов группы (градиентный
+    алгоритм): пока короткое среднее не выходит за долгосрочное, лимит растёт
+    на sqrt(limit), при росте латентности - уменьшается пропорционально.
+    """
+    def __init__(self, name: str, limit: int, min_limit: int, max_limit: int, queue: int,
+            window: int = 50, tolerance: float = 1.5, smoothing: float = 0.2) -> None:
+        self.name = name
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue = queue
+        self.window = window
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.inflight = 0
+        self.waiters = deque()
+        self.long_latency = None
+        self.samples = 0
+        self.total = 0.0
+        self.shed = 0
+
+    async def acquire(self, timeout: float) -> bool:
+        """Занять место в группе.
+
+        Args:
+            timeout (float): Сколько ещё можно ждать в очереди, секунды.
+
+        Returns:
+            bool: True - запрос допущен, False - отклонён (очередь полна либо истёк срок).
+        """
+        if timeout <= 0:
+            self.shed += 1
+            return False
+        if self.inflight < int(self.limit) and not self.waiters:
+            self.inflight += 1
+            return True
+        if len(self.waiters) >= self.queue:
+            self.shed += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+            return True
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # место передано в момент истечения срока
+                return True
+            waiter.cancel()
+            self.waiters.remove(waiter)
+            self.shed += 1
+            return False
+        except asyncio.CancelledError:
+            if waiter.done():
+                self.release()
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            raise
+
+    def release(self) -> None:
+        """Освободить место: передать его первому в очереди либо вернуть группе.
+        """
+        self.inflight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        while self.waiters and self.inflight < int(self.limit):
+            self.waiters.popleft().set_result(None)
+            self.inflight += 1
+
+    def observe(self, latency: float) -> None:
+        """Учесть длительность SQL-запроса и раз в окно пересчитать лимит.
+        """
+        self.samples += 1
+        self.total += latency
+        if self.samples < self.window:
+            return
+        short = self.total / self.samples
+        self.samples, self.total = 0, 0.0
+        if self.long_latency is None:
+            self.long_latency = short
+        else:
+            self.long_latency = self.long_latency * 0.95 + short * 0.05
+        if self.long_latency > 2 * short:
+            # латентность упала надолго - быстрее забыть старую базу
+            self.long_latency *= 0.9
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_latency / short))
+        limit = self.limit * gradient if gradient < 1 else self.limit + self.limit ** 0.5
+        limit = self.limit * (1 - self.smoothing) + limit * self.smoothing
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+        self._wake()
+
+    def stats(self) -> dict:
+        return {"limit": round(self.limit, 2), "inflight": self.inflight,
+            "queued": len(self.waiters), "shed": self.shed}
+
+
+class AdmissionControl:
+    """Группы допуска и учёт латентности БД по группам.
+    """
+    def __init__(self, groups: dict = None, queue_timeout: float = 0.05) -> None:
+        """
+        Args:
+            groups (dict, optional): Параметры групп, по умолчанию GROUPS.
+            queue_timeout (float, optional): Срок ожидания в очереди, секунды.
+        """
+        self.groups = {name: AdmissionGroup(name, **params) for name, params in (groups or GROUPS).items()}
+        self.queue_timeout = queue_timeout
+        self.loop = None
+        self.loop_thread = None
+
+    def start(self, loop) -> None:
+        """Привязаться к циклу событий (при запуске приложения, из потока цикла):
+        задачи запросов получают время создания, замеры латентности передаются
+        группам в этом цикле.
+        """
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        if loop.get_task_factory() is None:
+            loop.set_task_factory(_timed_task)
+
+    def install(self, engine) -> None:
+        """Подписаться на события движка для замера латентности SQL-запросов.
+        """
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        event.listen(engine, "handle_error", self._error)
+
+    # время начала хранится в контексте выполнения запроса, а не в соединении:
+    # запрос с ошибкой не оставляет его следующему запросу на том же соединении
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, ctx, executemany) -> None:
+        if ctx is not None and _current.get() is not None:
+            ctx.admission_start = time.perf_counter()
+
+    @staticmethod
+    def _error(exception_context) -> None:
+        # латентность запроса с ошибкой не учитывается
+        if exception_context.execution_context is not None:
+            exception_context.execution_context.admission_start = None
+
+    def _after(self, conn, cursor, statement, parameters, ctx, executemany) -> None:
+        group = _current.get()
+        start = getattr(ctx, "admission_start", None)
+        if group is None or start is None:
+            return
+        ctx.admission_start = None
+        latency = time.perf_counter() - start
+        # запрос мог выполняться в пуле потоков (SingleFlight): группа меняет
+        # очередь ожидающих future, это допустимо только в потоке цикла событий
+        if self.loop is None or threading.get_ident() == self.loop_thread:
+            group.observe(latency)
+        else:
+            self.loop.call_soon_threadsafe(group.observe, latency)
+
+
+class AdmissionMiddleware:
+    """ASGI middleware - допуск запросов к маршрутам с @admission_group.
+
+    Должен стоять внутри RouteContextMiddleware. Срок ожидания отсчитывается
+    от поступления запроса: в него входит и ожидание в цикле событий, пока
+    выполнялись другие обработчики. Запрос, не получивший места за этот срок
+    либо не поместившийся в очередь, сразу получает 503.
+    """
+    def __init__(self, app, control: AdmissionControl) -> None:
+        self.app = app
+        self.control = control
+        self.routes = None
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if self.routes is None:
+            self.routes = context.endpoint_attributes(scope["app"], "admission_group")
+        name = self.routes.get((scope["method"], context.request_route.get()))
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+
+        group = self.control.groups[name]
+        if not await group.acquire(self.control.queue_timeout - _loop_wait()):
+            exc = OverloadError()
+            body = json.dumps({"status_code": exc.code, "status_message": str(exc)}).encode()
+            await send({"type": "http.response.start", "status": 503, "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", b"1")]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        token = _current.set(group)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
+            group.release()
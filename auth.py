@@ -1,8 +1,16 @@
+import hmac
 import jwt
+from contextlib import contextmanager
+from contextvars import ContextVar
 from jwt import DecodeError
-from constants import TokenError
+from constants import TokenError, AdminError, ADMIN_TOKEN
+from tracing import traced
 
+# токен, уже проверенный в текущем запросе, и данные из него (trusted)
+_trusted: ContextVar = ContextVar("trusted_token", default = None)
 
+
+@traced("jwt.encode")
 def jwt_encode(data: dict) -> str:
     """Поместить данные в jwt.
 
@@ -15,6 +23,7 @@ def jwt_encode(data: dict) -> str:
     return jwt.encode(data, "secret_key", algorithm = "HS256")
 
 
+@traced("jwt.decode")
 def jwt_decode(token: str, keys: list = []) -> dict:
     """Извлечь данные из jwt.
 
@@ -29,8 +38,12 @@ def jwt_decode(token: str, keys: list = []) -> dict:
     Returns:
         dict: Словарь с данными, какие были внутри Не удалось декодировать jwt.
     """
+    known = _trusted.get()
     try:
-        data = jwt.decode(token, "secret_key", algorithms = ["HS256"])
+        if known is not None and known[0] == token:
+            data = known[1]
+        else:
+            data = jwt.decode(token, "secret_key", algorithms = ["HS256"])
         for key in keys:
             if key not in data:
                 raise DecodeError
@@ -39,6 +52,7 @@ def jwt_decode(token: str, keys: list = []) -> dict:
     return data
 
 
+@traced("jwt.validate")
 def jwt_validate(token: str) -> None:
     """Проверить jwt на валидность.
 
@@ -51,6 +65,9 @@ def jwt_validate(token: str) -> None:
     Returns:
         None: None
     """
+    known = _trusted.get()
+    if known is not None and known[0] == token:
+        return None
     try:
         jwt.decode(token, "secret_key", algorithms = ["HS256"])
     except DecodeError as exc:
@@ -58,3 +75,38 @@ def jwt_validate(token: str) -> None:
     return None
 
 
+@contextmanager
+def trusted(token: str):
+    """Проверить jwt один раз на весь блок.
+
+    Внутри блока jwt_decode и jwt_validate для этого токена не проверяют
+    подпись повторно, а возвращают уже извлечённые данные.
+
+    Args:
+        token (str): Токен.
+
+    Raises:
+        TokenError: Не удалось декодировать jwt.
+
+    Yields:
+        dict: Данные из jwt.
+    """
+    data = jwt_decode(token)
+    reset = _trusted.set((token, data))
+    try:
+        yield data
+    finally:
+        _trusted.reset(reset)
+
+
+def admin_validate(token: str) -> None:
+    """Проверить служебный токен (заголовок admin-token) для маршрутов /admin/*.
+
+    Args:
+        token (str): Токен.
+
+    Raises:
+        AdminError: Токен не совпадает с ADMIN_TOKEN либо ADMIN_TOKEN не задан.
+    """
+    if not ADMIN_TOKEN or token is None or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise AdminError()
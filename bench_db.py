@@ -0,0 +1,233 @@
+import sys
+import json
+import time
+import random
+import argparse
+from sqlalchemy import event, insert, select, update, text
+import database
+from database import DBItem, DBUser, engine
+from constants import PURGE_BATCH_SIZE
+
+################################################################################
+# database micro-benchmark
+################################################################################
+
+class Counter:
+    """Счётчик SQL-запросов (round-trip'ов) и выдач соединений из пула.
+    """
+    def __init__(self) -> None:
+        self.statements = 0
+        self.checkouts = 0
+        event.listen(engine, "before_cursor_execute", self._statement)
+        event.listen(engine.pool, "checkout", self._checkout)
+
+    def _statement(self, *args) -> None:
+        self.statements += 1
+
+    def _checkout(self, *args) -> None:
+        self.checkouts += 1
+
+
+def seed(users: int, items_per_user: int) -> None:
+    """Дозаполнить таблицы до заданного количества пользователей.
+
+    Данные генерируются на стороне сервера (generate_series), поэтому
+    заполнение до 10^7 строк не гоняет данные через сеть.
+
+    Args:
+        users (int): Итоговое количество пользователей.
+        items_per_user (int): Количество объектов на пользователя.
+    """
+    with engine.begin() as conn:
+        current = conn.execute(text(
+            "SELECT count(*) FROM users WHERE login LIKE 'seed\\_user\\_%'")).scalar()
+        if current >= users:
+            return
+        conn.execute(text(
+            "WITH new_users AS ("
+            "    INSERT INTO users (login, password) "
+            "    SELECT 'seed_user_' || g, 'seed_password_' || g FROM generate_series(:start, :stop) AS g "
+            "    RETURNING id) "
+            "INSERT INTO items (name, owner_id) "
+            "SELECT 'seed_item_' || id || '_' || k, id FROM new_users CROSS JOIN generate_series(1, :per_user) AS k"),
+            {"start": current + 1, "stop": users, "per_user": items_per_user})
+        conn.execute(text("ANALYZE users"))
+        conn.execute(text("ANALYZE items"))
+
+
+################################################################################
+# core variants
+################################################################################
+
+def core_create_user(login: str, password: str) -> dict:
+    with engine.begin() as conn:
+        return conn.execute(insert(DBUser).values(login = login, password = password). \
+            returning(DBUser.__table__)).one()
+
+
+def core_read_user(login: str) -> dict:
+    with engine.connect() as conn:
+        return conn.execute(select(DBUser.__table__).where(DBUser.login == login)).one()
+
+
+def core_read_item_by_id(id: int) -> dict:
+    with engine.connect() as conn:
+        return conn.execute(select(DBItem.__table__).where(DBItem.id == id)).one()
+
+
+def core_rebase_item(id: int, new_owner_id: int) -> dict:
+    with engine.begin() as conn:
+        return conn.execute(update(DBItem).values(owner_id = new_owner_id). \
+            where(DBItem.id == id).returning(DBItem.__table__)).one()
+
+
+def core_item_list() -> list:
+    with engine.connect() as conn:
+        return conn.execute(select(DBItem.__table__)).all()
+
+
+################################################################################
+# benchmark
+################################################################################
+
+def measure(counter: Counter, fn, calls: list) -> dict:
+    """Замерить серию вызовов функции.
+
+    Args:
+        counter (Counter): Счётчик запросов.
+        fn: Замеряемая функция.
+        calls (list): Аргументы для каждого вызова.
+
+    Returns:
+        dict: Количество вызовов, латентность, round-trip'ы и строки в секунду.
+    """
+    latencies = []
+    rows = 0
+    statements, checkouts = counter.statements, counter.checkouts
+    for args in calls:
+        start = time.perf_counter()
+        result = fn(*args)
+        latencies.append(time.perf_counter() - start)
+        rows += len(result) if isinstance(result, list) else 1
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        "calls": len(calls),
+        "mean_ms": round(total / len(calls) * 1000, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p95_ms": round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000, 3),
+        "round_trips": round((counter.statements - statements) / len(calls), 2),
+        "checkouts": round((counter.checkouts - checkouts) / len(calls), 2),
+        "rows_per_second": round(rows / total, 1) if total else None
+    }
+
+
+def purge_user(id: int) -> int:
+    """Очистка удалённого пользователя целиком - как её выполняет фоновый поток (purge.py).
+    """
+    total = 0
+    while True:
+        count = database.db_purge_user(id, PURGE_BATCH_SIZE)
+        if count == 0:
+            return total
+        total += count
+
+
+def run_size(counter: Counter, size: int, calls: int, list_max: int, variants: list) -> dict:
+    """Замерить все функции db_* на таблицах заданного размера.
+
+    Создаваемые в ходе замера строки удаляются: db_delete_user только помечает
+    пользователя удалённым, запись удаляет очистка (db_purge_user) - она
+    замеряется отдельно, так что размер таблиц между замерами не меняется,
+    а db_delete_user сравним с прежним удалением только как пометка.
+    """
+    with engine.connect() as conn:
+        users = conn.execute(text(
+            "SELECT id, login FROM users WHERE login LIKE 'seed\\_user\\_%' ORDER BY random() LIMIT :n"),
+            {"n": calls}).all()
+        items = conn.execute(text(
+            "SELECT id, name, owner_id FROM items WHERE name LIKE 'seed\\_item\\_%' ORDER BY random() LIMIT :n"),
+            {"n": calls}).all()
+    tag = f"bench_{size}_{random.getrandbits(32):08x}"
+    new_users = [(f"{tag}_user_{n}", "password") for n in range(calls)]
+    new_items_names = [f"{tag}_item_{n}" for n in range(calls)]
+
+    results = {}
+    if "orm" in variants:
+        results["db_create_user"] = measure(counter, database.db_create_user, new_users)
+        created_users = [database.db_read_user(login).id for login, _ in new_users]
+        results["db_read_user"] = measure(counter, database.db_read_user, [(u.login,) for u in users])
+        results["db_read_user_by_id"] = measure(counter, database.db_read_user_by_id, [(u.id,) for u in users])
+        results["db_update_user"] = measure(counter, database.db_update_user,
+            [(id, login, "new_password") for id, (login, _) in zip(created_users, new_users)])
+        results["db_create_item"] = measure(counter, database.db_create_item,
+            [(name, users[n % len(users)].id) for n, name in enumerate(new_items_names)])
+        created_items = [database.db_read_item(name).id for name in new_items_names]
+        results["db_read_item"] = measure(counter, database.db_read_item, [(i.name,) for i in items])
+        results["db_read_item_by_id"] = measure(counter, database.db_read_item_by_id, [(i.id,) for i in items])
+        results["db_update_item"] = measure(counter, database.db_update_item,
+            [(id, name, created_users[n]) for n, (id, name) in enumerate(zip(created_items, new_items_names))])
+        results["db_rebase_item"] = measure(counter, database.db_rebase_item,
+            [(id, users[n % len(users)].id) for n, id in enumerate(created_items)])
+        results["db_delete_item"] = measure(counter, database.db_delete_item, [(id,) for id in created_items])
+        results["db_delete_user"] = measure(counter, database.db_delete_user, [(id,) for id in created_users])
+        results["db_purge_user"] = measure(counter, purge_user, [(id,) for id in created_users])
+        if size <= list_max:
+            results["db_user_list"] = measure(counter, database.db_user_list, [()] * 3)
+            results["db_item_list"] = measure(counter, database.db_item_list, [()] * 3)
+
+    if "core" in variants:
+        results["core_create_user"] = measure(counter, core_create_user,
+            [(login + "_core", password) for login, password in new_users])
+        results["core_read_user"] = measure(counter, core_read_user, [(u.login,) for u in users])
+        results["core_read_item_by_id"] = measure(counter, core_read_item_by_id, [(i.id,) for i in items])
+        results["core_rebase_item"] = measure(counter, core_rebase_item, [(i.id, i.owner_id) for i in items])
+        if size <= list_max:
+            results["core_item_list"] = measure(counter, core_item_list, [()] * 3)
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM users WHERE login LIKE :tag"), {"tag": tag + "%_core"})
+    return results
+
+
+def report(size: int, results: dict) -> str:
+    lines = [f"users: {size}",
+        f"{'function':<24}{'calls':>7}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'trips':>7}{'rows/s':>12}"]
+    for name, stats in results.items():
+        lines.append(f"{name:<24}{stats['calls']:>7}{stats['mean_ms']:>10}{stats['p50_ms']:>10}"
+            f"{stats['p95_ms']:>10}{stats['round_trips']:>7}{stats['rows_per_second']:>12}")
+    return "\n".join(lines)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description = "Micro-benchmark of the database.py CRUD functions. "
+        "Seeds the configured database (POSTGRES_*), use a disposable one.")
+    parser.add_argument("--sizes", default = "1000,10000,100000",
+        help = "comma separated user counts, seeded in ascending order (up to 10000000)")
+    parser.add_argument("--items-per-user", type = int, default = 1)
+    parser.add_argument("--calls", type = int, default = 200, help = "calls per function and size")
+    parser.add_argument("--list-max", type = int, default = 100000,
+        help = "skip the full list functions above this table size")
+    parser.add_argument("--variants", default = "orm,core", help = "comma separated: orm, core")
+    parser.add_argument("--reset", action = "store_true", help = "clear all tables before seeding")
+    parser.add_argument("--save", help = "save results as JSON")
+    args = parser.parse_args(argv)
+
+    if args.reset:
+        database.db_clear_all()
+    counter = Counter()
+    variants = args.variants.split(",")
+    results = {}
+    for size in sorted(int(size) for size in args.sizes.split(",")):
+        start = time.perf_counter()
+        seed(size, args.items_per_user)
+        print(f"seeded {size} users in {time.perf_counter() - start:.1f} s")
+        results[size] = run_size(counter, size, args.calls, args.list_max, variants)
+        print(report(size, results[size]))
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent = 2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+from constants import API_URL
+from stats import percentile
+
+################################################################################
+# http load test
+################################################################################
+
+class HTTPConnection:
+    """Минимальный асинхронный HTTP/1.1 клиент с keep-alive.
+
+    Достаточен для JSON API этого сервиса и не требует сторонних библиотек.
+    """
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def open(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def request(self, method: str, path: str, body: dict = None, headers: dict = None) -> tuple:
+        """Выполнить запрос.
+
+        Args:
+            method (str): HTTP-метод.
+            path (str): Путь запроса.
+            body (dict, optional): Тело запроса, будет передано как JSON.
+            headers (dict, optional): Дополнительные заголовки.
+
+        Returns:
+            tuple: (HTTP-код ответа, разобранное JSON-тело либо None).
+        """
+        if self.writer is None:
+            await self.open()
+        payload = b"" if body is None else json.dumps(body).encode()
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+            f"Content-Length: {len(payload)}"]
+        if body is not None:
+            lines.append("Content-Type: application/json")
+        for key, value in (headers or {}).items():
+            lines.append(f"{key}: {value}")
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + payload)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        length, chunked, keep_alive = 0, False, True
+        while True:
+            line = (await self.reader.readline()).strip()
+            if not line:
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            key, value = key.strip().lower(), value.strip().lower()
+            if key == "content-length":
+                length = int(value)
+            elif key == "transfer-encoding" and value == "chunked":
+                chunked = True
+            elif key == "connection" and value == "close":
+                keep_alive = False
+
+        if chunked:
+            data = b""
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                data += await self.reader.readexactly(size)
+                await self.reader.readline()
+        else:
+            data = await self.reader.readexactly(length)
+
+        if not keep_alive:
+            await self.close()
+        try:
+            return status, json.loads(data) if data else None
+        except ValueError:
+            return status, None
+
+
+class Recorder:
+    """Накопитель длительностей и ошибок по маршрутам.
+    """
+    def __init__(self) -> None:
+        self.latencies = {}
+        self.errors = {}
+        self.recording = False
+
+    async def call(self, connection: HTTPConnection, route: str, method: str, path: str,
+            body: dict = None, token: str = None) -> dict:
+        """Выполнить запрос и учесть его длительность под именем маршрута.
+
+        Returns:
+            dict: Тело ответа, если запрос успешен (status_code == "0"), иначе None.
+        """
+        headers = {"token": token} if token else None
+        start = time.perf_counter()
+        try:
+            status, data = await connection.request(method, path, body, headers)
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            await connection.close()
+            status, data = None, None
+        elapsed = time.perf_counter() - start
+        ok = status == 200 and isinstance(data, dict) and data.get("status_code") == "0"
+        if self.recording:
+            self.latencies.setdefault(route, []).append(elapsed)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return data if ok else None
+
+
+async def _worker(recorder: Recorder, host: str, port: int, prefix: str, number: int,
+        deadline: float) -> None:
+    """Сценарий одного виртуального клиента.
+
+    Клиент регистрирует получателя и в цикле проходит полный путь: регистрация
+    и вход нового пользователя, создание объекта, список объектов, передача
+    объекта получателю (/send + /get) и удаление объекта.
+    """
+    connection = HTTPConnection(host, port)
+    receiver = f"{prefix}_{number}"
+    await recorder.call(connection, "/registration", "POST", "/registration",
+        {"login": receiver, "password": receiver})
+    data = await recorder.call(connection, "/login", "POST", "/login",
+        {"login": receiver, "password": receiver})
+    if data is None:
+        await connection.close()
+        return
+    receiver_token = data["token"]
+
+    iteration = 0
+    while time.monotonic() < deadline:
+        iteration += 1
+        login = f"{receiver}_{iteration}"
+        user = await recorder.call(connection, "/registration", "POST", "/registration",
+            {"login": login, "password": login})
+        data = await recorder.call(connection, "/login", "POST", "/login",
+            {"login": login, "password": login})
+        if user is None or data is None:
+            continue
+        token = data["token"]
+
+        item = await recorder.call(connection, "/items/new", "POST", "/items/new",
+            {"name": f"{login}_item", "owner_id": user["data"]["id"]}, token)
+        await recorder.call(connection, "/items", "GET", "/items", token = token)
+        if item is None:
+            continue
+        item_id = item["data"]["id"]
+
+        sent = await recorder.call(connection, "/send", "POST", "/send",
+            {"id": item_id, "new_owner_login": receiver}, token)
+        if sent is not None:
+            await recorder.call(connection, "/get/{params}", "GET", urlsplit(sent["url"]).path,
+                token = receiver_token)
+        await recorder.call(connection, "/items/{id}", "DELETE", f"/items/{item_id}",
+            token = receiver_token)
+    await connection.close()
+
+
+async def run(url: str, concurrency: int, duration: float, warmup: float) -> dict:
+    """Провести нагрузочный прогон.
+
+    Args:
+        url (str): Адрес API.
+        concurrency (int): Количество одновременных клиентов.
+        duration (float): Длительность замера, секунды.
+        warmup (float): Длительность прогрева без учёта результатов, секунды.
+
+    Returns:
+        dict: Результаты - пропускная способность и перцентили по маршрутам.
+    """
+    parts = urlsplit(url)
+    recorder = Recorder()
+    prefix = "bench_" + uuid.uuid4().hex[:8]
+
+    if warmup > 0:
+        deadline = time.monotonic() + warmup
+        await asyncio.gather(*[_worker(recorder, parts.hostname, parts.port or 80,
+            prefix + "w", number, deadline) for number in range(concurrency)])
+
+    recorder.recording = True
+    start = time.monotonic()
+    await asyncio.gather(*[_worker(recorder, parts.hostname, parts.port or 80,
+        prefix, number, start + duration) for number in range(concurrency)])
+    elapsed = time.monotonic() - start
+
+    routes = {}
+    for route, values in sorted(recorder.latencies.items()):
+        values.sort()
+        routes[route] = {
+            "requests": len(values),
+            "errors": recorder.errors.get(route, 0),
+            "throughput": round(len(values) / elapsed, 2),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3)
+        }
+    return {
+        "config": {"url": url, "concurrency": concurrency, "duration": duration, "warmup": warmup},
+        "elapsed": round(elapsed, 3),
+        "throughput": round(sum(len(values) for values in recorder.latencies.values()) / elapsed, 2),
+        "goodput": round(sum(len(values) - recorder.errors.get(route, 0)
+            for route, values in recorder.latencies.items()) / elapsed, 2),
+        "routes": routes
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """Сравнить прогон с эталоном.
+
+    Регрессией считается рост p95/p99 либо падение пропускной способности
+    маршрута больше чем на tolerance (доля от эталонного значения).
+
+    Returns:
+        list: Описания регрессий; пустой список - регрессий нет.
+    """
+    regressions = []
+    for route, expected in baseline["routes"].items():
+        actual = result["routes"].get(route)
+        if actual is None:
+            regressions.append(f"{route}: no requests in this run")
+            continue
+        for key in ("p95_ms", "p99_ms"):
+            if actual[key] > expected[key] * (1 + tolerance):
+                regressions.append(f"{route}: {key} {actual[key]} > {expected[key]} (+{tolerance:.0%})")
+        if actual["throughput"] < expected["throughput"] * (1 - tolerance):
+            regressions.append(f"{route}: throughput {actual['throughput']} < "
+                f"{expected['throughput']} (-{tolerance:.0%})")
+    return regressions
+
+
+def report(result: dict) -> str:
+    lines = [f"{'route':<16}{'requests':>10}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+    for route, stats in result["routes"].items():
+        lines.append(f"{route:<16}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput']:>10}"
+            f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    lines.append(f"total throughput: {result['throughput']} rps, goodput: {result['goodput']} rps "
+        f"in {result['elapsed']} s")
+    return "\n".join(lines)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description = "HTTP load test for every API route.")
+    parser.add_argument("--url", default = API_URL, help = "API address, default API_URL")
+    parser.add_argument("--concurrency", type = int, default = 16)
+    parser.add_argument("--duration", type = float, default = 10.0, help = "seconds")
+    parser.add_argument("--warmup", type = float, default = 2.0, help = "seconds")
+    parser.add_argument("--save", help = "save results as a JSON baseline")
+    parser.add_argument("--baseline", help = "compare with a saved JSON baseline")
+    parser.add_argument("--tolerance", type = float, default = 0.15,
+        help = "allowed regression as a fraction of the baseline")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args.url, args.concurrency, args.duration, args.warmup))
+    print(report(result))
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(result, file, indent = 2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+import json
+import math
+import time
+import threading
+import functools
+from collections import OrderedDict, deque
+from fastapi.responses import JSONResponse
+from sqlalchemy import exc as sa_exc
+from constants import UnavailableError
+
+################################################################################
+# circuit breaker
+################################################################################
+
+# ошибки недоступности БД: соединение, таймауты пула и запросов; остальные
+# ошибки (нарушение ограничений и т.п.) означают, что БД ответила
+OUTAGE_ERRORS = (sa_exc.OperationalError, sa_exc.InterfaceError, sa_exc.TimeoutError)
+
+
+class CircuitBreaker:
+    """Автомат защиты обращений к БД.
+
+    Замкнут - обращения выполняются, их исходы копятся в окне из window
+    последних. Когда в полном окне доля неудач (ошибок недоступности и
+    обращений дольше slow секунд) не меньше failure_rate, автомат
+    размыкается: обращения сразу отклоняются с UnavailableError, не ожидая
+    таймаутов. Через open_time секунд пропускается одно пробное обращение:
+    успех замыкает автомат, неудача снова размыкает.
+    """
+    def __init__(self, window: int = 20, failure_rate: float = 0.5, slow: float = 1.0,
+            open_time: float = 5.0, clock = time.monotonic) -> None:
+        self.window = window
+        self.failure_rate = failure_rate
+        self.slow = slow
+        self.open_time = open_time
+        self.clock = clock
+        self.state = "closed"
+        self.opened = None
+        self.outcomes = deque(maxlen = window)
+        self.probing = False
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def reset(self) -> None:
+        """Замкнуть автомат и забыть накопленные исходы.
+        """
+        with self._lock:
+            self.state = "closed"
+            self.opened = None
+            self.outcomes.clear()
+            self.probing = False
+
+    def retry_after(self) -> float:
+        """Сколько секунд автомат ещё будет отклонять обращения (0 - пропускает).
+        """
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.opened + self.open_time - self.clock())
+
+    def allow(self) -> bool:
+        """Можно ли обращаться к БД; в полуоткрытом состоянии - только одному.
+        """
+        with self._lock:
+            if self.state == "open" and self.clock() >= self.opened + self.open_time:
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.probing:
+                    return False
+                self.probing = True
+                return True
+            return self.state == "closed"
+
+    def record(self, success: bool) -> None:
+        """Учесть исход обращения.
+        """
+        with self._lock:
+            if self.state == "half_open":
+                self.probing = False
+                if success:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                else:
+                    self._open()
+                return
+            self.outcomes.append(success)
+            if len(self.outcomes) == self.window and \
+                    self.outcomes.count(False) >= self.failure_rate * self.window:
+                self._open()
+
+    def _open(self) -> None:
+        self.state = "open"
+        self.opened = self.clock()
+        self.outcomes.clear()
+        self.trips += 1
+
+    def guard(self, fn):
+        """Обернуть функцию db_*: отклонять вызовы при разомкнутом автомате,
+        учитывать исход и длительность, ошибки недоступности БД заменять на
+        UnavailableError.
+        """
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self.allow():
+                raise UnavailableError()
+            start = self.clock()
+            success = False
+            try:
+                result = fn(*args, **kwargs)
+                success = True
+            except OUTAGE_ERRORS as exc:
+                raise UnavailableError() from exc
+            except Exception:
+                # БД ответила - исход определяется только длительностью
+                success = True
+                raise
+            finally:
+                self.record(success and self.clock() - start <= self.slow)
+            return result
+        return wrapper
+
+    def stats(self) -> dict:
+        return {"state": self.state, "trips": self.trips,
+            "failures": self.outcomes.count(False), "calls": len(self.outcomes)}
+
+
+class StaleCache:
+    """Последние успешные ответы маршрутов чтения (LRU) - для выдачи,
+    когда БД недоступна.
+    """
+    def __init__(self, size: int = 1024, clock = time.monotonic) -> None:
+        self.size = size
+        self.clock = clock
+        self.entries = OrderedDict()
+
+    def put(self, key, value) -> None:
+        """Запомнить ответ: dict либо сериализованный JSON (bytes).
+        """
+        self.entries[key] = (value, self.clock())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last = False)
+
+    def response(self, key) -> JSONResponse:
+        """Сохранённый ответ с пометкой "stale": true, "age": возраст в секундах
+        и заголовками Warning и Age; None - сохранённого ответа нет.
+        """
+        if key not in self.entries:
+            return None
+        value, stored = self.entries[key]
+        age = int(self.clock() - stored)
+        data = json.loads(value) if isinstance(value, bytes) else dict(value)
+        data["stale"] = True
+        data["age"] = age
+        return JSONResponse(data, headers = {"warning": '110 - "Response is Stale"', "age": str(age)})
+
+
+class CircuitBreakerMiddleware:
+    """ASGI middleware - при разомкнутом автомате сразу отвечает 503 на
+    изменяющие запросы (все методы, кроме GET и HEAD); чтение проходит
+    в обработчики, которые отдают сохранённые ответы.
+    """
+    def __init__(self, app, breaker: CircuitBreaker) -> None:
+        self.app = app
+        self.breaker = breaker
+
+    async def __call__(self, scope, receive, send) -> None:
+        retry_after = self.breaker.retry_after() \
+            if scope["type"] == "http" and scope["method"] not in ("GET", "HEAD") else 0
+        if not retry_after:
+            await self.app(scope, receive, send)
+            return
+
+        exc = UnavailableError()
+        body = json.dumps({"status_code": exc.code, "status_message": str(exc)}).encode()
+        await send({"type": "http.response.start", "status": 503, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(math.ceil(retry_after)).encode())]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,227 @@
+import re
+import json
+import time
+import queue
+import hashlib
+import secrets
+import threading
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import auth
+import context
+from constants import TokenError
+
+################################################################################
+# traffic capture
+################################################################################
+
+# поля тела запроса, значения которых заменяются псевдонимами
+ANONYMISED_FIELDS = ("login", "password", "new_owner_login", "name")
+# параметры строки запроса, значения которых заменяются псевдонимами (q - часть наименования)
+ANONYMISED_QUERY = ("q",)
+
+# маршруты, в ответах которых есть данные для связывания цепочек при воспроизведении
+CREATE_ROUTES = ("/registration", "/registration_p", "/items/new", "/items/new_p")
+LINKED_ROUTES = CREATE_ROUTES + ("/login", "/send", "/batch")
+
+
+def pseudonym(value: str, salt: str) -> str:
+    """Заменить значение устойчивым псевдонимом.
+
+    Одинаковые значения дают одинаковые псевдонимы, поэтому регистрация,
+    вход и передача объекта по логину продолжают работать при воспроизведении.
+
+    Args:
+        value (str): Исходное значение.
+        salt (str): Соль журнала.
+    """
+    return "a" + hashlib.sha256((salt + str(value)).encode()).hexdigest()[:15]
+
+
+def link_id(params: str) -> str:
+    """Идентификатор ссылки /get/{params} - связывает ответ /send и запрос /get.
+    """
+    return hashlib.sha256(params.encode()).hexdigest()[:16]
+
+
+def _token_user(token: str) -> int:
+    try:
+        return auth.jwt_decode(token, ["user_id"])["user_id"]
+    except (TokenError, TypeError, AttributeError):
+        return None
+
+
+class CaptureLog:
+    """Журнал трафика: одна JSON-строка на запрос, только дозапись.
+
+    Запись строится фоновым потоком: в обработчике запроса остаются
+    только копирование байтов тела и постановка в очередь.
+
+    Поля записи:
+        t - смещение начала запроса от начала журнала, секунды;
+        method, route, params - метод, шаблон маршрута и параметры пути;
+        query - строка запроса (с псевдонимами вместо строки поиска), если есть;
+        user - пользователь из токена запроса;
+        body - тело запроса с псевдонимами вместо логинов, паролей и имён;
+        status - HTTP-код ответа;
+        created - идентификатор созданного пользователя/объекта;
+        token_user - пользователь, получивший токен в /login;
+        link - связь ответа /send с запросом /get/{params}.
+
+    Операции /batch записываются так же: method, route, params, body
+    с псевдонимами и created/token_user/link по ответу операции.
+    """
+    def __init__(self, path: str, salt: str = None, routes: list = ()) -> None:
+        """
+        Args:
+            path (str): Файл журнала.
+            salt (str, optional): Соль псевдонимов (None - случайная).
+            routes (list, optional): Шаблоны маршрутов в порядке сопоставления -
+                для определения маршрутов операций /batch.
+        """
+        self.path = path
+        self.salt = salt or secrets.token_hex(16)
+        self.patterns = [(route, re.compile("^" + re.sub(r"\{(\w+)\}", r"(?P<\1>[^/]+)", route) + "$"))
+            for route in routes]
+        self.start = time.monotonic()
+        self._records = queue.Queue(maxsize = 10000)
+        self._thread = threading.Thread(target = self._run, name = "traffic-capture", daemon = True)
+        self._thread.start()
+
+    def put(self, raw: tuple) -> None:
+        try:
+            self._records.put_nowait(raw)
+        except queue.Full:
+            pass
+
+    def _run(self) -> None:
+        with open(self.path, "a") as file:
+            while True:
+                raws = [self._records.get()]
+                while not self._records.empty() and len(raws) < 512:
+                    raws.append(self._records.get_nowait())
+                lines = []
+                for raw in raws:
+                    try:
+                        lines.append(json.dumps(self._record(*raw), separators = (",", ":")) + "\n")
+                    except (KeyError, TypeError, ValueError, AttributeError):
+                        pass
+                file.write("".join(lines))
+                file.flush()
+
+    def _record(self, t: float, method: str, route: str, params: dict, token: str,
+            body: bytes, status: int, response: bytes, query: bytes = b"") -> dict:
+        record = {"t": round(t, 6), "method": method, "route": route, "params": params,
+            "user": _token_user(token), "status": status}
+        if query:
+            record["query"] = self._query(query.decode("latin-1"))
+        try:
+            body = json.loads(body) if body else None
+        except ValueError:
+            body = None
+        try:
+            data = json.loads(response) if response else {}
+        except ValueError:
+            data = {}
+        body = self._anonymise(body)
+        if route == "/batch" and isinstance(body, dict) and isinstance(body.get("operations"), list):
+            # ответы операций есть и у отклонённого пакета (до первой неудачной)
+            results = data.get("data") if isinstance(data, dict) and isinstance(data.get("data"), list) else []
+            body["operations"] = [self._operation(operation, results[n] if n < len(results) else None)
+                for n, operation in enumerate(body["operations"])]
+        record["body"] = body
+        self._link(record, route, params, data)
+        return record
+
+    def _anonymise(self, body):
+        if not isinstance(body, dict):
+            return body
+        return {key: pseudonym(value, self.salt) if key in ANONYMISED_FIELDS else value
+            for key, value in body.items()}
+
+    def _query(self, query: str) -> str:
+        """Строка запроса с псевдонимами вместо строки поиска.
+        """
+        return urlencode([(key, pseudonym(value, self.salt) if key in ANONYMISED_QUERY else value)
+            for key, value in parse_qsl(query, keep_blank_values = True)])
+
+    def _operation(self, operation, data) -> dict:
+        """Запись операции /batch: маршрут и параметры пути, тело с псевдонимами.
+        """
+        if not isinstance(operation, dict) or not isinstance(operation.get("path"), str):
+            return operation
+        path, _, query = operation["path"].partition("?")
+        route, params = path, {}
+        for template, pattern in self.patterns:
+            match = pattern.match(path)
+            if match:
+                route, params = template, match.groupdict()
+                break
+        record = {"method": str(operation.get("method", "POST")).upper(), "route": route,
+            "params": params, "body": self._anonymise(operation.get("body"))}
+        if query:
+            record["query"] = self._query(query)
+        self._link(record, route, params, data)
+        return record
+
+    @staticmethod
+    def _link(record: dict, route: str, params: dict, data) -> None:
+        """Добавить в запись данные для связывания цепочек при воспроизведении.
+        """
+        if route == "/get/{params}":
+            record["params"] = {}
+            record["link"] = link_id(params.get("params", ""))
+        if not isinstance(data, dict) or data.get("status_code") != "0":
+            return
+        if route in CREATE_ROUTES:
+            record["created"] = data["data"]["id"]
+        elif route == "/login":
+            record["token_user"] = _token_user(data["token"])
+        elif route == "/send":
+            record["link"] = link_id(urlsplit(data["url"]).path.rsplit("/", 1)[-1])
+
+
+class CaptureMiddleware:
+    """ASGI middleware - записывает запросы в журнал трафика.
+
+    Должен стоять внутри RouteContextMiddleware.
+    """
+    def __init__(self, app, log: CaptureLog, routes: set) -> None:
+        """
+        Args:
+            app: ASGI-приложение.
+            log (CaptureLog): Журнал трафика.
+            routes (set): Шаблоны записываемых маршрутов.
+        """
+        self.app = app
+        self.log = log
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send) -> None:
+        route = context.request_route.get()
+        if scope["type"] != "http" or route not in self.routes:
+            await self.app(scope, receive, send)
+            return
+
+        t = time.monotonic() - self.log.start
+        body = []
+        response = []
+        status = []
+        linked = route in LINKED_ROUTES
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                body.append(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+            elif linked and message["type"] == "http.response.body":
+                response.append(message.get("body", b""))
+            await send(message)
+
+        await self.app(scope, receive_wrapper, send_wrapper)
+        token = next((value.decode("latin-1") for key, value in scope["headers"] if key == b"token"), None)
+        self.log.put((t, scope["method"], route, dict(scope.get("path_params", {})), token,
+            b"".join(body), status[0] if status else None, b"".join(response), scope.get("query_string", b"")))
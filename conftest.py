@@ -0,0 +1,76 @@
+import os
+
+# каждый процесс pytest-xdist работает в своей схеме БД; переменная должна быть
+# выставлена до импорта database, который создаёт таблицы при импорте
+os.environ["POSTGRES_SCHEMA"] = "test_" + os.getenv("PYTEST_XDIST_WORKER", "main")
+# фоновые потоки приложения (очистка удалённых пользователей, сверка счётчиков)
+# не запускаются: они гонялись бы с db_clear_all, тесты вызывают их сами
+os.environ["PURGE_BACKGROUND"] = "0"
+os.environ["ITEM_COUNTS_RECONCILE_S"] = "0"
+
+import pytest
+import auth
+import database
+import routes
+import storage
+from main import app
+from querycount import BudgetTestClient
+
+################################################################################
+# fixtures
+################################################################################
+
+USERS = [{"login": "admin", "password": "admin"},
+         {"login": "user_1", "password": "user_1_password"},
+         {"login": "user_2", "password": "user_2_password"},
+         {"login": "user_3", "password": "user_3_password"}]
+
+ITEMS = [{"name": "item_1", "owner": "admin"},
+         {"name": "item_2", "owner": "admin"},
+         {"name": "item_3", "owner": "user_1"},
+         {"name": "item_4", "owner": "user_2"}]
+
+
+@pytest.fixture(scope = "session")
+def client():
+    """Клиент, вызывающий приложение в том же процессе, без живого сервера.
+
+    Каждый запрос проверяется на бюджет обращений к БД его маршрута.
+    """
+    with BudgetTestClient(app, database.engine) as client:
+        yield client
+
+
+@pytest.fixture(autouse = True)
+def clean_db():
+    """Каждый тест начинается с пустых таблиц, замкнутым автоматом защиты БД
+    и без ответов, запомненных предыдущими тестами.
+    """
+    database.db_clear_all()
+    routes.stale.entries.clear()
+    routes.flights.flights.clear()
+    if storage.breaker is not None:
+        storage.breaker.reset()
+    yield
+
+
+@pytest.fixture
+def dump() -> dict:
+    """Пользователи USERS: идентификаторы (<login>_id) и токены (<login>_jwt).
+    """
+    dump = {}
+    for user in USERS:
+        id = database.db_create_user(user["login"], user["password"]).id
+        dump[user["login"] + "_id"] = id
+        dump[user["login"] + "_jwt"] = auth.jwt_encode({"user_id": id})
+    return dump
+
+
+@pytest.fixture
+def dump_items(dump: dict) -> dict:
+    """Пользователи USERS и объекты ITEMS: к dump добавляются <name>_id.
+    """
+    for item in ITEMS:
+        dump[item["name"] + "_id"] = database.db_create_item(
+            item["name"], dump[item["owner"] + "_id"]).id
+    return dump
@@ -5,10 +5,93 @@ POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_HOST = os.getenv("POSTGRES_HOST")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT")
 POSTGRES_DB = os.getenv("POSTGRES_DB")
-SQLALCHEMY_DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+# схема для таблиц приложения (пусто - схема по умолчанию); тесты получают
+# отдельную схему на каждый процесс, чтобы их можно было запускать параллельно
+POSTGRES_SCHEMA = os.getenv("POSTGRES_SCHEMA", "")
+# драйвер PostgreSQL для SQLAlchemy: psycopg2 (диалект psycopg - psycopg 3 - есть с SQLAlchemy 2.0)
+POSTGRES_DRIVER = os.getenv("POSTGRES_DRIVER", "psycopg2")
+SQLALCHEMY_DATABASE_URL = f"postgresql+{POSTGRES_DRIVER}://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+# частые запросы - подготовленные на сервере (PREPARE на каждом соединении пула)
+PREPARED_STATEMENTS = os.getenv("PREPARED_STATEMENTS", "1") == "1"
+# срок установки соединения с БД, секунды: недоступная БД не держит запрос дольше
+POSTGRES_CONNECT_TIMEOUT = int(os.getenv("POSTGRES_CONNECT_TIMEOUT", 5))
+# пул соединений: постоянные соединения (открываются при прогреве) и сверх них
+POSTGRES_POOL_SIZE = int(os.getenv("POSTGRES_POOL_SIZE", 5))
+POSTGRES_MAX_OVERFLOW = int(os.getenv("POSTGRES_MAX_OVERFLOW", 10))
+# хранилище данных (storage.py): "postgres" - БД по SQLALCHEMY_DATABASE_URL,
+# "memory" - в памяти процесса, без БД (данные не сохраняются между запусками)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
 API_HOST = os.getenv("API_HOST")
 API_PORT = os.getenv("API_PORT")
 API_URL = f"http://{API_HOST}:{API_PORT}"
+# журнал медленных запросов: порог в миллисекундах (0 - выключен)
+# и снятие EXPLAIN (ANALYZE, BUFFERS) для медленных SELECT
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 0))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "0") == "1"
+# трассировка: файл для span'ов в формате OTLP/JSON (пусто - выключена)
+# и доля трассируемых запросов
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+# журнал трафика для воспроизведения (replay.py): файл (пусто - выключен)
+# и соль псевдонимов логинов и паролей (пусто - случайная на каждый запуск)
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", "")
+CAPTURE_SALT = os.getenv("CAPTURE_SALT", "")
+# ограничение частоты запросов по пользователю/IP (лимиты - @rate_limit в routes.py)
+RATE_LIMIT = os.getenv("RATE_LIMIT", "0") == "1"
+# контроль допуска: лимиты одновременных запросов по группам маршрутов
+# (группы - @admission_group в routes.py) и срок ожидания в очереди, мс
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "0") == "1"
+ADMISSION_QUEUE_MS = float(os.getenv("ADMISSION_QUEUE_MS", 50))
+# сколько миллисекунд после выполнения запроса списка отдавать его результат
+# одинаковым запросам без обращения к БД (0 - только одновременным)
+SINGLE_FLIGHT_WINDOW_MS = float(os.getenv("SINGLE_FLIGHT_WINDOW_MS", 0))
+# сколько секунд хранить ответы на запросы с заголовком Idempotency-Key
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 24 * 60 * 60))
+# максимум операций в одном запросе /batch
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", 100))
+# максимум объектов в одной ссылке /send (идентификаторы входят в URL)
+SEND_MAX_ITEMS = int(os.getenv("SEND_MAX_ITEMS", 500))
+# удаление пользователя: объекты удаляются фоном частями по PURGE_BATCH_SIZE
+# строк с паузой PURGE_PAUSE_MS между частями
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", 1000))
+PURGE_PAUSE_MS = float(os.getenv("PURGE_PAUSE_MS", 50))
+# фоновый поток очистки (0 - не запускать: тесты вызывают purger.purge() сами)
+PURGE_BACKGROUND = os.getenv("PURGE_BACKGROUND", "1") == "1"
+# поток событий /items/events: интервал пинга простаивающего соединения, секунды
+FEED_HEARTBEAT = float(os.getenv("FEED_HEARTBEAT", 15))
+# поиск объектов /items/search: максимум результатов на страницу и сколько
+# совпадений ранжировать при поиске подстроки
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", 100))
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", 10000))
+# интервал фоновой сверки счётчиков объектов по владельцам, секунды (0 - выключена)
+ITEM_COUNTS_RECONCILE_S = float(os.getenv("ITEM_COUNTS_RECONCILE_S", 3600))
+# автомат защиты БД (breaker.py): размыкается, когда в окне из BREAKER_WINDOW
+# последних обращений доля ошибок и обращений дольше BREAKER_SLOW_MS не меньше
+# BREAKER_FAILURE_RATE; через BREAKER_OPEN_S секунд пропускает пробное обращение
+CIRCUIT_BREAKER = os.getenv("CIRCUIT_BREAKER", "1") == "1"
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", 20))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", 0.5))
+BREAKER_SLOW_MS = float(os.getenv("BREAKER_SLOW_MS", 1000))
+BREAKER_OPEN_S = float(os.getenv("BREAKER_OPEN_S", 5))
+# сколько последних успешных ответов маршрутов чтения хранить для выдачи при недоступной БД
+STALE_CACHE_SIZE = int(os.getenv("STALE_CACHE_SIZE", 1024))
+# готовность (health.py): результат проверки БД переиспользуется READY_CHECK_S секунд;
+# по SIGTERM процесс DRAIN_S секунд отвечает "не готов" и только потом завершается
+READY_CHECK_S = float(os.getenv("READY_CHECK_S", 1))
+DRAIN_S = float(os.getenv("DRAIN_S", 5))
+# служебные маршруты /admin/*: значение заголовка admin-token (пусто - маршруты выключены)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# профилировщик /admin/profile: максимальная длительность снятия, секунды
+PROFILE_MAX_S = float(os.getenv("PROFILE_MAX_S", 60))
+# учёт памяти по маршрутам (memprof.py, tracemalloc) с запуска процесса и глубина
+# сохраняемого стека выделения; включается и во время работы - POST /admin/memory
+ALLOC_TRACE = os.getenv("ALLOC_TRACE", "0") == "1"
+ALLOC_TRACE_FRAMES = int(os.getenv("ALLOC_TRACE_FRAMES", 10))
+# задержка цикла событий (loopmon.py): интервал замера и порог остановки цикла, мс -
+# при остановке дольше порога снимается стек блокирующего вызова (GET /admin/loop)
+LOOP_MONITOR = os.getenv("LOOP_MONITOR", "1") == "1"
+LOOP_LAG_INTERVAL_MS = float(os.getenv("LOOP_LAG_INTERVAL_MS", 50))
+LOOP_STALL_MS = float(os.getenv("LOOP_STALL_MS", 100))
 
 
 class Error(Exception):
@@ -67,4 +150,111 @@ class OwnerError(Error):
         self.value = value
 
     def __str__(self):
-        return f"Item '{self.value}' is owned by another user"
\ No newline at end of file
+        return f"Item '{self.value}' is owned by another user"
+
+
+class RateLimitError(Error):
+    """Превышена частота запросов к маршруту.
+    """
+    def __init__(self, value):
+        self.code = "6"
+        self.value = value
+
+    def __str__(self):
+        return f"Too many requests, retry in {self.value} s"
+
+
+class OverloadError(Error):
+    """Сервер перегружен, запрос отклонён без выполнения.
+    """
+    def __init__(self):
+        self.code = "7"
+
+    def __str__(self):
+        return "Server is overloaded, retry later"
+
+
+class IdempotencyKeyError(Error):
+    """Ключ идемпотентности уже использован для запроса с другим телом.
+    """
+    def __init__(self, value):
+        self.code = "8"
+        self.value = value
+
+    def __str__(self):
+        return f"Idempotency key '{self.value}' was used with a different request"
+
+
+class BatchError(Error):
+    """Пакет операций /batch не выполнен.
+    """
+    def __init__(self, value):
+        self.code = "9"
+        self.value = value
+
+    def __str__(self):
+        return f"Batch failed: {self.value}"
+
+
+class VersionConflictError(Error):
+    """Объект изменён другим запросом между чтением и записью.
+    """
+    def __init__(self, value):
+        self.code = "10"
+        self.value = value
+
+    def __str__(self):
+        return f"Item '{self.value}' was modified by another request"
+
+
+class UnavailableError(Error):
+    """БД недоступна (автомат защиты разомкнут), запрос отклонён без обращения к БД.
+    """
+    def __init__(self):
+        self.code = "11"
+
+    def __str__(self):
+        return "Database is unavailable, retry later"
+
+
+class NotReadyError(Error):
+    """Процесс не принимает трафик: прогрев, выход из балансировки, недоступна БД.
+    """
+    def __init__(self, value):
+        self.code = "12"
+        self.value = value
+
+    def __str__(self):
+        return f"Service is not ready: {self.value}"
+
+
+class AdminError(Error):
+    """Служебный маршрут: неверный admin-token либо служебные маршруты выключены.
+    """
+    def __init__(self):
+        self.code = "13"
+
+    def __str__(self):
+        return "Admin access denied"
+
+
+class LimitError(Error):
+    """Превышено допустимое количество значений в запросе.
+    """
+    def __init__(self, value):
+        self.code = "14"
+        self.value = value
+
+    def __str__(self):
+        return f"Limit exceeded: {self.value}"
+
+
+class IdempotencyPendingError(Error):
+    """Запрос с тем же ключом идемпотентности ещё выполняется.
+    """
+    def __init__(self, value):
+        self.code = "15"
+        self.value = value
+
+    def __str__(self):
+        return f"Request with idempotency key '{self.value}' is in progress"
@@ -0,0 +1,86 @@
+import threading
+from contextvars import ContextVar
+from starlette.routing import Match
+
+################################################################################
+# request context
+################################################################################
+
+# шаблон маршрута текущего запроса, например "/items/{id}"
+request_route: ContextVar = ContextVar("request_route", default = None)
+
+
+# шаблон маршрута, на который работает поток пула: {идентификатор потока: маршрут} -
+# контекст чужого потока не прочитать, а профилировщику нужен маршрут каждого потока
+thread_routes: dict = {}
+
+
+def routed(fn, *args):
+    """Выполнить fn(*args), отметив текущий поток маршрутом запроса (thread_routes).
+
+    Для функций, которые запрос выполняет в пуле потоков (run_in_threadpool
+    копирует контекст запроса в поток).
+    """
+    ident = threading.get_ident()
+    thread_routes[ident] = request_route.get()
+    try:
+        return fn(*args)
+    finally:
+        thread_routes.pop(ident, None)
+
+
+def route_path(scope: dict) -> str:
+    """Определить шаблон маршрута, которому соответствует запрос.
+
+    Args:
+        scope (dict): ASGI scope запроса.
+
+    Returns:
+        str: Шаблон маршрута либо путь запроса, если маршрут не найден.
+    """
+    app = scope.get("app")
+    if app is not None:
+        for route in app.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+    return scope.get("path")
+
+
+def endpoint_attributes(app, name: str) -> dict:
+    """Собрать значения атрибута, объявленного декоратором на обработчиках маршрутов.
+
+    Args:
+        app: Приложение FastAPI.
+        name (str): Имя атрибута, например "rate_limit".
+
+    Returns:
+        dict: {(метод, шаблон маршрута): значение} для маршрутов с атрибутом.
+    """
+    attributes = {}
+    for route in app.router.routes:
+        value = getattr(getattr(route, "endpoint", None), name, None)
+        if value is not None:
+            for method in getattr(route, "methods", None) or ():
+                attributes[(method, route.path)] = value
+    return attributes
+
+
+class RouteContextMiddleware:
+    """ASGI middleware - привязывает шаблон маршрута к контексту запроса.
+
+    Шаблон доступен через request_route всем слоям ниже (auth, database),
+    чтобы журналы и метрики можно было сопоставить с маршрутом.
+    """
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = request_route.set(route_path(scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_route.reset(token)
@@ -1,9 +1,30 @@
-from sqlalchemy import create_engine
+import re
+import json
+import datetime
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import any_, create_engine, delete, event, select, text, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, ForeignKey, Integer, String
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy.exc import IntegrityError, NoResultFound
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, func
+from sqlalchemy.orm import aliased, relationship, sessionmaker
+from sqlalchemy.exc import DBAPIError, IntegrityError, NoResultFound
+from sqlalchemy.orm.exc import StaleDataError
 from constants import *
+from slowlog import SlowQueryLog
+from tracing import TracedQueuePool, instrument_engine, traced
+
+
+# функции db_*, общие для всех хранилищ (storage.py, memory.py)
+__all__ = ["engine", "ITEM_EVENTS",
+    "db_transaction", "db_in_transaction", "db_clear_all",
+    "db_create_user", "db_read_user", "db_read_user_by_id", "db_update_user", "db_delete_user",
+    "db_deleted_users", "db_purge_user", "db_deletion_progress", "db_user_list",
+    "db_create_item", "db_read_item", "db_read_item_by_id", "db_read_transfer",
+    "db_update_item",
+    "db_delete_item", "db_rebase_item", "db_rebase_items", "db_item_list",
+    "db_item_counts", "db_reconcile_item_counts", "db_search_items",
+    "db_reserve_response", "db_store_response", "db_release_response"]
 
 
 ################################################################################
@@ -11,9 +32,20 @@ from constants import *
 ################################################################################
 
 engine = create_engine(
-    url = SQLALCHEMY_DATABASE_URL
+    url = SQLALCHEMY_DATABASE_URL,
+    poolclass = TracedQueuePool,
+    pool_size = POSTGRES_POOL_SIZE,
+    max_overflow = POSTGRES_MAX_OVERFLOW,
+    connect_args = dict(connect_timeout = POSTGRES_CONNECT_TIMEOUT,
+        **({"options": f"-csearch_path={POSTGRES_SCHEMA}"} if POSTGRES_SCHEMA else {}))
 )
 
+if SLOW_QUERY_MS > 0:
+    SlowQueryLog(engine, SLOW_QUERY_MS, explain = SLOW_QUERY_EXPLAIN).install()
+
+if TRACE_FILE:
+    instrument_engine(engine)
+
 
 ################################################################################
 # model
@@ -44,6 +76,8 @@ class DBUser(DBModelExt):
     id = Column(Integer, nullable = False, primary_key = True, autoincrement = True, index = True)
     login = Column(String, nullable = False, unique = True, index = True)
     password = Column(String, nullable = False)
+    # момент удаления: пользователь и его объекты скрыты, объекты удаляются фоном (purge.py)
+    deleted_at = Column(DateTime, nullable = True)
     items = relationship("DBItem", back_populates = "owner", passive_deletes = True)
 
     def __init__(self, login: str, password: str) -> None:
@@ -58,35 +92,262 @@ class DBItem(DBModelExt):
 
     id = Column(Integer, nullable = False, primary_key = True, autoincrement = True, index = True)
     name = Column(String, nullable = False, unique = True, index = True)
-    owner_id = Column(Integer, ForeignKey("users.id", ondelete = 'CASCADE'), nullable = False)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete = 'CASCADE'), nullable = False, index = True)
+    version = Column(Integer, nullable = False, server_default = "1")
     owner = relationship("DBUser", back_populates = "items")
 
+    # UPDATE проверяет версию, прочитанную вместе с объектом, и увеличивает её:
+    # параллельное изменение того же объекта вызывает StaleDataError
+    __mapper_args__ = {"version_id_col": version}
+
     def __init__(self, name: str, owner_id: int) -> None:
         self.name = name
         self.owner_id = owner_id
 
 
+class DBItemCount(DBModelExt):
+    """Таблица со счётчиками объектов по владельцам.
+
+    Обновляется функциями db_* в транзакции изменения объектов;
+    расхождения исправляет db_reconcile_item_counts.
+    """
+    __tablename__ = "item_counts"
+
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete = 'CASCADE'), nullable = False, primary_key = True)
+    count = Column(Integer, nullable = False, server_default = "0")
+
+
+class DBIdempotencyKey(DBModelExt):
+    """Таблица с ответами на запросы с заголовком Idempotency-Key.
+
+    Запись без ответа (response NULL) - ключ зарезервирован выполняющимся запросом.
+    """
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String, nullable = False, primary_key = True)
+    route = Column(String, nullable = False, primary_key = True)
+    request = Column(String, nullable = False)
+    response = Column(String, nullable = True)
+    created = Column(DateTime, nullable = False, server_default = func.now(), index = True)
+
+
+if POSTGRES_SCHEMA:
+    with engine.begin() as connection:
+        connection.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{POSTGRES_SCHEMA}"'))
+
 DBModel.metadata.create_all(engine)
 
+# create_all не добавляет столбцы в уже существующие таблицы
+with engine.begin() as connection:
+    connection.execute(text("ALTER TABLE items ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1"))
+    connection.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP"))
+    connection.execute(text("ALTER TABLE idempotency_keys ALTER COLUMN response DROP NOT NULL"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_items_owner_id ON items (owner_id)"))
+    # поиск по началу наименования (db_search_items): в порядке байтов (COLLATE "C")
+    # индекс подходит и для LIKE 'q%', и для сортировки результатов
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_items_name_prefix ON items ((lower(name) COLLATE "C"))'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_items_owner_name_prefix '
+        'ON items (owner_id, (lower(name) COLLATE "C"))'))
+
+# поиск подстроки (LIKE '%q%') - триграммный индекс, если доступно расширение pg_trgm;
+# без него поиск подстроки просматривает таблицу
+try:
+    with engine.begin() as connection:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public"))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_items_name_trgm "
+            "ON items USING gin (lower(name) public.gin_trgm_ops)"))
+except DBAPIError:
+    pass
+
+
+################################################################################
+# prepared statements
+################################################################################
+
+# частые запросы: имя -> (типы параметров, текст с параметрами $1, $2...);
+# только чтение - бюджеты запросов и журнал медленных запросов считают EXECUTE чтением
+PREPARED = {
+    "read_user": ("text",
+        "SELECT id, login, password, deleted_at FROM users WHERE login = $1 AND deleted_at IS NULL"),
+    "read_user_by_id": ("integer",
+        "SELECT id, login, password, deleted_at FROM users WHERE id = $1 AND deleted_at IS NULL"),
+    "read_item_by_id": ("integer",
+        "SELECT items.id, items.name, items.owner_id, items.version FROM items "
+        "JOIN users ON users.id = items.owner_id WHERE items.id = $1 AND users.deleted_at IS NULL"),
+    # объект для изменения (db_update_item, db_rebase_item) - без учёта удаления владельца
+    "load_item": ("integer",
+        "SELECT id, name, owner_id, version FROM items WHERE id = $1"),
+    # проверка передачи (db_read_transfer): владельцы объектов и новый владелец одним запросом
+    "read_transfer": ("integer[], text",
+        "SELECT items.id, items.owner_id, new_owner.id AS new_owner_id FROM unnest($1) AS ids (id) "
+        "LEFT JOIN (items JOIN users ON users.id = items.owner_id AND users.deleted_at IS NULL) "
+        "ON items.id = ids.id "
+        "LEFT JOIN users AS new_owner ON new_owner.login = $2 AND new_owner.deleted_at IS NULL")
+}
+
+
+def _prepare(dbapi_connection, connection_record) -> None:
+    """Подготовить запросы PREPARED на новом соединении пула.
+
+    Подготовленный запрос живёт до закрытия соединения; EXECUTE не тратит
+    время сервера на разбор и планирование запроса.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("".join(f"PREPARE {name} ({types}) AS {sql};" for name, (types, sql) in PREPARED.items()))
+    cursor.close()
+    dbapi_connection.commit()
+
+
+def _prepared(name: str, *params):
+    """Запрос PREPARED с параметрами: EXECUTE подготовленного запроса либо,
+    если подготовка выключена, тот же текст.
+    """
+    keys = {f"p{n}": value for n, value in enumerate(params, 1)}
+    if PREPARED_STATEMENTS and engine.dialect.driver == "psycopg2":
+        statement = f"EXECUTE {name} (" + ", ".join(f":{key}" for key in keys) + ")"
+    else:
+        statement = re.sub(r"\$(\d+)", r":p\1", PREPARED[name][1])
+    return text(statement).bindparams(**keys)
+
+
+if PREPARED_STATEMENTS and engine.dialect.driver == "psycopg2":
+    # таблицы уже созданы; соединения, открытые до подписки, закрываются
+    event.listen(engine, "connect", _prepare)
+    engine.dispose()
+
+
+################################################################################
+# item events
+################################################################################
+
+# канал LISTEN/NOTIFY событий объектов (feed.py); у каждой схемы свой канал
+ITEM_EVENTS = "item_events" + (f"_{POSTGRES_SCHEMA}" if POSTGRES_SCHEMA else "")
+
+
+def _count_items(deltas: dict):
+    """Запрос изменения счётчиков item_counts.
+
+    Args:
+        deltas (dict): {владелец: изменение числа объектов}.
+
+    Returns:
+        INSERT ... ON CONFLICT DO UPDATE либо None, если изменений нет.
+    """
+    # строки счётчиков блокируются в порядке владельцев - встречные передачи не взаимоблокируются
+    rows = [{"owner_id": owner_id, "count": delta} for owner_id, delta in sorted(deltas.items()) if delta]
+    if not rows:
+        return None
+    statement = insert(DBItemCount).values(rows)
+    return statement.on_conflict_do_update(index_elements = [DBItemCount.owner_id],
+        set_ = {"count": DBItemCount.count + statement.excluded.count})
+
+
+def _notify(session, event: str, ids: list, owner_id: int = None, new_owner_id: int = None) -> None:
+    """Отправить событие об объектах в канал ITEM_EVENTS и обновить счётчики
+    объектов владельцев (item_counts) - одним запросом.
+
+    NOTIFY транзакционный: слушатели получат событие при фиксации транзакции,
+    при откате оно пропадёт.
+
+    Args:
+        session: Сессия записи.
+        event (str): "create", "update", "rebase" либо "delete".
+        ids (list): Идентификаторы объектов.
+        owner_id (int, optional): Владелец до изменения.
+        new_owner_id (int, optional): Владелец после изменения.
+    """
+    payload = json.dumps({"event": event, "ids": ids, "owner_id": owner_id,
+        "new_owner_id": new_owner_id}, separators = (",", ":"))
+    statement = select(func.pg_notify(ITEM_EVENTS, payload))
+    deltas = {}
+    if owner_id is not None:
+        deltas[owner_id] = -len(ids)
+    if new_owner_id is not None:
+        deltas[new_owner_id] = deltas.get(new_owner_id, 0) + len(ids)
+    counts = _count_items(deltas)
+    if counts is not None:
+        # изменяющий CTE выполняется, даже если на него нет ссылок
+        statement = statement.add_cte(counts.cte("counts"))
+    session.execute(statement)
+
 
 ################################################################################
 # CRUD
 ################################################################################
 
-DBSession = sessionmaker(autocommit = False, autoflush = False, bind = engine)
+_sessionmaker = sessionmaker(autocommit = False, autoflush = False, bind = engine)
+
+# сессия общей транзакции текущего запроса (db_transaction)
+_transaction: ContextVar = ContextVar("db_transaction", default = None)
+
+
+class _TransactionSession:
+    """Сессия общей транзакции в роли сессии функции db_*.
+
+    commit() только отправляет изменения в БД (flush), выход из with не
+    закрывает сессию: фиксирует либо откатывает транзакцию db_transaction.
+    """
+    def __init__(self, session) -> None:
+        self.session = session
+
+    def __enter__(self) -> "_TransactionSession":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        return None
+
+    def commit(self) -> None:
+        self.session.flush()
+
+    def __getattr__(self, name: str):
+        return getattr(self.session, name)
+
+
+def DBSession():
+    """Сессия для функции db_*: новая либо сессия общей транзакции db_transaction.
+    """
+    session = _transaction.get()
+    return _sessionmaker() if session is None else _TransactionSession(session)
+
+
+@contextmanager
+def db_transaction():
+    """Выполнить вызовы функций db_* внутри блока в одной транзакции.
+
+    Транзакция фиксируется при выходе из блока и откатывается при исключении.
+    Для частичного отката используется session.begin_nested() (SAVEPOINT).
+
+    Yields:
+        Session: Сессия транзакции.
+    """
+    with _sessionmaker() as session:
+        with session.begin():
+            token = _transaction.set(session)
+            try:
+                yield session
+            finally:
+                _transaction.reset(token)
 
 
+def db_in_transaction() -> bool:
+    """Выполняется ли текущий код внутри db_transaction.
+    """
+    return _transaction.get() is not None
+
+
+@traced()
 def db_clear_all() -> None:
     """Удалить все данные из таблиц БД.
     """
     global DBSession
     with DBSession() as session:
-        session.query(DBItem).delete()
-        session.query(DBUser).delete()
+        for table in reversed(DBModel.metadata.sorted_tables):
+            session.execute(table.delete())
         session.commit()
     return None
 
 
+@traced()
 def db_create_user(login: str, password: str) -> DBUser:
     """Создать нового пользователя.
 
@@ -131,6 +392,7 @@ def db_create_user(login: str, password: str) -> DBUser:
     return user
 
 
+@traced()
 def db_read_user(login: str) -> DBUser:
     """Зачитать пользователя по заданному логину.
 
@@ -146,7 +408,7 @@ def db_read_user(login: str) -> DBUser:
     global DBSession
     with DBSession() as session:
         try:
-            user = session.query(DBUser).filter(DBUser.login == login).one()
+            user = session.execute(select(DBUser).from_statement(_prepared("read_user", login))).scalar_one()
 
             '''
             # alternative 1
@@ -160,6 +422,7 @@ def db_read_user(login: str) -> DBUser:
     return user
 
 
+@traced()
 def db_read_user_by_id(id: int) -> DBUser:
     """Зачитать пользователя по заданному идентификатору.
 
@@ -175,12 +438,13 @@ def db_read_user_by_id(id: int) -> DBUser:
     global DBSession
     with DBSession() as session:
         try:
-            user = session.query(DBUser).filter(DBUser.id == id).one()
+            user = session.execute(select(DBUser).from_statement(_prepared("read_user_by_id", id))).scalar_one()
         except NoResultFound as exc:
             raise NoValueFoundError(id) from exc
     return user
 
 
+@traced()
 def db_update_user(id: int, new_login: str, new_password: str) -> DBUser:
     """Обновить данные существующего пользователя.
 
@@ -231,9 +495,14 @@ def db_update_user(id: int, new_login: str, new_password: str) -> DBUser:
     return user
 
 
+@traced()
 def db_delete_user(id: int) -> None:
     """Удалить пользователя по заданному идентификатору.
 
+    Пользователь только помечается удалённым (одна строка), сразу перестаёт
+    быть виден вместе со своими объектами; объекты и сама запись удаляются
+    фоном частями (db_purge_user). Логин занят, пока удаление не завершено.
+
     Args:
         id (int): Идентификатор.
 
@@ -245,30 +514,105 @@ def db_delete_user(id: int) -> None:
     """
     global DBSession
     with DBSession() as session:
-        try:
-            user = session.query(DBUser).filter(DBUser.id == id).one()
-            session.delete(user)
-            session.commit()
+        result = session.execute(
+            update(DBUser). \
+            where(DBUser.id == id, DBUser.deleted_at.is_(None)). \
+            values(deleted_at = func.now()). \
+            execution_options(synchronize_session = False))
+        if result.rowcount != 1:
+            raise NoValueFoundError(id)
+        session.commit()
 
-            '''
-            # alternative 1 (no exception)
-            session.query(DBUser).filter(DBUser.id == id).delete()
-            session.commit()
-            '''
+        '''
+        # alternative 1 (cascade delete in one transaction - locks all items of the user)
+        user = session.query(DBUser).filter(DBUser.id == id).one()
+        session.delete(user)
+        session.commit()
+        '''
 
-            '''
-            # alternative 2 (no exception)
-            from sqlalchemy import delete
+    return None
+
+
+@traced()
+def db_deleted_users() -> list:
+    """Получить идентификаторы пользователей, ожидающих удаления объектов.
+
+    Returns:
+        list: Идентификаторы в порядке удаления.
+    """
+    global DBSession
+    with DBSession() as session:
+        ids = session.execute(
+            select(DBUser.id). \
+            where(DBUser.deleted_at.isnot(None)). \
+            order_by(DBUser.deleted_at)).scalars().all()
+    return ids
+
+
+@traced()
+def db_purge_user(id: int, limit: int) -> int:
+    """Удалить очередную часть объектов удалённого пользователя, а когда
+    объектов не осталось - его запись.
+
+    Каждая часть - отдельная короткая транзакция, блокирующая не более limit
+    строк; строки, уже заблокированные параллельной очисткой, пропускаются.
+
+    Args:
+        id (int): Идентификатор пользователя, помеченного удалённым.
+        limit (int): Сколько объектов удалить за раз.
+
+    Returns:
+        int: Сколько объектов удалено (0 - пользователь удалён полностью).
+    """
+    global DBSession
+    with DBSession() as session:
+        batch = select(DBItem.id). \
+            where(DBItem.owner_id == id). \
+            limit(limit). \
+            with_for_update(skip_locked = True)
+        count = session.execute(
+            delete(DBItem). \
+            where(DBItem.id.in_(batch)). \
+            execution_options(synchronize_session = False)).rowcount
+        if count > 0:
+            session.execute(_count_items({id: -count}))
+        else:
             session.execute(
-                delete(DBUser).where(DBUser.id == id))
-            session.commit()
-            '''
-        except NoResultFound as exc:
-            raise NoValueFoundError(id) from exc
+                delete(DBUser). \
+                where(DBUser.id == id, DBUser.deleted_at.isnot(None)). \
+                execution_options(synchronize_session = False))
+        session.commit()
+    return count
 
-    return None
 
+@traced()
+def db_deletion_progress(id: int) -> dict:
+    """Состояние удаления пользователя.
 
+    Args:
+        id (int): Идентификатор.
+
+    Raises:
+        NoValueFoundError: Пользователь не существует (либо удаление завершено).
+
+    Returns:
+        dict: {"deleting": bool, "deleted_at": момент удаления, "items_left": сколько объектов осталось}.
+    """
+    global DBSession
+    with DBSession() as session:
+        row = session.execute(
+            select(DBUser.deleted_at,
+                select(func.count(DBItem.id)).where(DBItem.owner_id == DBUser.id).scalar_subquery()). \
+            where(DBUser.id == id)).one_or_none()
+    if row is None:
+        raise NoValueFoundError(id)
+    deleted_at, items_left = row
+    return {"deleting": deleted_at is not None,
+        "deleted_at": deleted_at.isoformat() if deleted_at else None,
+        "items_left": items_left}
+
+
+@traced()
 def db_user_list() -> list:
     """Получить список пользователей.
 
@@ -277,10 +621,11 @@ def db_user_list() -> list:
     """
     global DBSession
     with DBSession() as session:
-        user_list = session.query(DBUser)
+        user_list = session.query(DBUser).filter(DBUser.deleted_at.is_(None)).all()
     return user_list
 
 
+@traced()
 def db_create_item(name: str, owner_id: int) -> DBItem:
     """Создать новый объект.
 
@@ -299,13 +644,17 @@ def db_create_item(name: str, owner_id: int) -> DBItem:
         try:
             item = DBItem(name = name, owner_id = owner_id)
             session.add(item)
+            session.flush()
+            _notify(session, "create", [item.id], new_owner_id = owner_id)
+            # все поля известны после INSERT - отвязать объект, чтобы commit его не сбросил
+            session.expunge(item)
             session.commit()
-            session.refresh(item)
         except IntegrityError as exc:
             raise DuplicateValueError(name) from exc
     return item
 
 
+@traced()
 def db_read_item(name: str) -> DBItem:
     """Зачитать объект по заданному наименованию.
 
@@ -321,12 +670,14 @@ def db_read_item(name: str) -> DBItem:
     global DBSession
     with DBSession() as session:
         try:
-            item = session.query(DBItem).filter(DBItem.name == name).one()
+            item = session.query(DBItem).join(DBItem.owner). \
+                filter(DBItem.name == name, DBUser.deleted_at.is_(None)).one()
         except NoResultFound as exc:
             raise NoValueFoundError(name) from exc
     return item
 
 
+@traced()
 def db_read_item_by_id(id: int) -> DBItem:
     """Зачитать объект по заданному идентификатору.
 
@@ -342,23 +693,46 @@ def db_read_item_by_id(id: int) -> DBItem:
     global DBSession
     with DBSession() as session:
         try:
-            item = session.query(DBItem).filter(DBItem.id == id).one()
+            item = session.execute(select(DBItem).from_statement(_prepared("read_item_by_id", id))).scalar_one()
         except NoResultFound as exc:
             raise NoValueFoundError(id) from exc
     return item
 
 
-def db_update_item(id: int, new_name: str, new_owner_id: int) -> DBItem:
+@traced()
+def db_read_transfer(ids: list, new_owner_login: str) -> tuple:
+    """Зачитать владельцев объектов и нового владельца для передачи (/send)
+    одним запросом.
+
+    Args:
+        ids (list): Идентификаторы объектов.
+        new_owner_login (str): Логин нового владельца.
+
+    Returns:
+        tuple: ({объект: владелец} для найденных объектов, идентификатор нового
+            владельца либо None, если такого пользователя нет).
+    """
+    global DBSession
+    with DBSession() as session:
+        rows = session.execute(_prepared("read_transfer", list(ids), new_owner_login)).all()
+    owners = {row.id: row.owner_id for row in rows if row.id is not None}
+    return owners, rows[0].new_owner_id if rows else None
+
+
+@traced()
+def db_update_item(id: int, new_name: str, new_owner_id: int, version: int = None) -> DBItem:
     """Обновить данные существующего объекта.
 
     Args:
         id (int): Идентификатор - данные этого объекта будут обновлены.
         new_name (str): Новое наименование.
         new_owner_id (int): Новый пользователь-владелец объекта.
+        version (int, optional): Ожидаемая версия объекта (DBItem.version).
 
     Raises:
         NoValueFoundError: Объект с заданным идентификатором не существует.
         DuplicateValueError: Объект с заданным наименованием уже существует.
+        VersionConflictError: Объект изменён другим запросом.
 
     Returns:
         DBItem: Объект в виде модели DBItem.
@@ -366,7 +740,10 @@ def db_update_item(id: int, new_name: str, new_owner_id: int) -> DBItem:
     global DBSession
     with DBSession() as session:
         try:
-            item = session.query(DBItem).filter(DBItem.id == id).one()
+            item = session.execute(select(DBItem).from_statement(_prepared("load_item", id))).scalar_one()
+            if version is not None and item.version != version:
+                raise VersionConflictError(id)
+            _notify(session, "update", [id], item.owner_id, new_owner_id)
             item.name = new_name
             item.owner_id = new_owner_id
             session.commit()
@@ -375,9 +752,12 @@ def db_update_item(id: int, new_name: str, new_owner_id: int) -> DBItem:
             raise NoValueFoundError(id) from exc
         except IntegrityError as exc:
             raise DuplicateValueError(new_name) from exc
+        except StaleDataError as exc:
+            raise VersionConflictError(id) from exc
     return item
 
 
+@traced()
 def db_delete_item(id: int) -> None:
     """Удалить объект по заданному идентификатору.
 
@@ -392,24 +772,29 @@ def db_delete_item(id: int) -> None:
     """
     global DBSession
     with DBSession() as session:
-        try:
-            item = session.query(DBItem).filter(DBItem.id == id).one()
-            session.delete(item)
-            session.commit()
-        except NoResultFound as exc:
-            raise NoValueFoundError(id) from exc
+        owner_id = session.execute(
+            delete(DBItem). \
+            where(DBItem.id == id). \
+            returning(DBItem.owner_id)).scalar_one_or_none()
+        if owner_id is None:
+            raise NoValueFoundError(id)
+        _notify(session, "delete", [id], owner_id = owner_id)
+        session.commit()
     return None
 
 
-def db_rebase_item(id: int, new_owner_id: int) -> DBItem:
+@traced()
+def db_rebase_item(id: int, new_owner_id: int, version: int = None) -> DBItem:
     """Перепривязать объект от одного владельца к другому.
 
     Args:
         id (int): Идентификатор - этот объект будет перепривязан.
         new_owner_id (int): Идентификатор пользователя-нового-владельца объекта.
+        version (int, optional): Ожидаемая версия объекта (DBItem.version).
 
     Raises:
         NoValueFoundError: Объект с заданным идентификатором не существует.
+        VersionConflictError: Объект изменён другим запросом.
 
     Returns:
         DBItem: Объект в виде модели DBItem.
@@ -417,19 +802,250 @@ def db_rebase_item(id: int, new_owner_id: int) -> DBItem:
     global DBSession
     with DBSession() as session:
         try:
-            item = session.query(DBItem).filter(DBItem.id == id).one()
+            item = session.execute(select(DBItem).from_statement(_prepared("load_item", id))).scalar_one()
+            if version is not None and item.version != version:
+                raise VersionConflictError(id)
+            _notify(session, "rebase", [id], item.owner_id, new_owner_id)
             item.owner_id = new_owner_id
             session.commit()
             session.refresh(item)
         except NoResultFound as exc:
             raise NoValueFoundError(id) from exc
+        except StaleDataError as exc:
+            raise VersionConflictError(id) from exc
     return item
 
 
+@traced()
+def db_rebase_items(ids: list, owner_id: int, new_owner_id: int) -> list:
+    """Перепривязать объекты от одного владельца к другому одним запросом.
+
+    Владелец проверяется в том же UPDATE, поэтому объект, переданный или
+    удалённый после выдачи ссылки, не будет перепривязан.
+
+    Args:
+        ids (list): Идентификаторы объектов.
+        owner_id (int): Идентификатор текущего владельца.
+        new_owner_id (int): Идентификатор нового владельца.
+
+    Raises:
+        OwnerError: Часть объектов не принадлежит owner_id, ни один объект не перепривязан.
+
+    Returns:
+        list: Объекты в виде моделей DBItem.
+    """
+    global DBSession
+    with DBSession() as session:
+        item_list = session.execute(select(DBItem).from_statement(update(DBItem). \
+            where(DBItem.id == any_(ids), DBItem.owner_id == owner_id). \
+            values(owner_id = new_owner_id, version = DBItem.version + 1).returning(DBItem))).scalars().all()
+        if len(item_list) != len(ids):
+            # выход из сессии без commit откатывает UPDATE
+            rebased = {item.id for item in item_list}
+            raise OwnerError(", ".join(str(id) for id in ids if id not in rebased))
+        # значения уже получены через RETURNING - отвязать объекты, чтобы commit их не сбросил
+        for item in item_list:
+            session.expunge(item)
+        _notify(session, "rebase", ids, owner_id, new_owner_id)
+        session.commit()
+    return item_list
+
+
+@traced()
 def db_item_list() -> list:
     """Получить список объектов.
     """
     global DBSession
     with DBSession() as session:
-        item_list = session.query(DBItem)
-    return item_list
\ No newline at end of file
+        item_list = session.query(DBItem).join(DBItem.owner). \
+            filter(DBUser.deleted_at.is_(None)).all()
+    return item_list
+
+
+@traced()
+def db_item_counts(owner_id: int = None) -> dict:
+    """Получить число объектов по владельцам из счётчиков item_counts,
+    не пересчитывая объекты.
+
+    Args:
+        owner_id (int, optional): Только для этого владельца.
+
+    Returns:
+        dict: {владелец: число объектов}; владельцы без объектов не включаются.
+    """
+    statement = select(DBItemCount.owner_id, DBItemCount.count). \
+        join(DBUser, DBUser.id == DBItemCount.owner_id). \
+        where(DBUser.deleted_at.is_(None), DBItemCount.count > 0)
+    if owner_id is not None:
+        statement = statement.where(DBItemCount.owner_id == owner_id)
+    global DBSession
+    with DBSession() as session:
+        counts = dict(session.execute(statement).all())
+    return counts
+
+
+@traced()
+def db_reconcile_item_counts(after_id: int = 0, limit: int = 100) -> tuple:
+    """Пересчитать счётчики item_counts очередной части пользователей и
+    исправить расхождения.
+
+    Строки счётчиков блокируются до пересчёта: параллельное изменение
+    объектов этих владельцев либо уже зафиксировано и учтено в пересчёте,
+    либо ждёт блокировки и применит своё изменение к исправленному значению.
+
+    Args:
+        after_id (int, optional): Пересчитывать пользователей с id больше заданного.
+        limit (int, optional): Сколько пользователей пересчитать.
+
+    Returns:
+        tuple: (последний пересчитанный id либо None, если пользователей больше нет;
+            число исправленных счётчиков).
+    """
+    global DBSession
+    with DBSession() as session:
+        ids = session.execute(
+            select(DBUser.id). \
+            where(DBUser.id > after_id). \
+            order_by(DBUser.id). \
+            limit(limit)).scalars().all()
+        if not ids:
+            return None, 0
+        session.execute(insert(DBItemCount). \
+            values([{"owner_id": id, "count": 0} for id in ids]). \
+            on_conflict_do_nothing())
+        session.execute(
+            select(DBItemCount.owner_id). \
+            where(DBItemCount.owner_id == any_(ids)). \
+            order_by(DBItemCount.owner_id). \
+            with_for_update())
+        actual = select(DBItem.owner_id, func.count().label("count")). \
+            where(DBItem.owner_id == any_(ids)). \
+            group_by(DBItem.owner_id). \
+            subquery()
+        actual = select(DBUser.id.label("owner_id"), func.coalesce(actual.c.count, 0).label("count")). \
+            outerjoin(actual, actual.c.owner_id == DBUser.id). \
+            where(DBUser.id == any_(ids)). \
+            subquery()
+        repaired = session.execute(
+            update(DBItemCount). \
+            where(DBItemCount.owner_id == actual.c.owner_id, DBItemCount.count != actual.c.count). \
+            values(count = actual.c.count). \
+            execution_options(synchronize_session = False)).rowcount
+        session.commit()
+    return ids[-1], repaired
+
+
+def _like_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+@traced()
+def db_search_items(query: str, owner_id: int = None, substring: bool = True,
+        limit: int = 20, offset: int = 0) -> list:
+    """Найти объекты по началу либо по части наименования без учёта регистра.
+
+    Поиск по началу идёт по индексу ix_items_name_prefix (ix_items_owner_name_prefix
+    для одного владельца), результаты - по алфавиту. Поиск подстроки использует
+    триграммный индекс ix_items_name_trgm; результаты ранжируются: совпадение
+    ближе к началу, затем более короткое наименование. Ранжируются первые
+    SEARCH_MAX_CANDIDATES совпадений, чтобы частая подстрока не сортировала всю таблицу.
+
+    Args:
+        query (str): Строка поиска.
+        owner_id (int, optional): Искать только среди объектов этого владельца.
+        substring (bool, optional): True - по части наименования, False - по началу.
+        limit (int, optional): Размер страницы.
+        offset (int, optional): Сколько результатов пропустить.
+
+    Returns:
+        list: Объекты в виде моделей DBItem.
+    """
+    query = query.lower()
+    name = func.lower(DBItem.name)
+    if substring:
+        condition = name.like("%" + _like_escape(query) + "%", escape = "\\")
+    else:
+        name = name.collate("C")
+        condition = name.like(_like_escape(query) + "%", escape = "\\")
+    statement = select(DBItem).join(DBItem.owner).where(condition, DBUser.deleted_at.is_(None))
+    if owner_id is not None:
+        statement = statement.where(DBItem.owner_id == owner_id)
+
+    if substring:
+        candidates = aliased(DBItem, statement.limit(SEARCH_MAX_CANDIDATES).subquery())
+        statement = select(candidates).order_by(
+            func.strpos(func.lower(candidates.name), query), func.length(candidates.name), candidates.id)
+    else:
+        statement = statement.order_by(name, DBItem.id)
+
+    global DBSession
+    with DBSession() as session:
+        item_list = session.execute(statement.limit(limit).offset(offset)).scalars().all()
+    return item_list
+
+
+@traced()
+def db_reserve_response(key: str, route: str, request: str) -> DBIdempotencyKey:
+    """Зарезервировать ключ идемпотентности за запросом либо зачитать запись по ключу.
+
+    Резерв - запись без ответа: одновременный запрос с тем же ключом видит её
+    и не выполняет создание повторно. Заодно удаляет записи старше IDEMPOTENCY_TTL.
+
+    Args:
+        key (str): Значение заголовка Idempotency-Key.
+        route (str): Маршрут (вместе с ключом - идентификатор запроса).
+        request (str): Отпечаток запроса.
+
+    Returns:
+        DBIdempotencyKey: None - ключ зарезервирован за этим запросом, иначе запись
+            по ключу (response None - запрос с этим ключом ещё выполняется).
+    """
+    cutoff = func.now() - datetime.timedelta(seconds = IDEMPOTENCY_TTL)
+    global DBSession
+    with DBSession() as session:
+        while True:
+            session.execute(delete(DBIdempotencyKey).where(DBIdempotencyKey.created < cutoff). \
+                execution_options(synchronize_session = False))
+            cursor = session.execute(insert(DBIdempotencyKey).values(key = key, route = route,
+                request = request, response = None).on_conflict_do_nothing())
+            session.commit()
+            if cursor.rowcount == 1:
+                return None
+            record = session.query(DBIdempotencyKey).filter(DBIdempotencyKey.key == key,
+                DBIdempotencyKey.route == route).one_or_none()
+            # запись могла быть снята между вставкой и чтением - резервируем заново
+            if record is not None:
+                return record
+
+
+@traced()
+def db_store_response(key: str, route: str, response: str) -> None:
+    """Сохранить ответ в зарезервированную запись ключа идемпотентности.
+
+    Args:
+        key (str): Значение заголовка Idempotency-Key.
+        route (str): Маршрут.
+        response (str): Ответ в формате JSON.
+    """
+    global DBSession
+    with DBSession() as session:
+        session.execute(update(DBIdempotencyKey).where(DBIdempotencyKey.key == key,
+            DBIdempotencyKey.route == route).values(response = response). \
+            execution_options(synchronize_session = False))
+        session.commit()
+
+
+@traced()
+def db_release_response(key: str, route: str) -> None:
+    """Снять резерв ключа идемпотентности (ответ не сохраняется, запрос можно повторить).
+
+    Args:
+        key (str): Значение заголовка Idempotency-Key.
+        route (str): Маршрут.
+    """
+    global DBSession
+    with DBSession() as session:
+        session.execute(delete(DBIdempotencyKey).where(DBIdempotencyKey.key == key,
+            DBIdempotencyKey.route == route, DBIdempotencyKey.response.is_(None)). \
+            execution_options(synchronize_session = False))
+        session.commit()
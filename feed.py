@@ -0,0 +1,137 @@
+import json
+import asyncio
+import logging
+import psycopg2
+import storage
+
+################################################################################
+# item events feed
+################################################################################
+
+logger = logging.getLogger("feed")
+
+
+class ItemFeed:
+    """Рассылка событий объектов (storage.ITEM_EVENTS) подписчикам процесса.
+
+    Одно соединение LISTEN на процесс, без отдельного потока: сокет
+    соединения отслеживается циклом событий (add_reader); хранилище в памяти
+    передаёт события напрямую (storage.listeners). Каждое событие
+    передаётся подписчикам - прежнему и новому владельцу объектов.
+    Подписчик, не успевающий забирать события (очередь заполнена),
+    отключается, чтобы не копить память.
+    """
+    def __init__(self, queue_size: int = 256, retry: float = 1.0) -> None:
+        self.queue_size = queue_size
+        self.retry = retry
+        self.subscribers = {}
+        self.connection = None
+        self.loop = None
+
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        """Подписаться на события объектов пользователя.
+
+        Returns:
+            asyncio.Queue: Очередь событий (dict); None в очереди - подписка
+                прервана, переподключиться.
+        """
+        self._listen()
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue) -> None:
+        queues = self.subscribers.get(user_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[user_id]
+
+    def close(self) -> None:
+        """Закрыть соединение LISTEN и прервать подписки.
+        """
+        for queues in list(self.subscribers.values()):
+            for queue in list(queues):
+                self._drop(queue)
+        self.subscribers.clear()
+        if self.connection is True:
+            storage.listeners.remove(self._put)
+        elif self.connection:
+            self.loop.remove_reader(self.connection.fileno())
+            self.connection.close()
+        self.connection = None
+
+    def _listen(self) -> None:
+        if self.connection is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        if storage.engine is None:
+            storage.listeners.append(self._put)
+            self.connection = True
+            return
+        try:
+            # отдельное соединение вне пула: оно занято LISTEN всё время работы процесса
+            connection = storage.engine.raw_connection()
+            connection.detach()
+            connection = connection.connection
+            connection.set_session(autocommit = True)
+            connection.cursor().execute(f'LISTEN "{storage.ITEM_EVENTS}"')
+        except psycopg2.Error:
+            logger.exception("item feed: LISTEN failed")
+            self.loop.call_later(self.retry, self._reconnect)
+            self.connection = False
+            return
+        self.connection = connection
+        self.loop.add_reader(connection.fileno(), self._read)
+
+    def _reconnect(self) -> None:
+        self.connection = None
+        if self.subscribers:
+            self._listen()
+
+    def _put(self, event: dict) -> None:
+        # события хранилища в памяти приходят из потока, выполнившего изменение
+        self.loop.call_soon_threadsafe(self.publish, event)
+
+    def _read(self) -> None:
+        try:
+            self.connection.poll()
+        except psycopg2.Error:
+            logger.exception("item feed: connection lost")
+            self.loop.remove_reader(self.connection.fileno())
+            self.connection.close()
+            self.connection = False
+            # события за время переподключения потеряны - подписчики переподключаются
+            for queues in list(self.subscribers.values()):
+                for queue in list(queues):
+                    self._drop(queue)
+            self.subscribers.clear()
+            self.loop.call_later(self.retry, self._reconnect)
+            return
+        while self.connection.notifies:
+            notify = self.connection.notifies.pop(0)
+            try:
+                self.publish(json.loads(notify.payload))
+            except (ValueError, KeyError):
+                pass
+
+    def publish(self, event: dict) -> None:
+        """Передать событие подписчикам - прежнему и новому владельцу.
+        """
+        for user_id in {event["owner_id"], event["new_owner_id"]}:
+            for queue in list(self.subscribers.get(user_id, ())):
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    self.unsubscribe(user_id, queue)
+                    self._drop(queue)
+
+    @staticmethod
+    def _drop(queue: asyncio.Queue) -> None:
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+
+feed = ItemFeed()
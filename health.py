@@ -0,0 +1,135 @@
+import os
+import time
+import signal
+import asyncio
+import logging
+import threading
+from sqlalchemy import text
+from constants import NotReadyError, POSTGRES_POOL_SIZE, POSTGRES_MAX_OVERFLOW, READY_CHECK_S
+
+################################################################################
+# liveness, readiness, warm-up and drain
+################################################################################
+
+logger = logging.getLogger("health")
+
+
+class Health:
+    """Состояние процесса для балансировщика.
+
+    starting - прогрев: открываются постоянные соединения пула и заполняются
+    кэши; ready - процесс принимает трафик; draining - процесс выходит из
+    балансировки перед завершением. Готовность дополнительно требует, чтобы
+    пул не был исчерпан и БД отвечала на SELECT 1; проверка БД выполняется
+    не чаще раза в interval секунд, одновременные проверки ждут одну.
+    """
+    def __init__(self, interval: float = 1.0, clock = time.monotonic) -> None:
+        self.interval = interval
+        self.clock = clock
+        self.state = "starting"
+        self.engine = None
+        self.checked = None
+        self.result = None
+        self._lock = threading.Lock()
+
+    def warm_up(self, engine, primers: list = ()) -> None:
+        """Прогреть процесс и перейти в состояние ready.
+
+        Args:
+            engine: SQLAlchemy engine (None - хранилище в памяти, без пула).
+            primers (list): Функции без аргументов, заполняющие кэши.
+        """
+        self.engine = engine
+        started = time.perf_counter()
+        try:
+            if engine is not None:
+                # все постоянные соединения одновременно - пул открывает каждое
+                # (и готовит на нём запросы), а не отдаёт одно и то же
+                connections = [engine.connect() for _ in range(POSTGRES_POOL_SIZE)]
+                for connection in connections:
+                    connection.close()
+            for primer in primers:
+                primer()
+        except Exception:
+            # готовность покажет проверка БД; кэши заполнят первые запросы
+            logger.exception("warm-up failed")
+        if self.state == "starting":
+            self.state = "ready"
+        logger.info("warm-up: %.3f s", time.perf_counter() - started)
+
+    def start_warm_up(self, engine, primers: list = ()) -> None:
+        """Прогреть процесс в фоновом потоке: проверка живости отвечает сразу.
+        """
+        self.state = "starting"
+        threading.Thread(target = self.warm_up, args = (engine, primers),
+            name = "warm-up", daemon = True).start()
+
+    def drain(self) -> None:
+        """Выйти из балансировки: дальше проверка готовности не проходит.
+        """
+        self.state = "draining"
+
+    def _pool(self) -> dict:
+        pool = self.engine.pool
+        return {"size": pool.size(), "idle": pool.checkedin(), "in_use": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0)}
+
+    def check(self) -> dict:
+        """Проверить готовность.
+
+        Returns:
+            dict: {"state": состояние[, "pool": счётчики пула]}.
+
+        Raises:
+            NotReadyError: Процесс не готов принимать трафик.
+        """
+        if self.state != "ready":
+            raise NotReadyError(self.state)
+        if self.engine is None:
+            return {"state": self.state}
+        with self._lock:
+            if self.checked is None or self.clock() - self.checked >= self.interval:
+                self.result = self._check()
+                self.checked = self.clock()
+            result = self.result
+        if isinstance(result, NotReadyError):
+            raise result
+        return result
+
+    def _check(self):
+        pool = self._pool()
+        if pool["idle"] == 0 and pool["overflow"] >= POSTGRES_MAX_OVERFLOW:
+            # все соединения заняты - новый запрос ждал бы в очереди пула
+            return NotReadyError("connection pool exhausted")
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        except Exception as exc:
+            return NotReadyError(f"database unreachable ({type(exc).__name__})")
+        return {"state": self.state, "pool": pool}
+
+    def install_drain(self, seconds: float) -> None:
+        """По SIGTERM сначала выйти из балансировки и только через seconds секунд
+        начать штатное завершение uvicorn (как по SIGINT): балансировщик успевает
+        заметить неготовность, пока процесс ещё обслуживает запросы.
+        """
+        if seconds <= 0 or threading.current_thread() is not threading.main_thread():
+            return
+        loop = asyncio.get_running_loop()
+
+        def terminate():
+            if self.state == "draining":
+                # повторный SIGTERM - завершиться, не дожидаясь конца вывода
+                os.kill(os.getpid(), signal.SIGINT)
+                return
+            logger.info("SIGTERM: draining for %s s", seconds)
+            self.drain()
+            loop.call_later(seconds, os.kill, os.getpid(), signal.SIGINT)
+
+        try:
+            loop.add_signal_handler(signal.SIGTERM, terminate)
+        except NotImplementedError:
+            pass
+
+
+health = Health(READY_CHECK_S)
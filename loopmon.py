@@ -0,0 +1,145 @@
+import sys
+import time
+import logging
+import threading
+import traceback
+from collections import deque
+from stats import percentile
+from context import route_path
+
+################################################################################
+# event loop lag monitor
+################################################################################
+
+logger = logging.getLogger("loop")
+
+
+class LoopMonitor:
+    """Замер задержки цикла событий и поиск блокирующих вызовов.
+
+    Таймер цикла срабатывает каждые interval секунд; задержка (lag) -
+    насколько позже назначенного он сработал: столько ждал любой готовый
+    к выполнению запрос. Отдельный поток следит за последним срабатыванием:
+    если цикл не отвечает дольше threshold секунд, он ещё занят - поток
+    снимает стек потока цикла (блокирующий вызов) и маршрут, который его
+    выполняет. Длительность остановки записывается, когда цикл освободится.
+    """
+    def __init__(self, interval: float = 0.05, threshold: float = 0.1, window: int = 1200,
+            history: int = 100) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = deque(maxlen = window)
+        self.stalls = deque(maxlen = history)
+        self.stall_count = 0
+        self.max_lag = 0.0
+        self.endpoints = {}
+        self.loop = None
+        self.ident = None
+        self.beat = None
+        self.expected = None
+        self.stalling = None
+        self._handle = None
+        self._stop = None
+
+    def start(self, loop, interval: float, threshold: float, endpoints: dict = None) -> None:
+        """Начать замер (вызывается из потока цикла событий).
+
+        Args:
+            loop: Цикл событий.
+            interval (float): Интервал замера, секунды.
+            threshold (float): Порог остановки цикла, секунды.
+            endpoints (dict, optional): {code обработчика: маршрут} - маршрут остановки
+                по кадру обработчика в стеке.
+        """
+        self.stop()
+        self.interval = interval
+        self.threshold = threshold
+        self.loop = loop
+        self.ident = threading.get_ident()
+        self.endpoints = endpoints or {}
+        self.beat = self.expected = time.monotonic()
+        self._handle = loop.call_soon(self._tick)
+        self._stop = threading.Event()
+        threading.Thread(target = self._watch, args = (self._stop,), name = "loop-monitor", daemon = True).start()
+
+    def stop(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._stop.set()
+            self._handle = None
+
+    def _tick(self) -> None:
+        now = time.monotonic()
+        lag = max(now - self.expected, 0.0)
+        self.lags.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+        stall = self.stalling
+        if stall is not None:
+            stall["duration_ms"] = round((now - self.beat) * 1000, 3)
+            self.stalling = None
+        self.beat = now
+        self.expected = now + self.interval
+        self._handle = self.loop.call_later(self.interval, self._tick)
+
+    def _watch(self, stop: threading.Event) -> None:
+        while not stop.wait(self.threshold / 2):
+            blocked = time.monotonic() - self.beat
+            if self.stalling is None and blocked > self.interval + self.threshold:
+                self._capture(blocked)
+
+    def _capture(self, blocked: float) -> None:
+        """Снять стек заблокированного цикла событий.
+        """
+        frame = sys._current_frames().get(self.ident)
+        if frame is None:
+            return
+        stall = {"at": time.time(), "route": self._route(frame), "duration_ms": None,
+            "stack": [f"{item.filename}:{item.lineno} {item.name}" for item in traceback.extract_stack(frame)]}
+        self.stalling = stall
+        self.stalls.append(stall)
+        self.stall_count += 1
+        logger.warning("event loop blocked for %.0f+ ms in %s at %s", blocked * 1000,
+            stall["route"], stall["stack"][-1])
+
+    def _route(self, frame) -> str:
+        # кадр обработчика маршрута, иначе - запрос из scope ближайшего middleware
+        request = None
+        while frame is not None:
+            route = self.endpoints.get(frame.f_code)
+            if route is not None:
+                return route
+            scope = frame.f_locals.get("scope") if request is None else None
+            if isinstance(scope, dict) and scope.get("type") == "http":
+                request = route_path(scope)
+            frame = frame.f_back
+        return request
+
+    def stats(self) -> dict:
+        """Задержка цикла за последние window замеров и последние остановки.
+        """
+        lags = sorted(self.lags)
+        return {
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "lag_ms": {
+                "current": round(self.lags[-1] * 1000, 3) if self.lags else 0.0,
+                "p50": round(percentile(lags, 50) * 1000, 3),
+                "p99": round(percentile(lags, 99) * 1000, 3),
+                "max": round(self.max_lag * 1000, 3)
+            },
+            "stalls": self.stall_count,
+            "recent": list(self.stalls)
+        }
+
+    def prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus.
+        """
+        stats = self.stats()
+        lines = ["# TYPE event_loop_lag_seconds gauge"]
+        for name in ("current", "p50", "p99", "max"):
+            lines.append(f'event_loop_lag_seconds{{stat="{name}"}} {stats["lag_ms"][name] / 1000}')
+        lines += ["# TYPE event_loop_stalls_total counter", f"event_loop_stalls_total {stats['stalls']}"]
+        return "\n".join(lines) + "\n"
+
+
+monitor = LoopMonitor()
@@ -1,10 +1,94 @@
 from fastapi import FastAPI
-from routes import router
-from constants import API_PORT
+from routes import router, warm_up
+from storage import engine, breaker
+from breaker import CircuitBreakerMiddleware
+from admission import AdmissionControl, AdmissionMiddleware
+from constants import *
+from capture import CaptureLog, CaptureMiddleware
+from context import RouteContextMiddleware
+from memprof import AllocationMiddleware, allocations
+from health import health
+from loopmon import monitor
+from purge import purger
+from reconcile import reconciler
+from ratelimit import RateLimitMiddleware
+from tracing import TracingMiddleware, tracer
+import asyncio
 import uvicorn
 
 app = FastAPI()
 app.include_router(router)
 
+
+@app.on_event("startup")
+async def start_health() -> None:
+    # прогрев в фоне: пока он идёт, /health/ready отвечает 503; SIGTERM - вывод из балансировки
+    health.start_warm_up(engine, [warm_up])
+    health.install_drain(DRAIN_S)
+
+
+@app.on_event("shutdown")
+def stop_health() -> None:
+    health.drain()
+
+
+@app.on_event("startup")
+async def start_loop_monitor() -> None:
+    # задержка цикла событий; остановки относятся к маршруту по кадру его обработчика
+    if LOOP_MONITOR:
+        monitor.start(asyncio.get_running_loop(), LOOP_LAG_INTERVAL_MS / 1000, LOOP_STALL_MS / 1000,
+            {route.endpoint.__code__: route.path for route in router.routes})
+
+
+@app.on_event("shutdown")
+def stop_loop_monitor() -> None:
+    monitor.stop()
+
+
+@app.on_event("startup")
+def start_purge() -> None:
+    # фоновое удаление объектов удалённых пользователей
+    if PURGE_BACKGROUND:
+        purger.start(PURGE_BATCH_SIZE, PURGE_PAUSE_MS / 1000)
+
+
+@app.on_event("startup")
+def start_reconcile() -> None:
+    # сверка счётчиков объектов по владельцам: при запуске и затем периодически
+    if ITEM_COUNTS_RECONCILE_S > 0:
+        reconciler.start(ITEM_COUNTS_RECONCILE_S)
+
+
+# add_middleware оборачивает приложение снаружи:
+# добавленный последним middleware выполняется первым
+if TRACE_FILE:
+    tracer.configure(TRACE_FILE, TRACE_SAMPLE_RATE)
+    app.add_middleware(TracingMiddleware)
+if CAPTURE_FILE:
+    routes = [route.path for route in router.routes]
+    app.add_middleware(CaptureMiddleware, log = CaptureLog(CAPTURE_FILE, CAPTURE_SALT or None, routes),
+        routes = set(routes))
+if ADMISSION_CONTROL:
+    admission = AdmissionControl(queue_timeout = ADMISSION_QUEUE_MS / 1000)
+    if engine is not None:
+        # латентность БД подстраивает лимиты; хранилище в памяти - лимиты постоянные
+        admission.install(engine)
+    app.add_middleware(AdmissionMiddleware, control = admission)
+
+    @app.on_event("startup")
+    async def start_admission() -> None:
+        admission.start(asyncio.get_running_loop())
+if breaker is not None:
+    # при разомкнутом автомате изменяющие запросы сразу получают 503
+    app.add_middleware(CircuitBreakerMiddleware, breaker = breaker)
+if RATE_LIMIT:
+    # снаружи остальных: отклонённый запрос не пишется в журналы и не трассируется
+    app.add_middleware(RateLimitMiddleware)
+if ALLOC_TRACE:
+    allocations.start(ALLOC_TRACE_FRAMES)
+# всегда: учёт памяти включается и во время работы (POST /admin/memory)
+app.add_middleware(AllocationMiddleware, tracker = allocations)
+app.add_middleware(RouteContextMiddleware)
+
 if __name__ == "__main__":
     uvicorn.run('main:app', host = '0.0.0.0', port = int(API_PORT), reload = True)
\ No newline at end of file
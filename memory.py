@@ -0,0 +1,644 @@
+import time
+import copy
+import datetime
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from constants import *
+
+################################################################################
+# in-memory storage
+################################################################################
+
+# функции db_* с теми же сигнатурами, результатами и исключениями, что в database.py;
+# хранилище выбирается в storage.py (STORAGE_BACKEND)
+__all__ = ["engine", "ITEM_EVENTS", "listeners",
+    "db_transaction", "db_in_transaction", "db_clear_all",
+    "db_create_user", "db_read_user", "db_read_user_by_id", "db_update_user", "db_delete_user",
+    "db_deleted_users", "db_purge_user", "db_deletion_progress", "db_user_list",
+    "db_create_item", "db_read_item", "db_read_item_by_id", "db_read_transfer",
+    "db_update_item",
+    "db_delete_item", "db_rebase_item", "db_rebase_items", "db_item_list",
+    "db_item_counts", "db_reconcile_item_counts", "db_search_items",
+    "db_reserve_response", "db_store_response", "db_release_response"]
+
+# БД нет: замер SQL-запросов (admission, querycount) и LISTEN/NOTIFY не подключаются
+engine = None
+ITEM_EVENTS = None
+
+# обработчики событий объектов (feed.py) - вызываются с событием после фиксации изменения
+listeners = []
+
+
+class MemModel:
+    """Строка таблицы в памяти: те же поля и конвертации, что у DBModelExt.
+
+    Строки не изменяются на месте - изменение заменяет строку новой,
+    поэтому откат транзакции - возврат прежних строк, а вызывающий
+    получает копию, не связанную с хранилищем.
+    """
+    columns = ()
+
+    def __str__(self) -> str:
+        return " / ".join(str(getattr(self, column)) for column in self.columns)
+
+    def to_dict(self):
+        return {column: getattr(self, column) for column in self.columns}
+
+
+class MemUser(MemModel):
+    """Пользователь (аналог DBUser).
+    """
+    columns = ("id", "login", "password", "deleted_at")
+
+    def __init__(self, id: int, login: str, password: str, deleted_at: datetime.datetime = None) -> None:
+        self.id = id
+        self.login = login
+        self.password = password
+        self.deleted_at = deleted_at
+
+    @property
+    def items(self) -> list:
+        with _locked():
+            return [copy.copy(_items[id]) for id in _owner_items.get(self.id, ())]
+
+
+class MemItem(MemModel):
+    """Объект (аналог DBItem).
+    """
+    columns = ("id", "name", "owner_id", "version")
+
+    def __init__(self, id: int, name: str, owner_id: int, version: int = 1) -> None:
+        self.id = id
+        self.name = name
+        self.owner_id = owner_id
+        self.version = version
+
+    @property
+    def owner(self) -> MemUser:
+        with _locked():
+            user = _users.get(self.owner_id)
+            return copy.copy(user) if user is not None else None
+
+
+class MemIdempotencyKey(MemModel):
+    """Сохранённый ответ (аналог DBIdempotencyKey); response None - ключ зарезервирован.
+    """
+    columns = ("key", "route", "request", "response", "created")
+
+    def __init__(self, key: str, route: str, request: str, response: str, created: float) -> None:
+        self.key = key
+        self.route = route
+        self.request = request
+        self.response = response
+        self.created = created
+
+
+# таблицы и хеш-индексы: id -> строка, login/name -> id, владелец -> {id объекта: None}
+_users = {}
+_logins = {}
+_items = {}
+_names = {}
+_owner_items = {}
+_responses = {}
+_sequences = {"users": 0, "items": 0}
+
+# один замок на хранилище: каждая функция и каждая транзакция db_transaction
+# выполняются целиком, без чередования с другими потоками; функции берут его через _locked()
+_lock = threading.RLock()
+# открытая транзакция, держащая замок, и поток, в котором она открыта
+_owner = None
+_owner_thread = None
+
+_MISSING = object()
+
+
+################################################################################
+# transactions
+################################################################################
+
+class _MemTransaction:
+    """Транзакция: журнал отката и события, отправляемые при фиксации.
+    """
+    def __init__(self) -> None:
+        self.undo = []
+        self.events = []
+
+    def begin_nested(self) -> "_MemSavepoint":
+        return _MemSavepoint(self)
+
+
+class _MemSavepoint:
+    """Точка сохранения (аналог session.begin_nested()).
+    """
+    def __init__(self, transaction: _MemTransaction) -> None:
+        self.transaction = transaction
+        self.undo = len(transaction.undo)
+        self.events = len(transaction.events)
+
+    def commit(self) -> None:
+        return None
+
+    def rollback(self) -> None:
+        _rollback(self.transaction.undo, self.undo)
+        del self.transaction.events[self.events:]
+
+
+_transaction: ContextVar = ContextVar("memory_transaction", default = None)
+
+
+def _rollback(undo: list, mark: int = 0) -> None:
+    while len(undo) > mark:
+        undo.pop()()
+
+
+@contextmanager
+def _locked():
+    """Взять замок хранилища на время вызова функции db_*.
+
+    Замок принадлежит транзакции, а не потоку: внутри db_transaction (в том
+    числе в потоках run_in_threadpool, куда копируется контекст) он уже взят.
+    Другой контекст потока, в котором открыта транзакция (другая сопрограмма
+    цикла событий), ждать не может - это взаимоблокировка, а повторный вход
+    в RLock смешал бы его изменения с чужой транзакцией; вызов отклоняется.
+
+    Raises:
+        UnavailableError: Транзакция этого потока открыта в другом контексте.
+    """
+    current = _transaction.get()
+    if current is not None and current is _owner:
+        yield
+        return
+    if _owner is not None and _owner_thread == threading.get_ident():
+        raise UnavailableError()
+    with _lock:
+        yield
+
+
+@contextmanager
+def db_transaction():
+    """Выполнить функции db_* внутри блока в одной транзакции.
+
+    Изменения видны другим потокам сразу, но до выхода из блока другие
+    потоки ждут замка хранилища; при исключении изменения откатываются.
+    """
+    global _owner, _owner_thread
+    current = _transaction.get()
+    if current is not None:
+        yield current
+        return
+    transaction = _MemTransaction()
+    with _locked():
+        token = _transaction.set(transaction)
+        _owner, _owner_thread = transaction, threading.get_ident()
+        try:
+            yield transaction
+        except BaseException:
+            _rollback(transaction.undo)
+            raise
+        finally:
+            _owner, _owner_thread = None, None
+            _transaction.reset(token)
+    for event in transaction.events:
+        _dispatch(event)
+
+
+def db_in_transaction() -> bool:
+    """Выполняется ли код внутри db_transaction().
+    """
+    return _transaction.get() is not None
+
+
+def _put(table: dict, key, value) -> None:
+    old = table.get(key, _MISSING)
+    table[key] = value
+    _log(table, key, old)
+
+
+def _remove(table: dict, key) -> None:
+    old = table.pop(key)
+    _log(table, key, old)
+
+
+def _log(table: dict, key, old) -> None:
+    transaction = _transaction.get()
+    if transaction is None:
+        return
+    def undo():
+        if old is _MISSING:
+            table.pop(key, None)
+        else:
+            table[key] = old
+    transaction.undo.append(undo)
+
+
+def _next_id(table: str) -> int:
+    # как и последовательность PostgreSQL, номер не возвращается при откате
+    _sequences[table] += 1
+    return _sequences[table]
+
+
+def _notify(event: str, ids: list, owner_id: int = None, new_owner_id: int = None) -> None:
+    """Событие об объектах (аналог NOTIFY): отправляется при фиксации транзакции.
+    """
+    event = {"event": event, "ids": ids, "owner_id": owner_id, "new_owner_id": new_owner_id}
+    transaction = _transaction.get()
+    if transaction is not None:
+        transaction.events.append(event)
+    else:
+        _dispatch(event)
+
+
+def _dispatch(event: dict) -> None:
+    for listener in listeners:
+        listener(event)
+
+
+def _live_user(id: int) -> MemUser:
+    user = _users.get(id)
+    return user if user is not None and user.deleted_at is None else None
+
+
+def _visible(item: MemItem) -> bool:
+    return _live_user(item.owner_id) is not None
+
+
+def _add_item(item: MemItem) -> None:
+    _put(_items, item.id, item)
+    _put(_names, item.name, item.id)
+    _put(_owner_items.setdefault(item.owner_id, {}), item.id, None)
+
+
+def _remove_item(item: MemItem) -> None:
+    _remove(_items, item.id)
+    _remove(_names, item.name)
+    _remove(_owner_items[item.owner_id], item.id)
+
+
+def _replace_item(item: MemItem, name: str, owner_id: int) -> MemItem:
+    new = MemItem(item.id, name, owner_id, item.version + 1)
+    if name != item.name:
+        _remove(_names, item.name)
+        _put(_names, name, item.id)
+    if owner_id != item.owner_id:
+        _remove(_owner_items[item.owner_id], item.id)
+        _put(_owner_items.setdefault(owner_id, {}), item.id, None)
+    _put(_items, item.id, new)
+    return new
+
+
+################################################################################
+# CRUD
+################################################################################
+
+def db_clear_all() -> None:
+    """Удалить все данные из таблиц.
+    """
+    with _locked():
+        for table in (_users, _logins, _items, _names, _owner_items, _responses):
+            table.clear()
+    return None
+
+
+def db_create_user(login: str, password: str) -> MemUser:
+    """Создать нового пользователя.
+
+    Raises:
+        DuplicateValueError: Пользователь с заданным логином уже существует.
+    """
+    with _locked():
+        if login in _logins:
+            raise DuplicateValueError(login)
+        user = MemUser(_next_id("users"), login, password)
+        _put(_users, user.id, user)
+        _put(_logins, login, user.id)
+        return copy.copy(user)
+
+
+def db_read_user(login: str) -> MemUser:
+    """Зачитать пользователя по заданному логину.
+
+    Raises:
+        NoValueFoundError: Пользователь с заданным логином не существует.
+    """
+    with _locked():
+        user = _live_user(_logins.get(login))
+        if user is None:
+            raise NoValueFoundError(login)
+        return copy.copy(user)
+
+
+def db_read_user_by_id(id: int) -> MemUser:
+    """Зачитать пользователя по заданному идентификатору.
+
+    Raises:
+        NoValueFoundError: Пользователь с заданным идентификатором не существует.
+    """
+    with _locked():
+        user = _live_user(id)
+        if user is None:
+            raise NoValueFoundError(id)
+        return copy.copy(user)
+
+
+def db_update_user(id: int, new_login: str, new_password: str) -> MemUser:
+    """Обновить данные существующего пользователя.
+
+    Raises:
+        NoValueFoundError: Пользователь с заданным идентификатором не существует.
+        DuplicateValueError: Пользователь с заданным новым логином уже существует.
+    """
+    with _locked():
+        user = _users.get(id)
+        if user is None:
+            raise NoValueFoundError(id)
+        if _logins.get(new_login, id) != id:
+            raise DuplicateValueError(new_login)
+        new = MemUser(id, new_login, new_password, user.deleted_at)
+        _remove(_logins, user.login)
+        _put(_logins, new_login, id)
+        _put(_users, id, new)
+        return copy.copy(new)
+
+
+def db_delete_user(id: int) -> None:
+    """Удалить пользователя: пометить удалённым, объекты удаляет db_purge_user.
+
+    Raises:
+        NoValueFoundError: Пользователь с заданным идентификатором не существует.
+    """
+    with _locked():
+        user = _live_user(id)
+        if user is None:
+            raise NoValueFoundError(id)
+        _put(_users, id, MemUser(id, user.login, user.password, datetime.datetime.now()))
+    return None
+
+
+def db_deleted_users() -> list:
+    """Получить идентификаторы пользователей, ожидающих удаления объектов.
+    """
+    with _locked():
+        users = [user for user in _users.values() if user.deleted_at is not None]
+    return [user.id for user in sorted(users, key = lambda user: user.deleted_at)]
+
+
+def db_purge_user(id: int, limit: int) -> int:
+    """Удалить очередную часть объектов удалённого пользователя, а когда
+    объектов не осталось - его запись.
+
+    Returns:
+        int: Сколько объектов удалено (0 - пользователь удалён полностью).
+    """
+    with _locked():
+        user = _users.get(id)
+        if user is None or user.deleted_at is None:
+            return 0
+        ids = list(_owner_items.get(id, ()))[:limit]
+        for item_id in ids:
+            _remove_item(_items[item_id])
+        if not ids:
+            _remove(_users, id)
+            _remove(_logins, user.login)
+            _owner_items.pop(id, None)
+        return len(ids)
+
+
+def db_deletion_progress(id: int) -> dict:
+    """Состояние удаления пользователя.
+
+    Raises:
+        NoValueFoundError: Пользователь не существует (либо удаление завершено).
+    """
+    with _locked():
+        user = _users.get(id)
+        if user is None:
+            raise NoValueFoundError(id)
+        return {"deleting": user.deleted_at is not None,
+            "deleted_at": user.deleted_at.isoformat() if user.deleted_at else None,
+            "items_left": len(_owner_items.get(id, ()))}
+
+
+def db_user_list() -> list:
+    """Получить список пользователей.
+    """
+    with _locked():
+        return [copy.copy(user) for user in _users.values() if user.deleted_at is None]
+
+
+def db_create_item(name: str, owner_id: int) -> MemItem:
+    """Создать новый объект.
+
+    Raises:
+        DuplicateValueError: Объект с заданным наименованием уже существует
+            (либо владелец не существует - как нарушение ограничения в БД).
+    """
+    with _locked():
+        if name in _names or owner_id not in _users:
+            raise DuplicateValueError(name)
+        item = MemItem(_next_id("items"), name, owner_id)
+        _add_item(item)
+        _notify("create", [item.id], new_owner_id = owner_id)
+        return copy.copy(item)
+
+
+def db_read_item(name: str) -> MemItem:
+    """Зачитать объект по заданному наименованию.
+
+    Raises:
+        NoValueFoundError: Объект с заданным наименованием не существует.
+    """
+    with _locked():
+        item = _items.get(_names.get(name))
+        if item is None or not _visible(item):
+            raise NoValueFoundError(name)
+        return copy.copy(item)
+
+
+def db_read_item_by_id(id: int) -> MemItem:
+    """Зачитать объект по заданному идентификатору.
+
+    Raises:
+        NoValueFoundError: Объект с заданным идентификатором не существует.
+    """
+    with _locked():
+        item = _items.get(id)
+        if item is None or not _visible(item):
+            raise NoValueFoundError(id)
+        return copy.copy(item)
+
+
+def db_read_transfer(ids: list, new_owner_login: str) -> tuple:
+    """Зачитать владельцев объектов и нового владельца для передачи (/send).
+
+    Returns:
+        tuple: ({объект: владелец} для найденных объектов, идентификатор нового
+            владельца либо None, если такого пользователя нет).
+    """
+    with _locked():
+        items = (_items.get(id) for id in ids)
+        owners = {item.id: item.owner_id for item in items if item is not None and _visible(item)}
+        new_owner = _live_user(_logins.get(new_owner_login))
+        return owners, new_owner.id if new_owner is not None else None
+
+
+def db_update_item(id: int, new_name: str, new_owner_id: int, version: int = None) -> MemItem:
+    """Обновить данные существующего объекта.
+
+    Raises:
+        NoValueFoundError: Объект с заданным идентификатором не существует.
+        DuplicateValueError: Объект с заданным наименованием уже существует.
+        VersionConflictError: Объект изменён другим запросом.
+    """
+    with _locked():
+        item = _items.get(id)
+        if item is None:
+            raise NoValueFoundError(id)
+        if version is not None and item.version != version:
+            raise VersionConflictError(id)
+        if _names.get(new_name, id) != id or new_owner_id not in _users:
+            raise DuplicateValueError(new_name)
+        _notify("update", [id], item.owner_id, new_owner_id)
+        return copy.copy(_replace_item(item, new_name, new_owner_id))
+
+
+def db_delete_item(id: int) -> None:
+    """Удалить объект по заданному идентификатору.
+
+    Raises:
+        NoValueFoundError: Объект с заданным идентификатором не существует.
+    """
+    with _locked():
+        item = _items.get(id)
+        if item is None:
+            raise NoValueFoundError(id)
+        _remove_item(item)
+        _notify("delete", [id], owner_id = item.owner_id)
+    return None
+
+
+def db_rebase_item(id: int, new_owner_id: int, version: int = None) -> MemItem:
+    """Перепривязать объект от одного владельца к другому.
+
+    Raises:
+        NoValueFoundError: Объект (либо новый владелец) не существует.
+        VersionConflictError: Объект изменён другим запросом.
+    """
+    with _locked():
+        item = _items.get(id)
+        if item is None:
+            raise NoValueFoundError(id)
+        if version is not None and item.version != version:
+            raise VersionConflictError(id)
+        if new_owner_id not in _users:
+            raise NoValueFoundError(new_owner_id)
+        _notify("rebase", [id], item.owner_id, new_owner_id)
+        return copy.copy(_replace_item(item, item.name, new_owner_id))
+
+
+def db_rebase_items(ids: list, owner_id: int, new_owner_id: int) -> list:
+    """Перепривязать объекты от одного владельца к другому.
+
+    Raises:
+        OwnerError: Часть объектов не принадлежит owner_id, ни один объект не перепривязан.
+    """
+    with _locked():
+        missing = [id for id in ids if id not in _owner_items.get(owner_id, ())]
+        if missing:
+            raise OwnerError(", ".join(str(id) for id in missing))
+        if new_owner_id not in _users:
+            raise NoValueFoundError(new_owner_id)
+        item_list = [copy.copy(_replace_item(_items[id], _items[id].name, new_owner_id))
+            for id in dict.fromkeys(ids)]
+        _notify("rebase", ids, owner_id, new_owner_id)
+        return item_list
+
+
+def db_item_list() -> list:
+    """Получить список объектов.
+    """
+    with _locked():
+        return [copy.copy(item) for item in _items.values() if _visible(item)]
+
+
+def db_item_counts(owner_id: int = None) -> dict:
+    """Получить число объектов по владельцам - размеры индекса владелец -> объекты.
+
+    Returns:
+        dict: {владелец: число объектов}; владельцы без объектов не включаются.
+    """
+    with _locked():
+        owners = [owner_id] if owner_id is not None else list(_owner_items)
+        return {owner: len(_owner_items[owner]) for owner in owners
+            if _owner_items.get(owner) and _live_user(owner) is not None}
+
+
+def db_reconcile_item_counts(after_id: int = 0, limit: int = 100) -> tuple:
+    """Сверка счётчиков: число объектов берётся из индекса, расхождений не бывает.
+
+    Returns:
+        tuple: (последний просмотренный id либо None, 0).
+    """
+    with _locked():
+        ids = sorted(id for id in _users if id > after_id)[:limit]
+    return (ids[-1] if ids else None), 0
+
+
+def db_search_items(query: str, owner_id: int = None, substring: bool = True,
+        limit: int = 20, offset: int = 0) -> list:
+    """Найти объекты по началу либо по части наименования без учёта регистра.
+
+    Порядок результатов - как в database.db_search_items. Поиск - просмотр
+    объектов (одного владельца, если он задан).
+    """
+    query = query.lower()
+    with _locked():
+        ids = _owner_items.get(owner_id, ()) if owner_id is not None else _items
+        items = [_items[id] for id in ids]
+        if substring:
+            found = [item for item in items if query in item.name.lower() and _visible(item)]
+            found = sorted(found, key = lambda item: item.id)[:SEARCH_MAX_CANDIDATES]
+            found.sort(key = lambda item: (item.name.lower().find(query), len(item.name), item.id))
+        else:
+            found = [item for item in items if item.name.lower().startswith(query) and _visible(item)]
+            found.sort(key = lambda item: (item.name.lower().encode(), item.id))
+        return [copy.copy(item) for item in found[offset:offset + limit]]
+
+
+def db_reserve_response(key: str, route: str, request: str) -> MemIdempotencyKey:
+    """Зарезервировать ключ идемпотентности за запросом либо зачитать запись по ключу.
+
+    Returns:
+        MemIdempotencyKey: None - ключ зарезервирован за этим запросом, иначе запись
+            по ключу (response None - запрос с этим ключом ещё выполняется).
+    """
+    with _locked():
+        now = time.time()
+        # ответы упорядочены по времени резервирования - устаревшие удаляются с начала
+        while _responses:
+            oldest = next(iter(_responses))
+            if _responses[oldest].created >= now - IDEMPOTENCY_TTL:
+                break
+            _remove(_responses, oldest)
+        if (key, route) in _responses:
+            return copy.copy(_responses[(key, route)])
+        _put(_responses, (key, route), MemIdempotencyKey(key, route, request, None, now))
+        return None
+
+
+def db_store_response(key: str, route: str, response: str) -> None:
+    """Сохранить ответ в зарезервированную запись ключа идемпотентности.
+    """
+    with _locked():
+        stored = _responses.get((key, route))
+        if stored is not None:
+            _put(_responses, (key, route), MemIdempotencyKey(key, route, stored.request, response, stored.created))
+
+
+def db_release_response(key: str, route: str) -> None:
+    """Снять резерв ключа идемпотентности (ответ не сохраняется, запрос можно повторить).
+    """
+    with _locked():
+        stored = _responses.get((key, route))
+        if stored is not None and stored.response is None:
+            _remove(_responses, (key, route))
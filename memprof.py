@@ -0,0 +1,142 @@
+import time
+import tracemalloc
+import context
+
+################################################################################
+# allocation profiling
+################################################################################
+
+# служебные кадры, которые не показываются среди мест выделения памяти
+IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+class AllocationTracker:
+    """Учёт выделения памяти (tracemalloc) по маршрутам и местам выделения.
+
+    Выключен, пока не вызван start(): без трассировки tracemalloc учёт
+    стоит одну проверку на запрос. Для каждого запроса считается прирост
+    занятой памяти (то, что осталось занятым после ответа - кэши, утечки),
+    а для запросов, выполнявшихся без других одновременных запросов, ещё
+    и пик - сколько памяти запрос занимал сверх начальной (ORM-объекты,
+    словари и JSON ответа): трассировка общая на процесс, и у одновременных
+    запросов пики не разделить.
+    """
+    def __init__(self) -> None:
+        self.routes = {}
+        self.baseline = None
+        self.started = None
+        self.inflight = 0
+        self.generation = 0
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 10) -> None:
+        """Включить трассировку и запомнить исходный снимок для сравнения.
+
+        Args:
+            frames (int, optional): Глубина стека, сохраняемого для каждого выделения.
+        """
+        if not self.tracing:
+            tracemalloc.start(frames)
+            self.routes = {}
+            self.started = time.time()
+        self.baseline = tracemalloc.take_snapshot().filter_traces(IGNORED)
+
+    def stop(self) -> None:
+        """Выключить трассировку (накопленные итоги по маршрутам сохраняются).
+        """
+        tracemalloc.stop()
+        self.baseline = None
+
+    def begin(self):
+        """Начало запроса; возвращает метку для end() либо None без трассировки.
+        """
+        if not self.tracing:
+            return None
+        self.inflight += 1
+        self.generation += 1
+        if self.inflight == 1 and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0], self.generation, self.inflight == 1
+
+    def end(self, route: str, mark) -> None:
+        """Окончание запроса - учесть его память в итогах маршрута.
+        """
+        self.inflight -= 1
+        if not self.tracing:
+            return
+        start, generation, alone = mark
+        current, peak = tracemalloc.get_traced_memory()
+        stats = self.routes.get(route)
+        if stats is None:
+            stats = self.routes[route] = {"requests": 0, "net_bytes": 0, "peak_requests": 0, "peak_bytes": 0}
+        stats["requests"] += 1
+        stats["net_bytes"] += current - start
+        # пик относится к запросу, если за время запроса не начался ни один другой
+        if alone and generation == self.generation and hasattr(tracemalloc, "reset_peak"):
+            stats["peak_requests"] += 1
+            stats["peak_bytes"] = max(stats["peak_bytes"], peak - start)
+
+    def report(self, top: int = 20, group: str = "lineno", diff: bool = True, reset: bool = False) -> dict:
+        """Итоги по маршрутам и места, где выделено больше всего памяти.
+
+        Args:
+            top (int, optional): Сколько мест выделения вернуть.
+            group (str, optional): "lineno" - по строке, "traceback" - по стеку выделения,
+                "filename" - по файлу.
+            diff (bool, optional): Сравнить с исходным снимком (start() либо прошлый reset).
+            reset (bool, optional): Сделать текущий снимок исходным для следующих сравнений.
+
+        Returns:
+            dict: {"tracing", "current", "peak", "routes", "top": [места выделения]}.
+        """
+        routes = {route: dict(stats, avg_net_bytes = stats["net_bytes"] // stats["requests"])
+            for route, stats in sorted(self.routes.items(), key = lambda item: -item[1]["net_bytes"])}
+        result = {"tracing": self.tracing, "started": self.started, "routes": routes, "top": []}
+        if not self.tracing:
+            return result
+        result["current"], result["peak"] = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED)
+        if diff and self.baseline is not None:
+            statistics = snapshot.compare_to(self.baseline, group)
+        else:
+            statistics = snapshot.statistics(group)
+        for stat in statistics[:top]:
+            frames = [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback]
+            site = {"site": frames if group == "traceback" else frames[0],
+                "size": stat.size, "count": stat.count}
+            if hasattr(stat, "size_diff"):
+                site["size_diff"], site["count_diff"] = stat.size_diff, stat.count_diff
+            result["top"].append(site)
+        if reset:
+            self.baseline = snapshot
+        return result
+
+
+class AllocationMiddleware:
+    """ASGI middleware - учёт памяти каждого запроса по маршруту
+    (context.request_route: добавляется до RouteContextMiddleware).
+    """
+    def __init__(self, app, tracker: AllocationTracker) -> None:
+        self.app = app
+        self.tracker = tracker
+
+    async def __call__(self, scope, receive, send) -> None:
+        mark = self.tracker.begin() if scope["type"] == "http" else None
+        if mark is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.tracker.end(f'{scope["method"]} {context.request_route.get()}', mark)
+
+
+allocations = AllocationTracker()
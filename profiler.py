@@ -0,0 +1,120 @@
+import sys
+import time
+import threading
+from collections import Counter
+import context
+
+################################################################################
+# sampling CPU profiler
+################################################################################
+
+# верхние кадры потоков, ожидающих ввода-вывода, блокировки или задания:
+# такие выборки по умолчанию не учитываются - профиль показывает работу
+IDLE_FRAMES = {
+    ("selectors", "select"),
+    ("threading", "wait"),
+    ("threading", "_wait_for_tstate_lock"),
+    ("queue", "get"),
+    ("concurrent.futures.thread", "_worker"),
+    ("anyio._backends._asyncio", "run"),
+}
+
+
+def _label(code, module: str) -> str:
+    return f"{module}:{code.co_name}"
+
+
+def _cpu_time(ident: int) -> float:
+    """Время процессора потока, секунды; None - недоступно.
+    """
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+class Sampler:
+    """Статистический профилировщик потоков процесса.
+
+    Пока снятие не запрошено, не работает вовсе: ни потока, ни перехвата
+    вызовов. Во время снятия отдельный поток каждые interval секунд берёт
+    стеки всех потоков (sys._current_frames), кроме ожидающих (IDLE_FRAMES)
+    и не занимавших процессор с прошлой выборки, и считает одинаковые стеки -
+    результат в формате collapsed stacks (flamegraph.pl, speedscope):
+    "кадр;кадр;...;кадр число". Маршрут выборки определяется по кадру
+    обработчика маршрута в стеке (цикл событий) либо по context.thread_routes
+    (потоки пула). Одновременно выполняется одно снятие, следующие ждут.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    def profile(self, seconds: float, interval: float = 0.01, endpoints: dict = None,
+            idle: bool = False) -> dict:
+        """Снять профиль.
+
+        Args:
+            seconds (float): Длительность снятия.
+            interval (float, optional): Интервал между выборками.
+            endpoints (dict, optional): {code обработчика: маршрут} - корень каждого
+                стека выборки - маршрут (либо thread:имя потока); None - без маршрутов.
+            idle (bool, optional): Учитывать ожидающие потоки.
+
+        Returns:
+            dict: {"samples": выборок, "duration": секунд, "routes": {маршрут: выборок},
+                "stacks": Counter {стек: выборок}}.
+        """
+        with self._lock:
+            own = threading.get_ident()
+            names = {}
+            stacks = Counter()
+            routes = Counter()
+            samples = 0
+            # поток ожидает, если его время процессора с прошлой выборки не выросло
+            cpu = {ident: _cpu_time(ident) for ident in sys._current_frames()}
+            time.sleep(interval)
+            started = time.perf_counter()
+            deadline = started + seconds
+            while True:
+                frames = sys._current_frames()
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    if not idle:
+                        used, cpu[ident] = cpu.get(ident), _cpu_time(ident)
+                        if (frame.f_globals.get("__name__"), frame.f_code.co_name) in IDLE_FRAMES or \
+                                used is not None and cpu[ident] is not None and cpu[ident] <= used:
+                            continue
+                    stack = []
+                    route = None
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(_label(code, frame.f_globals.get("__name__")))
+                        if endpoints is not None and route is None:
+                            route = endpoints.get(code)
+                        frame = frame.f_back
+                    if endpoints is not None:
+                        route = route or context.thread_routes.get(ident)
+                        if route is None:
+                            if ident not in names:
+                                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                            route = f"thread:{names.get(ident, ident)}"
+                        stack.append(route)
+                        routes[route] += 1
+                    stacks[";".join(reversed(stack))] += 1
+                frames = frame = None
+                samples += 1
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                time.sleep(min(interval, deadline - now))
+        return {"samples": samples, "duration": round(time.perf_counter() - started, 3),
+            "routes": dict(routes.most_common()), "stacks": stacks}
+
+    @staticmethod
+    def collapsed(stacks: Counter) -> str:
+        """Стеки в формате collapsed stacks, по убыванию числа выборок.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+sampler = Sampler()
@@ -0,0 +1,76 @@
+import time
+import logging
+import threading
+import storage
+
+################################################################################
+# deferred user deletion
+################################################################################
+
+logger = logging.getLogger("purge")
+
+
+class Purger:
+    """Фоновая очистка объектов удалённых пользователей.
+
+    DELETE /users/{id} только помечает пользователя удалённым; поток удаляет
+    его объекты частями по batch_size строк с паузой между частями, поэтому
+    удаление пользователя с большим числом объектов не держит блокировки
+    и не нагружает БД одной длинной транзакцией. Удаления, начатые другими
+    процессами либо прерванные перезапуском, подхватываются опросом раз
+    в idle секунд.
+    """
+    def __init__(self) -> None:
+        self.batch_size = 1000
+        self.pause = 0.05
+        self.idle = 5.0
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self, batch_size: int, pause: float, idle: float = 5.0) -> None:
+        """Запустить фоновый поток (повторный вызов ничего не делает).
+
+        Args:
+            batch_size (int): Сколько объектов удалять за раз.
+            pause (float): Пауза между частями, секунды.
+            idle (float, optional): Интервал опроса без вызовов wake(), секунды.
+        """
+        self.batch_size = batch_size
+        self.pause = pause
+        self.idle = idle
+        if self._thread is None:
+            self._thread = threading.Thread(target = self._run, name = "user-purge", daemon = True)
+            self._thread.start()
+
+    def wake(self) -> None:
+        """Начать очистку, не дожидаясь очередного опроса.
+        """
+        self._wake.set()
+
+    def purge(self) -> int:
+        """Удалить объекты всех пользователей, помеченных удалёнными.
+
+        Returns:
+            int: Сколько объектов удалено.
+        """
+        total = 0
+        for id in storage.db_deleted_users():
+            while True:
+                count = storage.db_purge_user(id, self.batch_size)
+                if count == 0:
+                    break
+                total += count
+                time.sleep(self.pause)
+        return total
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.idle)
+            self._wake.clear()
+            try:
+                self.purge()
+            except Exception:
+                logger.exception("user purge failed")
+
+
+purger = Purger()
@@ -0,0 +1,110 @@
+from urllib.parse import urlsplit
+from sqlalchemy import event
+from starlette.routing import Match
+from starlette.testclient import TestClient
+import context
+
+################################################################################
+# query budgets
+################################################################################
+
+def query_budget(queries: int, checkouts: int = None, repeats: bool = False):
+    """Декоратор маршрута - объявить бюджет обращений к БД на один запрос.
+
+    Бюджет проверяется в тестах (BudgetTestClient): если запрос к маршруту
+    выполнил больше SQL-запросов или взял из пула больше соединений, тест
+    падает со списком выполненных запросов. Повтор одного и того же SELECT
+    (или EXECUTE подготовленного запроса на чтение) внутри запроса (признак N+1)
+    по умолчанию тоже считается ошибкой.
+
+    Args:
+        queries (int): Максимум SQL-запросов (round-trip'ов).
+        checkouts (int, optional): Максимум выдач соединения из пула,
+            по умолчанию равен queries.
+        repeats (bool, optional): Разрешить повторы одинаковых SELECT.
+    """
+    def decorator(func):
+        func.query_budget = {"queries": queries,
+            "checkouts": queries if checkouts is None else checkouts, "repeats": repeats}
+        return func
+    return decorator
+
+
+class QueryCounter:
+    """Счётчик SQL-запросов и выдач соединений, выполненных внутри HTTP-запросов.
+
+    Учитываются только обращения с привязанным маршрутом (context.request_route),
+    поэтому фоновые задачи приложения в подсчёт не попадают.
+    """
+    def __init__(self, engine) -> None:
+        self.engine = engine
+        self.statements = []
+        self.checkouts = 0
+
+    def __enter__(self) -> "QueryCounter":
+        event.listen(self.engine, "before_cursor_execute", self._statement)
+        event.listen(self.engine.pool, "checkout", self._checkout)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        event.remove(self.engine, "before_cursor_execute", self._statement)
+        event.remove(self.engine.pool, "checkout", self._checkout)
+
+    def _statement(self, conn, cursor, statement, parameters, ctx, executemany) -> None:
+        if context.request_route.get() is not None:
+            self.statements.append(statement)
+
+    def _checkout(self, dbapi_connection, connection_record, connection_proxy) -> None:
+        if context.request_route.get() is not None:
+            self.checkouts += 1
+
+
+def route_budget(app, method: str, path: str) -> tuple:
+    """Найти маршрут запроса и объявленный для него бюджет.
+
+    Returns:
+        tuple: (шаблон маршрута, бюджет либо None).
+    """
+    scope = {"type": "http", "method": method.upper(), "path": path}
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path, getattr(route.endpoint, "query_budget", None)
+    return path, None
+
+
+def check_budget(app, method: str, path: str, counter: QueryCounter) -> None:
+    """Проверить, что запрос уложился в бюджет маршрута.
+
+    Raises:
+        AssertionError: Бюджет превышен.
+    """
+    route, budget = route_budget(app, method, path)
+    if budget is None:
+        return
+    statements = "\n".join(f"  {n}. {statement}" for n, statement in enumerate(counter.statements, 1))
+    if len(counter.statements) > budget["queries"] or counter.checkouts > budget["checkouts"]:
+        raise AssertionError(
+            f"{method.upper()} {route} exceeded its query budget: "
+            f"{len(counter.statements)} queries (budget {budget['queries']}), "
+            f"{counter.checkouts} checkouts (budget {budget['checkouts']}):\n" + statements)
+    if not budget["repeats"]:
+        selects = [statement for statement in counter.statements
+            if statement.lstrip().upper().startswith(("SELECT", "EXECUTE"))]
+        if len(selects) != len(set(selects)):
+            raise AssertionError(
+                f"{method.upper()} {route} repeated the same SELECT (N+1 suspected):\n" + statements)
+
+
+class BudgetTestClient(TestClient):
+    """Тестовый клиент, проверяющий бюджет обращений к БД на каждом запросе.
+    """
+    def __init__(self, app, engine, **kwargs) -> None:
+        super().__init__(app, **kwargs)
+        self.engine = engine
+
+    def request(self, method: str, url: str, *args, **kwargs):
+        with QueryCounter(self.engine) as counter:
+            response = super().request(method, url, *args, **kwargs)
+        check_budget(self.app, method, urlsplit(url).path, counter)
+        return response
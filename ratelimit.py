@@ -0,0 +1,118 @@
+import json
+import math
+import time
+from collections import OrderedDict
+import auth
+import context
+from constants import RateLimitError, TokenError
+
+################################################################################
+# rate limiting
+################################################################################
+
+def rate_limit(rate: float, burst: int, by: str = "user"):
+    """Декоратор маршрута - объявить ограничение частоты запросов.
+
+    Ограничение применяет RateLimitMiddleware до вызова обработчика,
+    поэтому отклонённый запрос не обращается к БД.
+
+    Args:
+        rate (float): Запросов в секунду в среднем (скорость пополнения корзины).
+        burst (int): Размер корзины - сколько запросов можно сделать подряд.
+        by (str, optional): Ключ ограничения: "user" - пользователь из токена
+            (без валидного токена - IP), "ip" - адрес клиента.
+    """
+    def decorator(func):
+        func.rate_limit = {"rate": rate, "burst": burst, "by": by}
+        return func
+    return decorator
+
+
+class RateLimiter:
+    """Набор корзин токенов (token bucket), по одной на маршрут и ключ.
+
+    Корзина хранит только остаток токенов и время последнего обновления.
+    Корзины упорядочены по времени обновления; корзина, которая за время
+    простоя снова наполнилась до burst, неотличима от новой и удаляется -
+    память занимают только активные ключи.
+    """
+    def __init__(self, clock = time.monotonic) -> None:
+        self.clock = clock
+        self.buckets = OrderedDict()
+
+    def acquire(self, key: tuple, rate: float, burst: int) -> float:
+        """Взять токен из корзины.
+
+        Args:
+            key (tuple): Ключ корзины.
+            rate (float): Скорость пополнения, токенов в секунду.
+            burst (int): Ёмкость корзины.
+
+        Returns:
+            float: 0, если запрос разрешён, иначе через сколько секунд повторить.
+        """
+        now = self.clock()
+        self._evict(now)
+        tokens, updated, _, _ = self.buckets.pop(key, (burst, now, rate, burst))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now, rate, burst)
+            return 0.0
+        self.buckets[key] = (tokens, now, rate, burst)
+        return (1 - tokens) / rate
+
+    def _evict(self, now: float) -> None:
+        while self.buckets:
+            key, (tokens, updated, rate, burst) = next(iter(self.buckets.items()))
+            if tokens + (now - updated) * rate < burst:
+                break
+            del self.buckets[key]
+
+
+class RateLimitMiddleware:
+    """ASGI middleware - ограничивает частоту запросов к маршрутам с @rate_limit.
+
+    Должен стоять внутри RouteContextMiddleware. Сверх лимита отвечает
+    429 с заголовком Retry-After.
+    """
+    def __init__(self, app, limiter: RateLimiter = None) -> None:
+        self.app = app
+        self.limiter = limiter or RateLimiter()
+        self.limits = None
+
+    def _limit(self, scope) -> dict:
+        if self.limits is None:
+            self.limits = context.endpoint_attributes(scope["app"], "rate_limit")
+        return self.limits.get((scope["method"], context.request_route.get()))
+
+    @staticmethod
+    def _key(scope, by: str):
+        if by == "user":
+            token = next((value.decode("latin-1") for key, value in scope["headers"] if key == b"token"), None)
+            if token is not None:
+                try:
+                    return auth.jwt_decode(token, ["user_id"])["user_id"]
+                except TokenError:
+                    pass
+        client = scope.get("client")
+        return client[0] if client else None
+
+    async def __call__(self, scope, receive, send) -> None:
+        limit = self._limit(scope) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        key = (scope["method"], context.request_route.get(), self._key(scope, limit["by"]))
+        retry_after = self.limiter.acquire(key, limit["rate"], limit["burst"])
+        if not retry_after:
+            await self.app(scope, receive, send)
+            return
+
+        exc = RateLimitError(math.ceil(retry_after))
+        body = json.dumps({"status_code": exc.code, "status_message": str(exc)}).encode()
+        await send({"type": "http.response.start", "status": 429, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(exc.value).encode())]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,69 @@
+import sys
+import json
+import time
+import logging
+import threading
+import storage
+
+################################################################################
+# item counts reconciliation
+################################################################################
+
+logger = logging.getLogger("reconcile")
+
+
+class CountReconciler:
+    """Фоновая сверка счётчиков объектов (item_counts) с таблицей объектов.
+
+    Счётчики обновляются в транзакциях изменения объектов, сверка только
+    исправляет расхождения (изменения данных в обход db_*, новая таблица
+    счётчиков в существующей БД). Пользователи пересчитываются частями по
+    batch_size, каждая часть - короткая транзакция.
+    """
+    def __init__(self) -> None:
+        self.batch_size = 100
+        self.pause = 0.05
+        self._thread = None
+
+    def start(self, interval: float, batch_size: int = 100, pause: float = 0.05) -> None:
+        """Запустить фоновый поток: сверка сразу и затем раз в interval секунд.
+        """
+        self.batch_size = batch_size
+        self.pause = pause
+        if self._thread is None:
+            self._thread = threading.Thread(target = self._run, args = (interval,),
+                name = "item-counts-reconcile", daemon = True)
+            self._thread.start()
+
+    def reconcile(self) -> int:
+        """Сверить счётчики всех пользователей.
+
+        Returns:
+            int: Число исправленных счётчиков.
+        """
+        after_id, repaired = 0, 0
+        while True:
+            after_id, count = storage.db_reconcile_item_counts(after_id, self.batch_size)
+            if after_id is None:
+                return repaired
+            repaired += count
+            time.sleep(self.pause)
+
+    def _run(self, interval: float) -> None:
+        while True:
+            try:
+                repaired = self.reconcile()
+                if repaired:
+                    logger.warning("item counts: %d counters repaired", repaired)
+            except Exception:
+                logger.exception("item counts reconciliation failed")
+            time.sleep(interval)
+
+
+reconciler = CountReconciler()
+
+
+if __name__ == "__main__":
+    # разовая сверка: python reconcile.py
+    print(json.dumps({"repaired": CountReconciler().reconcile()}))
+    sys.exit(0)
@@ -0,0 +1,224 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import auth
+from bench_http import HTTPConnection
+from constants import API_URL
+from stats import percentile
+
+################################################################################
+# traffic replay
+################################################################################
+
+class Replayer:
+    """Воспроизведение журнала трафика (capture.py) с ускорением по времени.
+
+    Запросы отправляются в моменты t / speed от начала прогона, не дожидаясь
+    предыдущих ответов, поэтому интервалы между запросами и их параллельность
+    сохраняются. Идентификаторы и токены подменяются по ответам цели:
+    созданные пользователи и объекты сопоставляются по полю created, токены
+    берутся из ответов /login (либо выписываются заново), ссылки /get/{params} -
+    из ответов /send с тем же link. Операции /batch подменяются так же, как
+    отдельные запросы, и сопоставляются по ответам своих операций.
+    """
+    def __init__(self, url: str, speed: float, timeout: float = 30.0) -> None:
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.speed = speed
+        self.timeout = timeout
+        self.users = {}
+        self.items = {}
+        self.links = {}
+        self.tokens = {}
+        self.connections = []
+        self.latencies = {}
+        self.errors = {}
+        self.lag = []
+
+    @staticmethod
+    def _future(futures: dict, key) -> asyncio.Future:
+        if key not in futures:
+            futures[key] = asyncio.get_running_loop().create_future()
+        return futures[key]
+
+    async def _mapped(self, futures: dict, id: int) -> int:
+        """Идентификатор на цели. Если объект создан в журнале, дождаться ответа
+        на его создание: при воспроизведении ответ может прийти позже, чем
+        следующий запрос, который на него ссылается.
+        """
+        # параметры пути записаны строками, созданные идентификаторы - числами
+        if isinstance(id, str) and id.isdigit():
+            id = int(id)
+        if id not in futures:
+            return id
+        return await asyncio.wait_for(asyncio.shield(futures[id]), self.timeout)
+
+    async def _token(self, user: int) -> str:
+        if user is None:
+            return None
+        if user in self.tokens:
+            return self.tokens[user]
+        return auth.jwt_encode({"user_id": await self._mapped(self.users, user)})
+
+    async def _path(self, record: dict) -> str:
+        route, params = record["route"], record.get("params") or {}
+        if route == "/get/{params}":
+            params = {"params": await asyncio.wait_for(
+                asyncio.shield(self._future(self.links, record["link"])), self.timeout)}
+        elif route in ("/users/{id}", "/users/{id}/deletion"):
+            params = {"id": await self._mapped(self.users, params["id"])}
+        elif route == "/items/{id}":
+            params = {"id": await self._mapped(self.items, params["id"])}
+        path = route
+        for key, value in params.items():
+            path = path.replace("{" + key + "}", str(value))
+        if record.get("query"):
+            query = [(key, str(await self._mapped(self.users, value)) if key == "owner_id" else value)
+                for key, value in parse_qsl(record["query"], keep_blank_values = True)]
+            path += "?" + urlencode(query)
+        return path
+
+    async def _body(self, record: dict) -> dict:
+        body = record.get("body")
+        if not isinstance(body, dict):
+            return body
+        body = dict(body)
+        if record["route"] == "/batch" and isinstance(body.get("operations"), list):
+            body["operations"] = [{"method": operation["method"], "path": await self._path(operation),
+                "body": await self._body(operation)} if isinstance(operation, dict) and "route" in operation
+                else operation for operation in body["operations"]]
+        if "owner_id" in body:
+            body["owner_id"] = await self._mapped(self.users, body["owner_id"])
+        if record["route"] == "/send" and "id" in body:
+            body["id"] = await self._mapped(self.items, body["id"])
+        if record["route"] == "/send" and isinstance(body.get("ids"), list):
+            body["ids"] = [await self._mapped(self.items, id) for id in body["ids"]]
+        return body
+
+    def _learn(self, record: dict, data: dict) -> None:
+        """Запомнить соответствия по ответу цели.
+        """
+        route = record["route"]
+        ok = isinstance(data, dict) and data.get("status_code") == "0"
+        if route == "/batch":
+            body = record.get("body")
+            operations = body.get("operations") if isinstance(body, dict) else None
+            results = data.get("data") if isinstance(data, dict) and isinstance(data.get("data"), list) else []
+            for n, operation in enumerate(operations or []):
+                if isinstance(operation, dict) and "route" in operation:
+                    self._learn(operation, results[n] if n < len(results) else None)
+        elif "created" in record:
+            futures = self.users if route.startswith("/registration") else self.items
+            future = self._future(futures, record["created"])
+            if not future.done():
+                # неудачное создание: ссылки на объект уйдут с исходным идентификатором
+                future.set_result(data["data"]["id"] if ok else record["created"])
+        elif route == "/login" and ok and record.get("token_user") is not None:
+            self.tokens[record["token_user"]] = data["token"]
+        elif route == "/send" and "link" in record:
+            future = self._future(self.links, record["link"])
+            if not future.done():
+                future.set_result(urlsplit(data["url"]).path.rsplit("/", 1)[-1] if ok else "-")
+
+    async def _send(self, record: dict, start: float) -> None:
+        delay = start + record["t"] / self.speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.lag.append(max(-delay, 0.0))
+        route = record["route"]
+        status, data = None, None
+        try:
+            path = await self._path(record)
+            token = await self._token(record.get("user"))
+            body = await self._body(record)
+        except asyncio.TimeoutError:
+            path = None
+        if path is not None:
+            connection = self.connections.pop() if self.connections else HTTPConnection(self.host, self.port)
+            started = time.perf_counter()
+            try:
+                status, data = await connection.request(record["method"], path, body,
+                    {"token": token} if token else None)
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                await connection.close()
+            self.connections.append(connection)
+            self.latencies.setdefault(route, []).append(time.perf_counter() - started)
+        if status != record.get("status"):
+            self.errors[route] = self.errors.get(route, 0) + 1
+        self._learn(record, data)
+
+    @staticmethod
+    def _records(records: list):
+        """Записи вместе с записями операций /batch.
+        """
+        for record in records:
+            yield record
+            body = record.get("body")
+            if record["route"] == "/batch" and isinstance(body, dict):
+                for operation in body.get("operations") or []:
+                    if isinstance(operation, dict) and "route" in operation:
+                        yield operation
+
+    async def run(self, records: list) -> dict:
+        """Воспроизвести записи.
+
+        Returns:
+            dict: Итоги - длительность, запросы и перцентили по маршрутам, отставание.
+        """
+        records = sorted(records, key = lambda record: record["t"])
+        for record in self._records(records):
+            if "created" in record:
+                self._future(self.users if record["route"].startswith("/registration") else self.items,
+                    record["created"])
+        start = time.monotonic()
+        await asyncio.gather(*[self._send(record, start) for record in records])
+        elapsed = time.monotonic() - start
+        for connection in self.connections:
+            await connection.close()
+
+        routes = {}
+        for route, values in sorted(self.latencies.items()):
+            values.sort()
+            routes[route] = {
+                "requests": len(values),
+                "mismatched_status": self.errors.pop(route, 0),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3)
+            }
+        for route, errors in self.errors.items():
+            routes[route] = {"requests": 0, "mismatched_status": errors}
+        self.lag.sort()
+        return {
+            "speed": self.speed,
+            "elapsed": round(elapsed, 3),
+            "requests": len(records),
+            "throughput": round(len(records) / elapsed, 2) if elapsed else None,
+            "schedule_lag_p99_ms": round(percentile(self.lag, 99) * 1000, 3),
+            "routes": routes
+        }
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description = "Replay a traffic log recorded with CAPTURE_FILE.")
+    parser.add_argument("log", help = "traffic log file")
+    parser.add_argument("--url", default = API_URL, help = "target API address, default API_URL")
+    parser.add_argument("--speed", type = float, default = 1.0, help = "time scale: 1, 5, 10...")
+    parser.add_argument("--save", help = "save the summary as JSON")
+    args = parser.parse_args(argv)
+
+    with open(args.log) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    result = asyncio.run(Replayer(args.url, args.speed).run(records))
+    print(json.dumps(result, indent = 2))
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(result, file, indent = 2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,30 @@
-from fastapi import APIRouter, Header, Body
-import database
+import json
+import asyncio
+import hashlib
+from contextlib import nullcontext
+from typing import List
+from urllib.parse import urlsplit
+from fastapi import APIRouter, Header, Body, Query
+from fastapi.dependencies.utils import request_params_to_args, request_body_to_args
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import QueryParams
+from starlette.routing import Match
+import storage
 import auth
+import tracing
+from admission import admission_group
+from feed import feed
+from health import health
+from profiler import sampler
+from memprof import allocations
+from loopmon import monitor
+from purge import purger
+from querycount import query_budget
+from ratelimit import rate_limit
+from singleflight import SingleFlight
+from breaker import StaleCache
 from schemas import *
 from constants import *
 
@@ -10,12 +34,242 @@ from constants import *
 
 router = APIRouter()
 
+# общее выполнение одинаковых одновременных запросов списков
+flights = SingleFlight(SINGLE_FLIGHT_WINDOW_MS / 1000)
+# последние успешные ответы маршрутов чтения - на время недоступности БД
+stale = StaleCache(STALE_CACHE_SIZE)
+
+
+def _fresh(key, value):
+    """Запомнить успешный ответ маршрута чтения (кроме чтения внутри /batch -
+    оно видит незафиксированные изменения).
+    """
+    if not storage.db_in_transaction():
+        stale.put(key, value)
+    return value
+
+
+def _stale(key, exc: UnavailableError):
+    """Ответ маршрута чтения при недоступной БД: последний успешный ответ
+    с пометкой stale либо ошибка, если его нет.
+    """
+    result = None if storage.db_in_transaction() else stale.response(key)
+    return result or {"status_code": exc.code, "status_message": str(exc)}
+
 
 @router.get("/")
+@query_budget(0)
 async def hello():
     return {"data": "None"}
 
 
+@router.get("/health/live")
+@query_budget(0)
+async def health_live() -> dict:
+    """Маршрут - проверка живости: процесс обрабатывает запросы. GET-запрос (/health/live).
+
+    Не обращается к БД: недоступная БД - повод вывести процесс из балансировки, а не перезапускать.
+    """
+    return {"status_code": "0", "status_message" : "Success", "data": {"state": health.state}}
+
+
+@router.get("/health/ready")
+@query_budget(1)
+async def health_ready():
+    """Маршрут - проверка готовности принимать трафик. GET-запрос (/health/ready).
+
+    Returns:
+        dict: {"status_code": число, "status_message" : текст[, "data": {"state": состояние, "pool": счётчики пула}]};
+            не готов - HTTP 503.
+    """
+    try:
+        result = {"status_code": "0", "status_message" : "Success",
+            "data": await run_in_threadpool(health.check)}
+    except NotReadyError as exc:
+        result = JSONResponse({"status_code": exc.code, "status_message": str(exc)}, status_code = 503)
+    return result
+
+
+@router.get("/admin/profile")
+@query_budget(0)
+@rate_limit(1, 2, by = "ip")
+async def admin_profile(seconds: float = Query(5, gt = 0, le = PROFILE_MAX_S),
+        interval_ms: float = Query(10, ge = 1, le = 1000), by_route: bool = Query(True),
+        idle: bool = Query(False), format: str = Query("json", regex = "^(json|collapsed)$"),
+        admin_token: str = Header(None)):
+    """Маршрут - снять профиль процессора по всем потокам процесса. GET-запрос (/admin/profile).
+
+    Args:
+        seconds (float): Длительность снятия.
+        interval_ms (float): Интервал между выборками, мс.
+        by_route (bool): Корень каждого стека - маршрут запроса.
+        idle (bool): Учитывать потоки, ожидающие ввода-вывода и блокировок.
+        format (str): "json" либо "collapsed" - текст для flamegraph.pl / speedscope.
+        admin_token (str): Служебный токен (ADMIN_TOKEN).
+
+    Returns:
+        dict: {"status_code": число, "status_message" : текст[, "data": {"samples": выборок,
+            "duration": секунд, "routes": {маршрут: выборок}, "stacks": collapsed stacks}]}.
+    """
+    try:
+        auth.admin_validate(admin_token)
+        endpoints = {route.endpoint.__code__: route.path for route in router.routes} if by_route else None
+        profile = await run_in_threadpool(sampler.profile, seconds, interval_ms / 1000, endpoints, idle)
+        stacks = sampler.collapsed(profile["stacks"])
+        if format == "collapsed":
+            return Response(stacks, media_type = "text/plain")
+        result = {"status_code": "0", "status_message" : "Success", "data": dict(profile, stacks = stacks)}
+    except AdminError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except Exception as exc:
+        result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
+    return result
+
+
+@router.get("/admin/memory")
+@query_budget(0)
+@rate_limit(1, 5, by = "ip")
+async def admin_memory(top: int = Query(20, ge = 1, le = 1000),
+        group: str = Query("lineno", regex = "^(lineno|traceback|filename)$"),
+        diff: bool = Query(True), reset: bool = Query(False), admin_token: str = Header(None)) -> dict:
+    """Маршрут - память процесса по маршрутам и местам выделения. GET-запрос (/admin/memory).
+
+    Args:
+        top (int): Сколько мест выделения вернуть.
+        group (str): Группировка мест: "lineno", "traceback" либо "filename".
+        diff (bool): Сравнить с исходным снимком - включения учёта либо прошлого reset.
+        reset (bool): Сделать текущий снимок исходным.
+        admin_token (str): Служебный токен (ADMIN_TOKEN).
+
+    Returns:
+        dict: {"status_code": число, "status_message" : текст[, "data": {"tracing": включён ли учёт,
+            "current": занято байт, "peak": пик, "routes": {маршрут: итоги}, "top": [места выделения]}]}.
+    """
+    try:
+        auth.admin_validate(admin_token)
+        result = {"status_code": "0", "status_message" : "Success",
+            "data": await run_in_threadpool(allocations.report, top, group, diff, reset)}
+    except AdminError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except Exception as exc:
+        result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
+    return result
+
+
+@router.post("/admin/memory")
+@query_budget(0)
+@rate_limit(1, 5, by = "ip")
+async def admin_memory_switch(enabled: bool = Body(...),
+        frames: int = Body(ALLOC_TRACE_FRAMES, ge = 1, le = 100), admin_token: str = Header(None)) -> dict:
+    """Маршрут - включить либо выключить учёт памяти. POST-запрос (/admin/memory).
+
+    Трассировка замедляет выделение памяти в несколько раз - включать на время замера.
+
+    Args:
+        enabled (bool): Включить либо выключить.
+        frames (int): Глубина сохраняемого стека выделения.
+        admin_token (str): Служебный токен (ADMIN_TOKEN).
+
+    Returns:
+        dict: {"status_code": число, "status_message" : текст, "data": {"tracing": включён ли учёт}}.
+    """
+    try:
+        auth.admin_validate(admin_token)
+        if enabled:
+            await run_in_threadpool(allocations.start, frames)
+        else:
+            allocations.stop()
+        result = {"status_code": "0", "status_message" : "Success", "data": {"tracing": allocations.tracing}}
+    except AdminError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except Exception as exc:
+        result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
+    return result
+
+
+@router.get("/admin/loop")
+@query_budget(0)
+@rate_limit(5, 10, by = "ip")
+async def admin_loop(format: str = Query("json", regex = "^(json|prometheus)$"), admin_token: str = Header(None)):
+    """Маршрут - задержка цикла событий и последние его остановки. GET-запрос (/admin/loop).
+
+    Args:
+        format (str): "json" либо "prometheus" - метрики в текстовом формате Prometheus.
+        admin_token (str): Служебный токен (ADMIN_TOKEN).
+
+    Returns:
+        dict: {"status_code": число, "status_message" : текст[, "data": {"lag_ms": задержка,
+            "stalls": число остановок, "recent": [{"route", "duration_ms", "stack"}, ...]}]}.
+    """
+    try:
+        auth.admin_validate(admin_token)
+        if format == "prometheus":
+            return Response(monitor.prometheus(), media_type = "text/plain; version=0.0.4")
+        result = {"status_code": "0", "status_message" : "Success", "data": monitor.stats()}
+    except AdminError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except Exception as exc:
+        result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
+    return result
+
+
+def warm_up() -> None:
+    """Заполнить сохранённые ответы списков (прогрев при запуске процесса).
+    """
+    stale.put("/users", _user_list())
+    stale.put("/items", _item_list())
+
+
+def _idempotent(key: str, route: str, request: dict, create, *args) -> dict:
+    """Выполнить создание не более одного раза на ключ идемпотентности.
+
+    Ключ сначала резервируется за запросом, и только затем выполняется create;
+    одновременный запрос с тем же ключом получает HTTP 409 и не создаёт объект
+    второй раз. Ответ сохраняется на IDEMPOTENCY_TTL; повтор с тем же ключом
+    получает его без вызова create. Непредвиденные ошибки ("-1") и
+    недоступность БД ("11") снимают резерв, такой запрос можно повторить.
+
+    Args:
+        key (str): Значение заголовка Idempotency-Key (None - без идемпотентности).
+        route (str): Маршрут.
+        request (dict): Параметры запроса - повтор должен совпадать с первым запросом.
+        create: Функция создания, возвращает ответ маршрута.
+
+    Returns:
+        dict: {"status_code": число, "status_message" : текст[, "data": словарь]}.
+    """
+    if key is None:
+        return create(*args)
+    try:
+        fingerprint = hashlib.sha256(json.dumps(request, sort_keys = True).encode()).hexdigest()
+        stored = storage.db_reserve_response(key, route, fingerprint)
+        if stored is None:
+            try:
+                result = create(*args)
+            except BaseException:
+                storage.db_release_response(key, route)
+                raise
+            if result["status_code"] in ("-1", "11"):
+                storage.db_release_response(key, route)
+            else:
+                storage.db_store_response(key, route, json.dumps(result))
+            return result
+        if stored.request != fingerprint:
+            raise IdempotencyKeyError(key)
+        if stored.response is None:
+            raise IdempotencyPendingError(key)
+        result = json.loads(stored.response)
+    except IdempotencyKeyError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except IdempotencyPendingError as exc:
+        result = JSONResponse({"status_code": exc.code, "status_message": str(exc)}, status_code = 409)
+    except UnavailableError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except Exception as exc:
+        result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
+    return result
+
+
 def _user_create(login: str, password: str) -> dict:
     """Создать нового пользователя.
 
@@ -29,45 +283,62 @@ def _user_create(login: str, password: str) -> dict:
         dict: {"status_code": число, "status_message" : текст[, "data": словарь]}.
     """
     try:
-        user = database.db_create_user(login, password)
-        result = {"status_code": "0", "status_message" : "Success", "data": user.to_dict()}
+        user = storage.db_create_user(login, password)
+        with tracing.span("serialize"):
+            result = {"status_code": "0", "status_message" : "Success", "data": user.to_dict()}
     except DuplicateValueError as exc:
         result = {"status_code": exc.code, "status_message" : str(exc)}
+    except UnavailableError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
     except Exception as exc:
         result = {"status_code": "-1", "status_message" : f"Something went wrong: {exc}"}
     return result
 
 
 @router.post("/registration")
-async def user_create(login: str = Body(...), password: str = Body(...)) -> dict:
+@query_budget(5, checkouts = 4)
+@rate_limit(2, 10, by = "ip")
+@admission_group("auth")
+async def user_create(login: str = Body(...), password: str = Body(...),
+        idempotency_key: str = Header(None)) -> dict:
     """Маршрут - зарегистрировать нового пользователя. POST-запрос (/registration).
 
     Args:
         login (str): Логин.
         password (str): Пароль.
+        idempotency_key (str): Ключ идемпотентности (заголовок Idempotency-Key).
 
     Returns:
         dict: {"status_code": число, "status_message" : текст[, "data": словарь]}.
     """
-    return _user_create(login, password)
+    return _idempotent(idempotency_key, "/registration", {"login": login, "password": password},
+        _user_create, login, password)
 
 
 @router.post("/registration_p")
-async def user_create_p(user: SchemaUser) -> dict:
+@query_budget(5, checkouts = 4)
+@rate_limit(2, 10, by = "ip")
+@admission_group("auth")
+async def user_create_p(user: SchemaUser, idempotency_key: str = Header(None)) -> dict:
     """Маршрут - зарегистрировать нового пользователя. POST-запрос (/registration_p).
     
     Вариант с pydantic схемой.
 
     Args:
         user (SchemaUser): pydantic схема с логином и паролем внутри.
+        idempotency_key (str): Ключ идемпотентности (заголовок Idempotency-Key).
 
     Returns:
         dict: {"status_code": число, "status_message" : текст[, "data": словарь]}.
     """
-    return _user_create(user.login, user.password)
+    return _idempotent(idempotency_key, "/registration_p", user.dict(),
+        _user_create, user.login, user.password)
 
 
 @router.post("/login")
+@query_budget(1)
+@rate_limit(5, 20, by = "ip")
+@admission_group("auth")
 async def user_login(login: str = Body(...), password: str = Body(...)) -> dict:
     """Маршрут - авторизовать пользователя. POST-запрос (/login).
 
@@ -79,7 +350,7 @@ async def user_login(login: str = Body(...), password: str = Body(...)) -> dict:
         dict: {"status_code": число, "status_message" : текст[, "token": значение]}.
     """
     try:
-        user = database.db_read_user(login)
+        user = storage.db_read_user(login)
         if user.password != password:
             raise AuthorizationError()
         result = {"status_code": "0", "status_message": "Success",
@@ -88,12 +359,17 @@ async def user_login(login: str = Body(...), password: str = Body(...)) -> dict:
         result = {"status_code": exc.code, "status_message": str(exc)}
     except AuthorizationError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
     except Exception as exc:
         result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
     return result
 
 
 @router.delete("/users/{id}")
+@query_budget(1)
+@rate_limit(5, 20)
+@admission_group("writes")
 async def user_delete(id: int, token: str = Header(None)) -> dict:
     """Маршрут - удалить пользователя. DELETE-запрос (/users/{id}).
 
@@ -106,18 +382,70 @@ async def user_delete(id: int, token: str = Header(None)) -> dict:
     """
     try:
         auth.jwt_validate(token)
-        database.db_delete_user(id)
+        storage.db_delete_user(id)
+        # объекты пользователя удаляются фоном частями
+        purger.wake()
         result = {"status_code": "0", "status_message" : "Success"}
     except NoValueFoundError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
     except TokenError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except Exception as exc:
+        result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
+    return result
+
+
+@router.get("/users/{id}/deletion")
+@query_budget(1)
+@rate_limit(10, 30)
+@admission_group("reads")
+async def user_deletion(id: int, token: str = Header(None)) -> dict:
+    """Маршрут - ход удаления пользователя. GET-запрос (/users/{id}/deletion).
+
+    Args:
+        id (int): Идентификатор пользователя.
+        token (str): Токен текущего пользователя.
+
+    Returns:
+        dict: {"status_code": число, "status_message" : текст,
+            "data": {"deleting": bool, "deleted_at": момент удаления, "items_left": число}}.
+            Код 2 - пользователь не существует либо удаление завершено.
+    """
+    try:
+        auth.jwt_validate(token)
+        progress = storage.db_deletion_progress(id)
+        result = {"status_code": "0", "status_message" : "Success", "data": progress}
+    except NoValueFoundError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except TokenError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
     except Exception as exc:
         result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
     return result
 
 
+def _user_list() -> bytes:
+    """Получить список пользователей в сериализованном виде.
+
+    Выполняется одно на все одинаковые одновременные запросы (SingleFlight).
+
+    Returns:
+        bytes: JSON {"status_code": "0", "status_message" : "Success", "data": список}.
+    """
+    user_list = storage.db_user_list()
+    with tracing.span("serialize"):
+        return JSONResponse({"status_code": "0", "status_message" : "Success",
+            "data": [user.to_dict() for user in user_list]}).body
+
+
 @router.get("/users")
+@query_budget(1)
+@rate_limit(10, 30)
+@admission_group("reads")
 async def user_list(token: str = Header(None)) -> dict:
     """Маршрут - получить список пользователей. GET-запрос (/users).
 
@@ -129,11 +457,14 @@ async def user_list(token: str = Header(None)) -> dict:
     """
     try:
         auth.jwt_validate(token)
-        user_list = database.db_user_list()
-        result = {"status_code": "0", "status_message" : "Success",
-            "data": [user.to_dict() for user in user_list]}
+        # список не зависит от пользователя - все валидные токены делят один ключ
+        # внутри /batch список должен видеть изменения своей транзакции
+        body = _user_list() if storage.db_in_transaction() else await flights.do("/users", _user_list)
+        result = Response(_fresh("/users", body), media_type = "application/json")
     except TokenError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = _stale("/users", exc)
     except Exception as exc:
         result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
     return result
@@ -154,48 +485,65 @@ def _item_create(name: str, owner_id: int, token: str) -> dict:
     """
     try:
         auth.jwt_validate(token)
-        item = database.db_create_item(name, owner_id)
-        result = {"status_code": "0", "status_message" : "Success", "data": item.to_dict()}
+        item = storage.db_create_item(name, owner_id)
+        with tracing.span("serialize"):
+            result = {"status_code": "0", "status_message" : "Success", "data": item.to_dict()}
     except DuplicateValueError as exc:
         result = {"status_code": exc.code, "status_message" : str(exc)}
     except TokenError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
     except Exception as exc:
         result = {"status_code": "-1", "status_message" : f"Something went wrong: {exc}"}
     return result
 
 
 @router.post("/items/new")
-async def item_create(name: str = Body(...), owner_id: int =  Body(...), token: str = Header(None)) -> dict:
+@query_budget(5, checkouts = 4)
+@rate_limit(5, 20)
+@admission_group("writes")
+async def item_create(name: str = Body(...), owner_id: int =  Body(...), token: str = Header(None),
+        idempotency_key: str = Header(None)) -> dict:
     """Маршрут - создать новый объект. POST-запрос (/items/new").
 
     Args:
         name (str): Наименование.
         owner_id (int): Идентификатор пользователя-владельца.
         token (str): Токен текущего пользователя.
+        idempotency_key (str): Ключ идемпотентности (заголовок Idempotency-Key).
 
     Returns:
         dict: {"status_code": число, "status_message" : текст[, "data": словарь]}.
     """
-    return _item_create(name, owner_id, token)
+    return _idempotent(idempotency_key, "/items/new", {"name": name, "owner_id": owner_id, "token": token},
+        _item_create, name, owner_id, token)
 
 
 @router.post("/items/new_p")
-async def item_create(item: SchemaItem, token: str = Header(None)) -> dict:
+@query_budget(5, checkouts = 4)
+@rate_limit(5, 20)
+@admission_group("writes")
+async def item_create(item: SchemaItem, token: str = Header(None), idempotency_key: str = Header(None)) -> dict:
     """Маршрут - создать новый объект. POST-запрос (/items/new_p").
 
     Вариант с pydantic схемой.
 
     Args:
         item (SchemaItem): pydantic схема с наименованием и ссылкой на пользователя внутри.
+        idempotency_key (str): Ключ идемпотентности (заголовок Idempotency-Key).
 
     Returns:
         dict: {"status_code": число, "status_message" : текст[, "data": словарь]}.
     """
-    return _item_create(item.name, item.owner_id, token)
+    return _idempotent(idempotency_key, "/items/new_p", {**item.dict(), "token": token},
+        _item_create, item.name, item.owner_id, token)
 
 
 @router.delete("/items/{id}")
+@query_budget(2)
+@rate_limit(5, 20)
+@admission_group("writes")
 async def item_delete(id: int, token: str = Header(None)) -> dict:
     """Маршрут - удалить объект. DELETE-запрос (/items/{id}).
 
@@ -208,18 +556,37 @@ async def item_delete(id: int, token: str = Header(None)) -> dict:
     """
     try:
         auth.jwt_validate(token)
-        database.db_delete_item(id)
+        storage.db_delete_item(id)
         result = {"status_code": "0", "status_message" : "Success"}
     except NoValueFoundError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
     except TokenError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
     except Exception as exc:
         result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
     return result
 
 
+def _item_list() -> bytes:
+    """Получить список объектов в сериализованном виде.
+
+    Выполняется одно на все одинаковые одновременные запросы (SingleFlight).
+
+    Returns:
+        bytes: JSON {"status_code": "0", "status_message" : "Success", "data": список}.
+    """
+    item_list = storage.db_item_list()
+    with tracing.span("serialize"):
+        return JSONResponse({"status_code": "0", "status_message" : "Success",
+            "data": [item.to_dict() for item in item_list]}).body
+
+
 @router.get("/items")
+@query_budget(1)
+@rate_limit(10, 30)
+@admission_group("reads")
 async def item_list(token: str = Header(None)) -> dict:
     """Маршрут - получить список объектов. GET-запрос (/items).
 
@@ -231,22 +598,146 @@ async def item_list(token: str = Header(None)) -> dict:
     """
     try:
         auth.jwt_validate(token)
-        item_list = database.db_item_list()
-        result = {"status_code": "0", "status_message" : "Success",
-            "data": [item.to_dict() for item in item_list]}
+        # список не зависит от пользователя - все валидные токены делят один ключ
+        # внутри /batch список должен видеть изменения своей транзакции
+        body = _item_list() if storage.db_in_transaction() else await flights.do("/items", _item_list)
+        result = Response(_fresh("/items", body), media_type = "application/json")
     except TokenError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = _stale("/items", exc)
     except Exception as exc:
         result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
     return result
 
 
+@router.get("/items/stats")
+@query_budget(1)
+@rate_limit(10, 30)
+@admission_group("reads")
+async def item_stats(owner_id: int = Query(None), token: str = Header(None)) -> dict:
+    """Маршрут - число объектов по владельцам. GET-запрос (/items/stats).
+
+    Читает счётчики, а не объекты: время ответа не зависит от числа объектов.
+
+    Args:
+        owner_id (int): Только для этого владельца.
+        token (str): Токен текущего пользователя.
+
+    Returns:
+        dict: {"status_code": число, "status_message" : текст[, "data":
+            {"items": всего объектов, "owners": {владелец: число объектов}}]}.
+    """
+    try:
+        auth.jwt_validate(token)
+        counts = storage.db_item_counts(owner_id)
+        if owner_id is not None:
+            counts.setdefault(owner_id, 0)
+        result = _fresh(("/items/stats", owner_id), {"status_code": "0", "status_message" : "Success",
+            "data": {"items": sum(counts.values()), "owners": counts}})
+    except TokenError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = _stale(("/items/stats", owner_id), exc)
+    except Exception as exc:
+        result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
+    return result
+
+
+@router.get("/items/search")
+@query_budget(1)
+@rate_limit(10, 30)
+@admission_group("reads")
+async def item_search(q: str = Query(..., min_length = 1), owner_id: int = Query(None),
+        mode: str = Query("substring", regex = "^(prefix|substring)$"),
+        limit: int = Query(20, ge = 1, le = SEARCH_MAX_LIMIT), offset: int = Query(0, ge = 0),
+        token: str = Header(None)) -> dict:
+    """Маршрут - поиск объектов по наименованию. GET-запрос (/items/search?q=...).
+
+    Args:
+        q (str): Строка поиска, без учёта регистра.
+        owner_id (int): Искать только среди объектов этого владельца.
+        mode (str): "substring" - по части наименования (ранжированно), "prefix" - по началу (по алфавиту).
+        limit (int): Размер страницы.
+        offset (int): Сколько результатов пропустить.
+        token (str): Токен текущего пользователя.
+
+    Returns:
+        dict: {"status_code": число, "status_message" : текст[, "data": список, "next_offset": число]}.
+            next_offset - смещение следующей страницы либо None.
+    """
+    try:
+        auth.jwt_validate(token)
+        item_list = storage.db_search_items(q, owner_id, mode == "substring", limit, offset)
+        result = _fresh(("/items/search", q, owner_id, mode, limit, offset), {"status_code": "0",
+            "status_message" : "Success", "data": [item.to_dict() for item in item_list],
+            "next_offset": offset + limit if len(item_list) == limit else None})
+    except TokenError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = _stale(("/items/search", q, owner_id, mode, limit, offset), exc)
+    except Exception as exc:
+        result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
+    return result
+
+
+async def _item_events(user_id: int, queue):
+    """Поток событий в формате text/event-stream; при простое - комментарий-пинг,
+    по которому сервер обнаруживает закрытое соединение.
+    """
+    try:
+        yield "retry: 1000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), FEED_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if event is None:
+                # подписка прервана - клиент переподключится и перечитает /items
+                return
+            yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        feed.unsubscribe(user_id, queue)
+
+
+@router.get("/items/events")
+@query_budget(0)
+@rate_limit(1, 5)
+async def item_events(token: str = Header(None)):
+    """Маршрут - события объектов текущего пользователя. GET-запрос (/items/events).
+
+    Ответ - поток Server-Sent Events: create, update, rebase и delete
+    объектов, которыми пользователь владел либо стал владеть; данные события -
+    {"event", "ids", "owner_id", "new_owner_id"}. Заменяет периодический опрос /items.
+
+    Args:
+        token (str): Токен текущего пользователя.
+
+    Returns:
+        StreamingResponse | dict: Поток событий либо {"status_code": число, "status_message" : текст}.
+    """
+    try:
+        user_id = auth.jwt_decode(token, ["user_id"])["user_id"]
+    except TokenError as exc:
+        return {"status_code": exc.code, "status_message": str(exc)}
+    return StreamingResponse(_item_events(user_id, feed.subscribe(user_id)),
+        media_type = "text/event-stream", headers = {"cache-control": "no-cache"})
+
+
 @router.post("/send")
-async def item_send(id: int = Body(...), new_owner_login: str = Body(...), token: str = Header(None)) -> dict:
-    """Маршрут - послать свой объект другому пользователю. POST-запрос (/send).
+@query_budget(1)
+@rate_limit(5, 20)
+@admission_group("writes")
+async def item_send(id: int = Body(None), ids: List[int] = Body(None), new_owner_login: str = Body(...),
+        token: str = Header(None)) -> dict:
+    """Маршрут - послать свои объекты другому пользователю. POST-запрос (/send).
+
+    Одна ссылка передаёт один объект (id) либо сразу несколько (ids).
 
     Args:
         id (int): Идентификатор - этот объект будет послан.
+        ids (List[int]): Идентификаторы - эти объекты будут посланы (вместо id).
         new_owner_login (str): Логин - этот пользователь станет новым владельцем.
         token (str): Токен текущего пользователя.
 
@@ -255,18 +746,36 @@ async def item_send(id: int = Body(...), new_owner_login: str = Body(...), token
     """
     try:
         token = auth.jwt_decode(token, ["user_id"])
-        item = database.db_read_item_by_id(id)
-        if token["user_id"] != item.owner_id:
-            raise OwnerError(id)
-        new_owner = database.db_read_user(new_owner_login)
+        item_ids = list(dict.fromkeys([id] if ids is None else ids))
+        if None in item_ids or not item_ids:
+            raise NoValueFoundError("id")
+        if len(item_ids) > SEND_MAX_ITEMS:
+            raise LimitError(f"more than {SEND_MAX_ITEMS} items")
+        owners, new_owner_id = storage.db_read_transfer(item_ids, new_owner_login)
+        for item_id in item_ids:
+            if item_id not in owners:
+                raise NoValueFoundError(item_id)
+            if owners[item_id] != token["user_id"]:
+                raise OwnerError(item_id)
+        if new_owner_id is None:
+            raise NoValueFoundError(new_owner_login)
+        params = {"new_owner_id": new_owner_id, "owner_id": token["user_id"]}
+        if ids is None:
+            params["item_id"] = id
+        else:
+            params["item_ids"] = item_ids
         result = {"status_code": "0", "status_message" : "Success", "url": API_URL + \
-            "/get/" + auth.jwt_encode({"item_id": id, "new_owner_id": new_owner.id})}
+            "/get/" + auth.jwt_encode(params)}
     except OwnerError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
     except NoValueFoundError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
     except TokenError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
+    except LimitError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
     except Exception as exc:
         result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
         raise
@@ -274,6 +783,9 @@ async def item_send(id: int = Body(...), new_owner_login: str = Body(...), token
 
 
 @router.get("/get/{params}")
+@query_budget(3)
+@rate_limit(5, 20)
+@admission_group("writes")
 async def item_get(params: str, token: str = Header(None)) -> dict:
     """Маршрут - получить объект от другого пользователя. GET-запроса (/get).
 
@@ -282,21 +794,137 @@ async def item_get(params: str, token: str = Header(None)) -> dict:
         token (str): Токен текущего пользователя.
 
     Returns:
-        dict: {"status_code": число, "status_message" : текст[, "data": словарь]}.
+        dict: {"status_code": число, "status_message" : текст[, "data": словарь
+            либо список словарей, если ссылка выдана на несколько объектов]}.
     """
     try:
         token = auth.jwt_decode(token, ["user_id"])
-        params = auth.jwt_decode(params, ["item_id", "new_owner_id"])
+        params = auth.jwt_decode(params, ["new_owner_id"])
+        item_ids = params["item_ids"] if "item_ids" in params else [params["item_id"]]
         if token["user_id"] != params["new_owner_id"]:
-            raise OwnerError(params["item_id"])
-        item = database.db_rebase_item(params["item_id"], params["new_owner_id"])
-        result = {"status_code": "0", "status_message" : "Success", "data": item.to_dict()}
+            raise OwnerError(", ".join(str(item_id) for item_id in item_ids))
+        if "owner_id" in params:
+            # владелец проверяется в том же UPDATE
+            item_list = storage.db_rebase_items(item_ids, params["owner_id"], params["new_owner_id"])
+        else:
+            # ссылка, выданная до появления owner_id в параметрах
+            item_list = [storage.db_rebase_item(params["item_id"], params["new_owner_id"])]
+        with tracing.span("serialize"):
+            data = [item.to_dict() for item in item_list]
+            result = {"status_code": "0", "status_message" : "Success",
+                "data": data if "item_ids" in params else data[0]}
     except OwnerError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
+    except VersionConflictError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
     except NoValueFoundError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
     except TokenError as exc:
         result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except Exception as exc:
+        result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
+    return result
+
+
+async def _batch_call(n: int, operation: dict, token: str) -> dict:
+    """Выполнить одну операцию пакета обработчиком соответствующего маршрута.
+
+    Параметры пути, строки запроса и тело проверяются и преобразуются так же,
+    как при отдельном запросе к маршруту (по его описанию в FastAPI).
+
+    Args:
+        n (int): Номер операции в пакете.
+        operation (dict): {"method": метод, "path": путь[?запрос][, "body": словарь]}.
+        token (str): Токен пакета, передаётся обработчикам с параметром token.
+
+    Returns:
+        dict: Ответ обработчика.
+    """
+    if not isinstance(operation, dict) or not isinstance(operation.get("path"), str) \
+            or not isinstance(operation.get("method", "POST"), str):
+        raise BatchError(f"operation {n} is not an object with a path")
+    method = operation.get("method", "POST").upper()
+    path = urlsplit(operation["path"])
+    body = operation.get("body")
+    if body is not None and not isinstance(body, dict):
+        raise BatchError(f"operation {n}: body is not an object")
+    scope = {"type": "http", "method": method, "path": path.path}
+    for route in router.routes:
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL and route.endpoint not in (batch, item_events):
+            break
+    else:
+        raise NoValueFoundError(f"{method} {path.path}")
+
+    dependant = route.dependant
+    kwargs, errors = request_params_to_args(dependant.path_params, child_scope["path_params"])
+    values, query_errors = request_params_to_args(dependant.query_params, QueryParams(path.query))
+    kwargs.update(values)
+    values, header_errors = request_params_to_args(dependant.header_params, {"token": token})
+    kwargs.update(values)
+    values, body_errors = await request_body_to_args(dependant.body_params, body or {})
+    kwargs.update(values)
+    errors += query_errors + header_errors + body_errors
+    if errors:
+        details = "; ".join(".".join(str(part) for part in error["loc"]) + ": " + error["msg"]
+            for error in RequestValidationError(errors).errors())
+        raise BatchError(f"operation {n}: {details}")
+    result = await route.endpoint(**kwargs)
+    if isinstance(result, Response):
+        result = json.loads(result.body)
+    return result
+
+
+@router.post("/batch")
+@query_budget(BATCH_MAX_OPERATIONS * 7, checkouts = 1, repeats = True)
+@rate_limit(2, 10)
+@admission_group("writes")
+async def batch(operations: list = Body(...), atomic: bool = Body(True), token: str = Header(None)) -> dict:
+    """Маршрут - выполнить пакет операций в одной транзакции. POST-запрос (/batch).
+
+    Операции - запросы к другим маршрутам, выполняются по порядку их
+    обработчиками с токеном пакета; токен проверяется один раз. Каждая
+    операция выполняется в своей точке сохранения (SAVEPOINT).
+
+    Args:
+        operations (list): Операции [{"method": метод, "path": путь[, "body": словарь]}, ...].
+        atomic (bool): True - при первой неудачной операции откатить весь пакет,
+            False - откатить только неудачные операции.
+        token (str): Токен текущего пользователя.
+
+    Returns:
+        dict: {"status_code": число, "status_message" : текст[, "data": список ответов операций]}.
+    """
+    results = []
+    try:
+        if len(operations) > BATCH_MAX_OPERATIONS:
+            raise BatchError(f"more than {BATCH_MAX_OPERATIONS} operations")
+        with auth.trusted(token) if token is not None else nullcontext(), \
+                storage.db_transaction() as session:
+            for n, operation in enumerate(operations):
+                savepoint = session.begin_nested()
+                try:
+                    response = await _batch_call(n, operation, token)
+                except Error as exc:
+                    response = {"status_code": exc.code, "status_message": str(exc)}
+                except Exception as exc:
+                    response = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
+                results.append(response)
+                if response.get("status_code", "0") == "0":
+                    savepoint.commit()
+                    continue
+                savepoint.rollback()
+                if atomic:
+                    raise BatchError(f"operation {n} failed, all operations rolled back")
+        result = {"status_code": "0", "status_message" : "Success", "data": results}
+    except BatchError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc), "data": results}
+    except TokenError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
+    except UnavailableError as exc:
+        result = {"status_code": exc.code, "status_message": str(exc)}
     except Exception as exc:
         result = {"status_code": "-1", "status_message": f"Something went wrong: {exc}"}
     return result
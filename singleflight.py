@@ -0,0 +1,50 @@
+import asyncio
+import functools
+from starlette.concurrency import run_in_threadpool
+from context import routed
+
+################################################################################
+# single-flight
+################################################################################
+
+class SingleFlight:
+    """Объединение одинаковых одновременных запросов в одно выполнение.
+
+    Первый запрос с данным ключом запускает функцию в пуле потоков отдельной
+    задачей, остальные ждут её результата, не обращаясь к БД. Отмена любого
+    из ожидающих (клиент отключился), в том числе первого, не прерывает
+    выполнение для остальных. После завершения результат ещё window секунд
+    отдаётся новым запросам с тем же ключом (0 - не отдаётся). Ошибки
+    передаются всем ожидающим, но не запоминаются.
+    """
+    def __init__(self, window: float = 0.0) -> None:
+        self.window = window
+        self.flights = {}
+
+    async def do(self, key, fn, *args):
+        """Выполнить fn(*args) либо присоединиться к выполнению с тем же ключом.
+
+        Args:
+            key: Ключ - маршрут, параметры и область авторизации запроса.
+            fn: Функция, выполняется в пуле потоков.
+
+        Returns:
+            Результат fn, общий для всех запросов с этим ключом.
+        """
+        future = self.flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(run_in_threadpool(routed, fn, *args))
+            self.flights[key] = future
+            future.add_done_callback(functools.partial(self._done, key))
+        return await asyncio.shield(future)
+
+    def _done(self, key, future: asyncio.Future) -> None:
+        # exception() - ошибка считается полученной, даже если все ожидающие отменены
+        if future.cancelled() or future.exception() is not None or self.window <= 0:
+            self._forget(key, future)
+        else:
+            future.get_loop().call_later(self.window, self._forget, key, future)
+
+    def _forget(self, key, future: asyncio.Future) -> None:
+        if self.flights.get(key) is future:
+            del self.flights[key]
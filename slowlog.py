@@ -0,0 +1,160 @@
+import sys
+import time
+import queue
+import logging
+import threading
+from sqlalchemy import event
+import context
+
+################################################################################
+# slow query log
+################################################################################
+
+logger = logging.getLogger("slow_query")
+
+
+def _caller() -> str:
+    """Найти в стеке вызова функцию db_* модуля database.
+
+    Returns:
+        str: Имя функции либо None.
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name.startswith("db_") and frame.f_globals.get("__name__") == "database":
+            return code.co_name
+        frame = frame.f_back
+    return None
+
+
+def _shape(parameters) -> object:
+    """Описать параметры запроса без их значений (только типы).
+
+    Args:
+        parameters: Параметры DBAPI - словарь, кортеж либо список наборов.
+
+    Returns:
+        object: Структура с именами типов вместо значений.
+    """
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return {"rows": len(parameters), "row": _shape(parameters[0])}
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+class SlowQueryLog:
+    """Журнал медленных SQL-запросов.
+
+    Замеряет время каждого запроса через события engine. Запросы дольше порога
+    вместе с формой параметров, вызвавшей функцией db_* и маршрутом передаются
+    в фоновый поток, который пишет их в журнал и (опционально) снимает
+    EXPLAIN (ANALYZE, BUFFERS) на отдельном соединении.
+    """
+    def __init__(self, engine, threshold_ms: float, explain: bool = False,
+            explain_interval: float = 60.0) -> None:
+        """
+        Args:
+            engine: SQLAlchemy engine.
+            threshold_ms (float): Порог в миллисекундах.
+            explain (bool, optional): Снимать ли план выполнения.
+            explain_interval (float, optional): Не чаще одного EXPLAIN для одного
+                и того же текста запроса за этот интервал (секунды).
+        """
+        self.engine = engine
+        self.threshold = threshold_ms / 1000.0
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self._explained = {}
+        # при переполнении очереди записи отбрасываются,
+        # чтобы журналирование никогда не тормозило обработку запроса
+        self._records = queue.Queue(maxsize = 1000)
+        self._thread = threading.Thread(target = self._run, name = "slow-query-log", daemon = True)
+
+    def install(self) -> None:
+        """Подписаться на события engine и запустить фоновый поток.
+        """
+        event.listen(self.engine, "before_cursor_execute", self._before)
+        event.listen(self.engine, "after_cursor_execute", self._after)
+        event.listen(self.engine, "handle_error", self._error)
+        self._thread.start()
+
+    # время начала хранится в контексте выполнения запроса: он не переживает
+    # запрос, даже если тот завершился ошибкой и after_cursor_execute не вызван
+    def _before(self, conn, cursor, statement, parameters, ctx, executemany) -> None:
+        if ctx is not None:
+            ctx.slow_query_start = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, ctx, executemany) -> None:
+        self._log(ctx, statement, parameters, executemany)
+
+    def _error(self, exception_context) -> None:
+        # запрос с ошибкой (нарушение ограничения, таймаут) тоже журналируется, без EXPLAIN
+        self._log(exception_context.execution_context, exception_context.statement,
+            exception_context.parameters, True, type(exception_context.original_exception).__name__)
+
+    def _log(self, ctx, statement: str, parameters, executemany: bool, error: str = None) -> None:
+        start = getattr(ctx, "slow_query_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        if elapsed < self.threshold:
+            return
+        if ctx.execution_options.get("slow_query_log") is False:
+            return
+        record = {
+            "duration_ms": round(elapsed * 1000, 3),
+            "statement": statement,
+            "parameters": _shape(parameters),
+            "function": _caller(),
+            "route": context.request_route.get(),
+            "error": error,
+            "explain": None if executemany else parameters
+        }
+        try:
+            self._records.put_nowait(record)
+        except queue.Full:
+            pass
+
+    def _run(self) -> None:
+        while True:
+            record = self._records.get()
+            parameters = record.pop("explain")
+            plan = None
+            if self.explain and parameters is not None:
+                plan = self._explain(record["statement"], parameters)
+            logger.warning("slow query %.3f ms in %s (route %s): %s params=%s%s%s",
+                record["duration_ms"], record["function"], record["route"],
+                record["statement"], record["parameters"],
+                "" if record["error"] is None else " error=" + record["error"],
+                "" if plan is None else "\n" + plan)
+
+    def _explain(self, statement: str, parameters) -> str:
+        """Снять план выполнения запроса.
+
+        Планируются только SELECT и EXECUTE подготовленных запросов (все они -
+        чтение): EXPLAIN ANALYZE исполняет запрос, и для изменяющих запросов это
+        повторило бы их побочные эффекты.
+
+        Returns:
+            str: Текст плана либо None.
+        """
+        if not statement.lstrip().upper().startswith(("SELECT", "EXECUTE")):
+            return None
+        now = time.monotonic()
+        if now - self._explained.get(statement, -self.explain_interval) < self.explain_interval:
+            return None
+        self._explained[statement] = now
+        try:
+            with self.engine.connect() as conn:
+                conn = conn.execution_options(slow_query_log = False)
+                with conn.begin() as trans:
+                    rows = conn.exec_driver_sql(
+                        "EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters).fetchall()
+                    trans.rollback()
+        except Exception as exc:
+            return f"EXPLAIN failed: {exc}"
+        return "\n".join(row[0] for row in rows)
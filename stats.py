@@ -0,0 +1,15 @@
+################################################################################
+# statistics
+################################################################################
+
+def percentile(values: list, p: float) -> float:
+    """Перцентиль по методу ближайшего ранга.
+
+    Args:
+        values (list): Отсортированные значения.
+        p (float): Перцентиль, от 0 до 100.
+    """
+    if not values:
+        return 0.0
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
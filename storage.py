@@ -0,0 +1,28 @@
+from constants import STORAGE_BACKEND, CIRCUIT_BREAKER, BREAKER_WINDOW, BREAKER_FAILURE_RATE, \
+    BREAKER_SLOW_MS, BREAKER_OPEN_S
+
+################################################################################
+# storage backend
+################################################################################
+
+# функции db_* выбранного хранилища; у хранилищ одинаковые сигнатуры, результаты
+# и исключения (DuplicateValueError, NoValueFoundError...), список - __all__ модуля:
+# database.py - PostgreSQL через SQLAlchemy, memory.py - в памяти процесса
+if STORAGE_BACKEND == "memory":
+    from memory import *
+elif STORAGE_BACKEND == "postgres":
+    from database import *
+else:
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+breaker = None
+if STORAGE_BACKEND == "postgres" and CIRCUIT_BREAKER:
+    # обращения к БД - через автомат защиты: при сбоях БД запросы отклоняются
+    # сразу (UnavailableError), а не после таймаутов соединения и запроса;
+    # транзакции не оборачиваются - обращения внутри них учитываются сами
+    import database
+    from breaker import CircuitBreaker
+    breaker = CircuitBreaker(BREAKER_WINDOW, BREAKER_FAILURE_RATE, BREAKER_SLOW_MS / 1000, BREAKER_OPEN_S)
+    for _name in database.__all__:
+        if _name.startswith("db_") and _name not in ("db_transaction", "db_in_transaction"):
+            globals()[_name] = breaker.guard(globals()[_name])
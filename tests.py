@@ -1,7 +1,17 @@
+import os
 import unittest
-import requests
+from urllib.parse import urlsplit
+
+# свою схему БД нужно выбрать до импорта database, который создаёт таблицы при импорте
+os.environ.setdefault("POSTGRES_SCHEMA", "test_unittest")
+# фоновые очистка и сверка счётчиков не должны работать параллельно с тестами
+os.environ.setdefault("PURGE_BACKGROUND", "0")
+os.environ.setdefault("ITEM_COUNTS_RECONCILE_S", "0")
+
+import auth
 import database
-from constants import API_URL
+from main import app
+from querycount import BudgetTestClient
 
 ################################################################################
 # unit-tests
@@ -13,30 +23,40 @@ class TestAPI(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls) -> None:
-        database.db_clear_all()
-        cls.dump = {
-            "admin_id": None,
-            "user_1_id": None,
-            "user_2_id": None,
-            "user_3_id": None,
-            "admin_jwt": None,
-            "user_1_jwt": None,
-            "user_2_jwt": None,
-            "item_1_id": None,
-            "item_2_id": None,
-            "item_3_id": None,
-            "item_4_id": None
-        }
+        cls.client = BudgetTestClient(app, database.engine)
+        cls.client.__enter__()
 
     def setUp(self) -> None:
-        pass
+        database.db_clear_all()
+        self.dump = {}
 
     def tearDown(self) -> None:
-        pass
+        self.dump = None
 
     @classmethod
     def tearDownClass(cls) -> None:
-        cls.dump = None
+        cls.client.__exit__(None, None, None)
+
+    def seed_users(self) -> None:
+        """Создать пользователей admin, user_1..3 и выписать им токены.
+        """
+        for login, password in [("admin", "admin"),
+                                ("user_1", "user_1_password"),
+                                ("user_2", "user_2_password"),
+                                ("user_3", "user_3_password")]:
+            id = database.db_create_user(login, password).id
+            self.dump[login + "_id"] = id
+            self.dump[login + "_jwt"] = auth.jwt_encode({"user_id": id})
+
+    def seed_items(self) -> None:
+        """Создать пользователей и объекты item_1..4.
+        """
+        self.seed_users()
+        for name, owner in [("item_1", "admin"),
+                            ("item_2", "admin"),
+                            ("item_3", "user_1"),
+                            ("item_4", "user_2")]:
+            self.dump[name + "_id"] = database.db_create_item(name, self.dump[owner + "_id"]).id
 
 
     def test_01_user_create(self):
@@ -47,7 +67,7 @@ class TestAPI(unittest.TestCase):
                      {"login": "user_1", "password": "user_1_password"},
                      {"login": "user_2", "password": "user_2_password"},
                      {"login": "user_3", "password": "user_3_password"}]:
-            response = requests.post(API_URL + "/registration", json = user)
+            response = self.client.post("/registration", json = user)
             self.assertIsNotNone(response)
             self.assertEqual(response.status_code, 200)
 
@@ -58,12 +78,10 @@ class TestAPI(unittest.TestCase):
             self.assertIn("data", data)
             self.assertEqual(data["status_code"], "0")
 
-            self.dump[user["login"] + '_id'] = data["data"]["id"]
-
         # попытка дублирования данных
         user = {"login": "admin", "password": "admin"}
 
-        response = requests.post(API_URL + "/registration", json = user)
+        response = self.client.post("/registration", json = user)
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
 
@@ -76,7 +94,7 @@ class TestAPI(unittest.TestCase):
         # попытка передачи некорректных данных
         user = {"aaa": "aaa"}
 
-        response = requests.post(API_URL + "/registration", json = user)
+        response = self.client.post("/registration", json = user)
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 422)
 
@@ -84,12 +102,14 @@ class TestAPI(unittest.TestCase):
     def test_02_user_login(self):
         """Тест маршрута /login.
         """
+        self.seed_users()
+
         # проверка вызова маршрута, наличия ответа и формата ответа
         for user in [{"login": "admin", "password": "admin"},
                      {"login": "user_1", "password": "user_1_password"},
                      {"login": "user_2", "password": "user_2_password"},
                      {"login": "user_3", "password": "user_3_password"}]:
-            response = requests.post(API_URL + "/login", json = user)
+            response = self.client.post("/login", json = user)
             self.assertIsNotNone(response)
             self.assertEqual(response.status_code, 200)
 
@@ -100,12 +120,10 @@ class TestAPI(unittest.TestCase):
             self.assertIn("token", data)
             self.assertEqual(data["status_code"], "0")
 
-            self.dump[user["login"] + '_jwt'] = data["token"]
-
         # попытка подключения несуществующим пользователем
         user = {"login": "admin1", "password": "admin"}
 
-        response = requests.post(API_URL + "/login", json = user)
+        response = self.client.post("/login", json = user)
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
 
@@ -118,7 +136,7 @@ class TestAPI(unittest.TestCase):
         # попытка подключения с неправильным паролем
         user = {"login": "admin", "password": "admin1"}
 
-        response = requests.post(API_URL + "/login", json = user)
+        response = self.client.post("/login", json = user)
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
 
@@ -132,9 +150,11 @@ class TestAPI(unittest.TestCase):
     def test_03_user_delete(self):
         """Тест маршрута /users/{id}.
         """
+        self.seed_users()
+
         # проверка вызова маршрута, наличия ответа и формата ответа
-        response = requests.delete(
-            API_URL + f"/users/{self.dump['user_3_id']}",
+        response = self.client.delete(
+            f"/users/{self.dump['user_3_id']}",
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -146,8 +166,8 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["status_code"], "0")
 
         # попытка удалить несуществующего пользователя
-        response = requests.delete(
-            API_URL + f"/users/{self.dump['user_3_id']}",
+        response = self.client.delete(
+            f"/users/{self.dump['user_3_id']}",
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -159,8 +179,8 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["status_code"], "2")
 
         # попытка подключения с неправильным токеном
-        response = requests.delete(
-            API_URL + f"/users/{self.dump['user_2_id']}",
+        response = self.client.delete(
+            f"/users/{self.dump['user_2_id']}",
             headers = {"token": "Zzz"})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -175,9 +195,11 @@ class TestAPI(unittest.TestCase):
     def test_04_user_list(self):
         """Тест маршрута /users.
         """
+        self.seed_users()
+
         # проверка вызова маршрута, наличия ответа и формата ответа
-        response = requests.get(
-            API_URL + "/users",
+        response = self.client.get(
+            "/users",
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -189,11 +211,11 @@ class TestAPI(unittest.TestCase):
         self.assertIn("data", data)
         self.assertEqual(data["status_code"], "0")
         self.assertIsInstance(data["data"], list)
-        self.assertEqual(len(data["data"]), 3)
+        self.assertEqual(len(data["data"]), 4)
 
         # попытка подключения с неправильным токеном
-        response = requests.get(
-            API_URL + "/users",
+        response = self.client.get(
+            "/users",
             headers = {"token": "Zzz"})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -208,13 +230,15 @@ class TestAPI(unittest.TestCase):
     def test_05_item_create(self):
         """Тест маршрута /items/new.
         """
+        self.seed_users()
+
         # проверка вызова маршрута, наличия ответа и формата ответа
         for item in [{"name": "item_1", "owner_id": self.dump["admin_id"]},
                      {"name": "item_2", "owner_id": self.dump["admin_id"]},
                      {"name": "item_3", "owner_id": self.dump["user_1_id"]},
                      {"name": "item_4", "owner_id": self.dump["user_2_id"]}]:
-            response = requests.post(
-                API_URL + "/items/new",
+            response = self.client.post(
+                "/items/new",
                 json = item,
                 headers = {"token": self.dump["admin_jwt"]})
             self.assertIsNotNone(response)
@@ -227,12 +251,10 @@ class TestAPI(unittest.TestCase):
             self.assertIn("data", data)
             self.assertEqual(data["status_code"], "0")
 
-            self.dump[item["name"] + '_id'] = data["data"]["id"]
-
         # попытка дублирования данных
         item = {"name": "item_1", "owner_id": self.dump["admin_id"]}
-        response = requests.post(
-            API_URL + "/items/new",
+        response = self.client.post(
+            "/items/new",
             json = item,
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
@@ -249,8 +271,8 @@ class TestAPI(unittest.TestCase):
 
         # попытка передачи некорректных данных
         item = {"aaa": "aaa"}
-        response = requests.post(
-            API_URL + "/items/new",
+        response = self.client.post(
+            "/items/new",
             json = item,
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
@@ -258,8 +280,8 @@ class TestAPI(unittest.TestCase):
 
         # попытка подключения с неправильным токеном
         item = {"name": "item_1", "owner_id": self.dump["admin_id"]}
-        response = requests.post(
-            API_URL + "/items/new",
+        response = self.client.post(
+            "/items/new",
             json = item,
             headers = {"token": "Zzz"})
         self.assertIsNotNone(response)
@@ -275,9 +297,11 @@ class TestAPI(unittest.TestCase):
     def test_06_item_delete(self):
         """Тест маршрута /items/{id}.
         """
+        self.seed_items()
+
         # проверка вызова маршрута, наличия ответа и формата ответа
-        response = requests.delete(
-            API_URL + f"/items/{self.dump['item_4_id']}",
+        response = self.client.delete(
+            f"/items/{self.dump['item_4_id']}",
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -289,8 +313,8 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["status_code"], "0")
 
         # попытка удалить несуществующий объект
-        response = requests.delete(
-            API_URL + f"/items/{self.dump['item_4_id']}",
+        response = self.client.delete(
+            f"/items/{self.dump['item_4_id']}",
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -302,8 +326,8 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["status_code"], "2")
 
         # попытка подключения с неправильным токеном
-        response = requests.delete(
-            API_URL + f"/items/{self.dump['item_3_id']}",
+        response = self.client.delete(
+            f"/items/{self.dump['item_3_id']}",
             headers = {"token": "Zzz"})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -318,9 +342,11 @@ class TestAPI(unittest.TestCase):
     def test_07_item_list(self):
         """Тест маршрута /items.
         """
+        self.seed_items()
+
         # проверка вызова маршрута, наличия ответа и формата ответа
-        response = requests.get(
-            API_URL + "/items",
+        response = self.client.get(
+            "/items",
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -332,11 +358,11 @@ class TestAPI(unittest.TestCase):
         self.assertIn("data", data)
         self.assertEqual(data["status_code"], "0")
         self.assertIsInstance(data["data"], list)
-        self.assertEqual(len(data["data"]), 3)
+        self.assertEqual(len(data["data"]), 4)
 
         # попытка подключения с неправильным токеном
-        response = requests.get(
-            API_URL + "/items",
+        response = self.client.get(
+            "/items",
             headers = {"token": "Zzz"})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -351,9 +377,11 @@ class TestAPI(unittest.TestCase):
     def test_08_item_send(self):
         """Тест маршрута /send.
         """
+        self.seed_items()
+
         # проверка вызова маршрута, наличия ответа и формата ответа
-        response = requests.post(
-            API_URL + "/send",
+        response = self.client.post(
+            "/send",
             json = {"id": self.dump["item_2_id"], "new_owner_login": "user_2"},
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
@@ -366,11 +394,9 @@ class TestAPI(unittest.TestCase):
         self.assertIn("url", data)
         self.assertEqual(data["status_code"], "0")
 
-        self.dump["rebase_item_url"] = data["url"]
-
         # попытка послать чужой объект
-        response = requests.post(
-            API_URL + "/send",
+        response = self.client.post(
+            "/send",
             json = {"id": self.dump["item_3_id"], "new_owner_login": "user_2"},
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
@@ -383,8 +409,8 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["status_code"], "5")
 
         # попытка послать несуществующий объект
-        response = requests.post(
-            API_URL + "/send",
+        response = self.client.post(
+            "/send",
             json = {"id": 100500, "new_owner_login": "user_1"},
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
@@ -397,8 +423,8 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["status_code"], "2")
 
         # попытка послать несуществующему пользователю
-        response = requests.post(
-            API_URL + "/send",
+        response = self.client.post(
+            "/send",
             json = {"id": self.dump["item_1_id"], "new_owner_login": "Zzz"},
             headers = {"token": self.dump["admin_jwt"]})
         self.assertIsNotNone(response)
@@ -411,8 +437,8 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["status_code"], "2")
 
         # попытка подключения с неправильным токеном
-        response = requests.post(
-            API_URL + "/send",
+        response = self.client.post(
+            "/send",
             json = {"id": self.dump["item_1_id"], "new_owner_login": "user_1"},
             headers = {"token": "Zzz"})
         self.assertIsNotNone(response)
@@ -428,9 +454,18 @@ class TestAPI(unittest.TestCase):
     def test_09_item_get(self):
         """Тест маршрута /get.
         """
+        self.seed_items()
+
+        # ссылка на передачу объекта item_2 пользователю user_2
+        response = self.client.post(
+            "/send",
+            json = {"id": self.dump["item_2_id"], "new_owner_login": "user_2"},
+            headers = {"token": self.dump["admin_jwt"]})
+        url = urlsplit(response.json()["url"]).path
+
         # проверка вызова маршрута, наличия ответа и формата ответа
-        response = requests.get(
-            self.dump["rebase_item_url"],
+        response = self.client.get(
+            url,
             headers = {"token": self.dump["user_2_jwt"]})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -443,8 +478,8 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["status_code"], "0")
 
         # попытка получить чужой объект
-        response = requests.get(
-            self.dump["rebase_item_url"],
+        response = self.client.get(
+            url,
             headers = {"token": self.dump["user_1_jwt"]})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
@@ -456,8 +491,8 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["status_code"], "5")
 
         # попытка подключения с неправильным токеном
-        response = requests.get(
-            self.dump["rebase_item_url"],
+        response = self.client.get(
+            url,
             headers = {"token": "Zzz"})
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 200)
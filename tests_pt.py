@@ -1,21 +1,12 @@
 import sys
 import pytest
-import requests
-import database
-from constants import API_URL
+from urllib.parse import urlsplit
 
 ################################################################################
 # py-tests
 ################################################################################
 
-pytest.dump = {}
-
-
-def test_00_init():
-    database.db_clear_all()
-
-
-def test_01_user_create():
+def test_01_user_create(client):
     """Тест маршрута /registration.
     """
     # проверка вызова маршрута, наличия ответа и формата ответа
@@ -23,7 +14,7 @@ def test_01_user_create():
                     {"login": "user_1", "password": "user_1_password"},
                     {"login": "user_2", "password": "user_2_password"},
                     {"login": "user_3", "password": "user_3_password"}]:
-        response = requests.post(API_URL + "/registration", json = user)
+        response = client.post("/registration", json = user)
         assert response != None
         assert response.status_code == 200
 
@@ -34,12 +25,10 @@ def test_01_user_create():
         assert "data" in data
         assert data["status_code"] == "0"
 
-        pytest.dump[user["login"] + '_id'] = data["data"]["id"]
-
     # попытка дублирования данных
     user = {"login": "admin", "password": "admin"}
 
-    response = requests.post(API_URL + "/registration", json = user)
+    response = client.post("/registration", json = user)
     assert response != None
     assert response.status_code == 200
 
@@ -51,12 +40,12 @@ def test_01_user_create():
     # попытка передачи некорректных данных
     user = {"aaa": "aaa"}
 
-    response = requests.post(API_URL + "/registration", json = user)
+    response = client.post("/registration", json = user)
     assert response != None
     assert response.status_code == 422
 
 
-def test_02_user_login():
+def test_02_user_login(client, dump):
     """Тест маршрута /login.
     """
     # проверка вызова маршрута, наличия ответа и формата ответа
@@ -64,7 +53,7 @@ def test_02_user_login():
                     {"login": "user_1", "password": "user_1_password"},
                     {"login": "user_2", "password": "user_2_password"},
                     {"login": "user_3", "password": "user_3_password"}]:
-        response = requests.post(API_URL + "/login", json = user)
+        response = client.post("/login", json = user)
         assert response != None
         assert response.status_code == 200
 
@@ -75,12 +64,10 @@ def test_02_user_login():
         assert "token" in data
         assert data["status_code"] == "0"
 
-        pytest.dump[user["login"] + '_jwt'] = data["token"]
-
     # попытка подключения несуществующим пользователем
     user = {"login": "admin1", "password": "admin"}
 
-    response = requests.post(API_URL + "/login", json = user)
+    response = client.post("/login", json = user)
     assert response != None
     assert response.status_code == 200
 
@@ -93,7 +80,7 @@ def test_02_user_login():
     # попытка подключения с неправильным паролем
     user = {"login": "admin", "password": "admin1"}
 
-    response = requests.post(API_URL + "/login", json = user)
+    response = client.post("/login", json = user)
     assert response != None
     assert response.status_code == 200
 
@@ -104,13 +91,13 @@ def test_02_user_login():
     assert data["status_code"] == "3"
 
 
-def test_03_user_delete():
+def test_03_user_delete(client, dump):
     """Тест маршрута /users/{id}.
     """
     # проверка вызова маршрута, наличия ответа и формата ответа
-    response = requests.delete(
-        API_URL + f"/users/{pytest.dump['user_3_id']}",
-        headers = {"token": pytest.dump["admin_jwt"]})
+    response = client.delete(
+        f"/users/{dump['user_3_id']}",
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -121,9 +108,9 @@ def test_03_user_delete():
     assert data["status_code"] == "0"
 
     # попытка удалить несуществующего пользователя
-    response = requests.delete(
-        API_URL + f"/users/{pytest.dump['user_3_id']}",
-        headers = {"token": pytest.dump["admin_jwt"]})
+    response = client.delete(
+        f"/users/{dump['user_3_id']}",
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -134,8 +121,8 @@ def test_03_user_delete():
     assert data["status_code"] == "2"
 
     # попытка подключения с неправильным токеном
-    response = requests.delete(
-        API_URL + f"/users/{pytest.dump['user_2_id']}",
+    response = client.delete(
+        f"/users/{dump['user_2_id']}",
         headers = {"token": "Zzz"})
     assert response != None
     assert response.status_code == 200
@@ -147,13 +134,13 @@ def test_03_user_delete():
     assert data["status_code"] == "4"
 
 
-def test_04_user_list():
+def test_04_user_list(client, dump):
     """Тест маршрута /users.
     """
     # проверка вызова маршрута, наличия ответа и формата ответа
-    response = requests.get(
-        API_URL + "/users",
-        headers = {"token": pytest.dump["admin_jwt"]})
+    response = client.get(
+        "/users",
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -164,11 +151,11 @@ def test_04_user_list():
     assert "data" in data
     assert data["status_code"] == "0"
     assert isinstance(data["data"], list) == True
-    assert len(data["data"]) == 3
+    assert len(data["data"]) == 4
 
     # попытка подключения с неправильным токеном
-    response = requests.get(
-        API_URL + "/users",
+    response = client.get(
+        "/users",
         headers = {"token": "Zzz"})
     assert response != None
     assert response.status_code == 200
@@ -180,18 +167,18 @@ def test_04_user_list():
     assert data["status_code"] == "4"
 
 
-def test_05_item_create():
+def test_05_item_create(client, dump):
     """Тест маршрута /items/new.
     """
     # проверка вызова маршрута, наличия ответа и формата ответа
-    for item in [{"name": "item_1", "owner_id": pytest.dump["admin_id"]},
-                    {"name": "item_2", "owner_id": pytest.dump["admin_id"]},
-                    {"name": "item_3", "owner_id": pytest.dump["user_1_id"]},
-                    {"name": "item_4", "owner_id": pytest.dump["user_2_id"]}]:
-        response = requests.post(
-            API_URL + "/items/new",
+    for item in [{"name": "item_1", "owner_id": dump["admin_id"]},
+                    {"name": "item_2", "owner_id": dump["admin_id"]},
+                    {"name": "item_3", "owner_id": dump["user_1_id"]},
+                    {"name": "item_4", "owner_id": dump["user_2_id"]}]:
+        response = client.post(
+            "/items/new",
             json = item,
-            headers = {"token": pytest.dump["admin_jwt"]})
+            headers = {"token": dump["admin_jwt"]})
         assert response != None
         assert response.status_code == 200
 
@@ -202,14 +189,12 @@ def test_05_item_create():
         assert "data" in data
         assert data["status_code"] == "0"
 
-        pytest.dump[item["name"] + '_id'] = data["data"]["id"]
-
     # попытка дублирования данных
-    item = {"name": "item_1", "owner_id": pytest.dump["admin_id"]}
-    response = requests.post(
-        API_URL + "/items/new",
+    item = {"name": "item_1", "owner_id": dump["admin_id"]}
+    response = client.post(
+        "/items/new",
         json = item,
-        headers = {"token": pytest.dump["admin_jwt"]})
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -224,17 +209,17 @@ def test_05_item_create():
 
     # попытка передачи некорректных данных
     item = {"aaa": "aaa"}
-    response = requests.post(
-        API_URL + "/items/new",
+    response = client.post(
+        "/items/new",
         json = item,
-        headers = {"token": pytest.dump["admin_jwt"]})
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 422
 
     # попытка подключения с неправильным токеном
-    item = {"name": "item_1", "owner_id": pytest.dump["admin_id"]}
-    response = requests.post(
-        API_URL + "/items/new",
+    item = {"name": "item_1", "owner_id": dump["admin_id"]}
+    response = client.post(
+        "/items/new",
         json = item,
         headers = {"token": "Zzz"})
     assert response != None
@@ -247,13 +232,14 @@ def test_05_item_create():
     assert data["status_code"] == "4"
 
 
-def test_06_item_delete():
+@pytest.mark.usefixtures("dump_items")
+def test_06_item_delete(client, dump):
     """Тест маршрута /items/{id}.
     """
     # проверка вызова маршрута, наличия ответа и формата ответа
-    response = requests.delete(
-        API_URL + f"/items/{pytest.dump['item_4_id']}",
-        headers = {"token": pytest.dump["admin_jwt"]})
+    response = client.delete(
+        f"/items/{dump['item_4_id']}",
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -264,9 +250,9 @@ def test_06_item_delete():
     assert data["status_code"] == "0"
 
     # попытка удалить несуществующий объект
-    response = requests.delete(
-        API_URL + f"/items/{pytest.dump['item_4_id']}",
-        headers = {"token": pytest.dump["admin_jwt"]})
+    response = client.delete(
+        f"/items/{dump['item_4_id']}",
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -277,8 +263,8 @@ def test_06_item_delete():
     assert data["status_code"] == "2"
 
     # попытка подключения с неправильным токеном
-    response = requests.delete(
-        API_URL + f"/items/{pytest.dump['item_3_id']}",
+    response = client.delete(
+        f"/items/{dump['item_3_id']}",
         headers = {"token": "Zzz"})
     assert response != None
     assert response.status_code == 200
@@ -290,13 +276,14 @@ def test_06_item_delete():
     assert data["status_code"] == "4"
 
 
-def test_07_item_list():
+@pytest.mark.usefixtures("dump_items")
+def test_07_item_list(client, dump):
     """Тест маршрута /items.
     """
     # проверка вызова маршрута, наличия ответа и формата ответа
-    response = requests.get(
-        API_URL + "/items",
-        headers = {"token": pytest.dump["admin_jwt"]})
+    response = client.get(
+        "/items",
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -307,11 +294,11 @@ def test_07_item_list():
     assert "data" in data
     assert data["status_code"] == "0"
     assert isinstance(data["data"], list) == True
-    assert len(data["data"]) == 3
+    assert len(data["data"]) == 4
 
     # попытка подключения с неправильным токеном
-    response = requests.get(
-        API_URL + "/items",
+    response = client.get(
+        "/items",
         headers = {"token": "Zzz"})
     assert response != None
     assert response.status_code == 200
@@ -323,14 +310,15 @@ def test_07_item_list():
     assert data["status_code"] == "4"
 
 
-def test_08_item_send():
+@pytest.mark.usefixtures("dump_items")
+def test_08_item_send(client, dump):
     """Тест маршрута /send.
     """
     # проверка вызова маршрута, наличия ответа и формата ответа
-    response = requests.post(
-        API_URL + "/send",
-        json = {"id": pytest.dump["item_2_id"], "new_owner_login": "user_2"},
-        headers = {"token": pytest.dump["admin_jwt"]})
+    response = client.post(
+        "/send",
+        json = {"id": dump["item_2_id"], "new_owner_login": "user_2"},
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -341,13 +329,11 @@ def test_08_item_send():
     assert "url" in data
     assert data["status_code"] == "0"
 
-    pytest.dump["rebase_item_url"] = data["url"]
-
     # попытка послать чужой объект
-    response = requests.post(
-        API_URL + "/send",
-        json = {"id": pytest.dump["item_3_id"], "new_owner_login": "user_2"},
-        headers = {"token": pytest.dump["admin_jwt"]})
+    response = client.post(
+        "/send",
+        json = {"id": dump["item_3_id"], "new_owner_login": "user_2"},
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -358,10 +344,10 @@ def test_08_item_send():
     assert data["status_code"] == "5"
 
     # попытка послать несуществующий объект
-    response = requests.post(
-        API_URL + "/send",
+    response = client.post(
+        "/send",
         json = {"id": 100500, "new_owner_login": "user_1"},
-        headers = {"token": pytest.dump["admin_jwt"]})
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -372,10 +358,10 @@ def test_08_item_send():
     assert data["status_code"] == "2"
 
     # попытка послать несуществующему пользователю
-    response = requests.post(
-        API_URL + "/send",
-        json = {"id": pytest.dump["item_1_id"], "new_owner_login": "Zzz"},
-        headers = {"token": pytest.dump["admin_jwt"]})
+    response = client.post(
+        "/send",
+        json = {"id": dump["item_1_id"], "new_owner_login": "Zzz"},
+        headers = {"token": dump["admin_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -386,9 +372,9 @@ def test_08_item_send():
     assert data["status_code"] == "2"
 
     # попытка подключения с неправильным токеном
-    response = requests.post(
-        API_URL + "/send",
-        json = {"id": pytest.dump["item_1_id"], "new_owner_login": "user_1"},
+    response = client.post(
+        "/send",
+        json = {"id": dump["item_1_id"], "new_owner_login": "user_1"},
         headers = {"token": "Zzz"})
     assert response != None
     assert response.status_code == 200
@@ -400,13 +386,21 @@ def test_08_item_send():
     assert data["status_code"] == "4"
 
 
-def test_09_item_get():
+@pytest.mark.usefixtures("dump_items")
+def test_09_item_get(client, dump):
     """Тест маршрута /get.
     """
+    # ссылка на передачу объекта item_2 пользователю user_2
+    response = client.post(
+        "/send",
+        json = {"id": dump["item_2_id"], "new_owner_login": "user_2"},
+        headers = {"token": dump["admin_jwt"]})
+    url = urlsplit(response.json()["url"]).path
+
     # проверка вызова маршрута, наличия ответа и формата ответа
-    response = requests.get(
-        pytest.dump["rebase_item_url"],
-        headers = {"token": pytest.dump["user_2_jwt"]})
+    response = client.get(
+        url,
+        headers = {"token": dump["user_2_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -418,9 +412,9 @@ def test_09_item_get():
     assert data["status_code"] == "0"
 
     # попытка получить чужой объект
-    response = requests.get(
-        pytest.dump["rebase_item_url"],
-        headers = {"token": pytest.dump["user_1_jwt"]})
+    response = client.get(
+        url,
+        headers = {"token": dump["user_1_jwt"]})
     assert response != None
     assert response.status_code == 200
 
@@ -431,8 +425,8 @@ def test_09_item_get():
     assert data["status_code"] == "5"
 
     # попытка подключения с неправильным токеном
-    response = requests.get(
-        pytest.dump["rebase_item_url"],
+    response = client.get(
+        url,
         headers = {"token": "Zzz"})
     assert response != None
     assert response.status_code == 200
@@ -444,5 +438,1208 @@ def test_09_item_get():
     assert data["status_code"] == "4"
 
 
+def test_10_rate_limit(dump):
+    """Тест ограничения частоты запросов (RateLimitMiddleware).
+    """
+    from fastapi import FastAPI
+    from starlette.testclient import TestClient
+    from context import RouteContextMiddleware
+    from ratelimit import RateLimiter, RateLimitMiddleware
+    from routes import router
+
+    now = [0.0]
+    limiter = RateLimiter(clock = lambda: now[0])
+    app = FastAPI()
+    app.include_router(router)
+    app.add_middleware(RateLimitMiddleware, limiter = limiter)
+    app.add_middleware(RouteContextMiddleware)
+    client = TestClient(app)
+
+    # корзина /items: 30 запросов подряд, дальше 10 в секунду
+    for _ in range(30):
+        response = client.get("/items", headers = {"token": dump["admin_jwt"]})
+        assert response.status_code == 200
+
+    response = client.get("/items", headers = {"token": dump["admin_jwt"]})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    data = response.json()
+    assert data["status_code"] == "6"
+
+    # у другого пользователя своя корзина
+    response = client.get("/items", headers = {"token": dump["user_1_jwt"]})
+    assert response.status_code == 200
+
+    # за 0.1 секунды корзина пополняется на один запрос
+    now[0] += 0.1
+    response = client.get("/items", headers = {"token": dump["admin_jwt"]})
+    assert response.status_code == 200
+    response = client.get("/items", headers = {"token": dump["admin_jwt"]})
+    assert response.status_code == 429
+
+    # простаивающие корзины наполняются и удаляются
+    now[0] += 10
+    response = client.get("/items", headers = {"token": dump["user_2_jwt"]})
+    assert response.status_code == 200
+    assert len(limiter.buckets) == 1
+
+
+def test_11_admission():
+    """Тест группы допуска (AdmissionGroup): лимит, очередь и срок ожидания.
+    """
+    import asyncio
+    import threading
+    from admission import AdmissionControl, AdmissionGroup, _current
+
+    async def scenario():
+        group = AdmissionGroup("test", limit = 1, min_limit = 1, max_limit = 4, queue = 1)
+        assert await group.acquire(0.05)
+
+        # второй запрос ждёт в очереди, третий не помещается в очередь
+        second = asyncio.ensure_future(group.acquire(1.0))
+        await asyncio.sleep(0)
+        assert not await group.acquire(1.0)
+
+        # освобождённое место передаётся ожидающему
+        group.release()
+        assert await second
+        assert group.inflight == 1
+
+        # истёк срок ожидания в очереди
+        assert not await group.acquire(0.01)
+        assert not await group.acquire(0)
+        assert group.shed == 3
+        group.release()
+        assert group.inflight == 0
+
+        # лимит растёт при стабильной латентности БД и падает при её росте
+        for _ in range(30 * group.window):
+            group.observe(0.001)
+        assert group.limit == 4
+        for _ in range(3 * group.window):
+            group.observe(0.01)
+        assert group.limit < 4
+
+        # замер из пула потоков передаётся группе в цикле событий
+        control = AdmissionControl({"reads": {"limit": 1, "min_limit": 1, "max_limit": 1, "queue": 1}})
+        control.start(asyncio.get_running_loop())
+        assert asyncio.get_running_loop().get_task_factory() is not None
+        reads = control.groups["reads"]
+
+        class Context:
+            pass
+
+        threads = []
+        observe = reads.observe
+        reads.observe = lambda latency: threads.append(threading.get_ident()) or observe(latency)
+
+        def query():
+            token = _current.set(reads)
+            try:
+                ctx = Context()
+                control._before(None, None, "", None, ctx, False)
+                control._after(None, None, "", None, ctx, False)
+            finally:
+                _current.reset(token)
+
+        await asyncio.get_running_loop().run_in_executor(None, query)
+        await asyncio.sleep(0)
+        assert threads == [threading.get_ident()]
+        assert reads.samples == 1
+
+    asyncio.run(scenario())
+
+    # время начала - в контексте запроса: запрос с ошибкой не оставляет его на соединении
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.exc import ProgrammingError
+    import database
+
+    control = AdmissionControl({"reads": {"limit": 1, "min_limit": 1, "max_limit": 1, "queue": 1}})
+    reads = control.groups["reads"]
+    engine = create_engine(database.engine.url, pool_size = 1)
+    control.install(engine)
+    token = _current.set(reads)
+    try:
+        with engine.connect() as connection:
+            with pytest.raises(ProgrammingError):
+                connection.execute(text("SELECT * FROM no_such_table"))
+            assert "admission_start" not in connection.info
+            connection.execute(text("SELECT 1"))
+        assert reads.samples == 1
+    finally:
+        _current.reset(token)
+        engine.dispose()
+
+    # лимиты групп выводятся из размера пула соединений
+    from admission import GROUPS, _groups
+    from constants import POSTGRES_POOL_SIZE, POSTGRES_MAX_OVERFLOW
+    assert sum(group["max_limit"] for group in GROUPS.values()) <= POSTGRES_POOL_SIZE + POSTGRES_MAX_OVERFLOW
+    assert [group["max_limit"] for group in _groups(30).values()] == [14, 10, 6]
+
+
+def test_12_single_flight():
+    """Тест объединения одинаковых одновременных запросов (SingleFlight).
+    """
+    import time
+    import asyncio
+    from singleflight import SingleFlight
+
+    calls = []
+
+    def query(value):
+        calls.append(value)
+        time.sleep(0.05)
+        return value
+
+    async def scenario():
+        flights = SingleFlight()
+        results = await asyncio.gather(*[flights.do("/items", query, n) for n in range(10)])
+        assert results == [0] * 10
+        assert len(calls) == 1
+
+        # без окна следующий запрос выполняется заново
+        assert await flights.do("/items", query, 1) == 1
+        assert len(calls) == 2
+
+        # в окне результат отдаётся без выполнения
+        flights = SingleFlight(window = 0.2)
+        assert await flights.do("/items", query, 2) == 2
+        assert await flights.do("/items", query, 3) == 2
+        assert len(calls) == 3
+        await asyncio.sleep(0.3)
+        assert await flights.do("/items", query, 4) == 4
+
+        # отмена первого запроса не прерывает выполнение для остальных
+        flights = SingleFlight()
+        leader = asyncio.ensure_future(flights.do("/items", query, 5))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do("/items", query, 6))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await follower == 5
+        assert leader.cancelled()
+        assert flights.flights == {}
+
+    asyncio.run(scenario())
+
+
+def test_13_idempotency_key(client, dump):
+    """Тест повторов /registration и /items/new с заголовком Idempotency-Key.
+    """
+    # повтор регистрации получает первый ответ, а не DuplicateValueError
+    user = {"login": "user_4", "password": "user_4_password"}
+    first = client.post("/registration", json = user, headers = {"Idempotency-Key": "k1"}).json()
+    assert first["status_code"] == "0"
+    retry = client.post("/registration", json = user, headers = {"Idempotency-Key": "k1"}).json()
+    assert retry == first
+
+    # без ключа повтор по-прежнему дублирует значение
+    response = client.post("/registration", json = user).json()
+    assert response["status_code"] == "1"
+
+    # тот же ключ с другим телом запроса
+    response = client.post("/registration", json = {"login": "user_5", "password": "user_5"},
+        headers = {"Idempotency-Key": "k1"}).json()
+    assert response["status_code"] == "8"
+
+    # ключи разных маршрутов не пересекаются
+    item = {"name": "item_5", "owner_id": dump["admin_id"]}
+    headers = {"token": dump["admin_jwt"], "Idempotency-Key": "k1"}
+    first = client.post("/items/new", json = item, headers = headers).json()
+    assert first["status_code"] == "0"
+    retry = client.post("/items/new", json = item, headers = headers).json()
+    assert retry == first
+
+    response = client.get("/items", headers = {"token": dump["admin_jwt"]}).json()
+    assert [item["name"] for item in response["data"]].count("item_5") == 1
+
+    # ключ зарезервирован одновременным запросом: второй получает 409 и ничего не создаёт
+    import json
+    import hashlib
+    import storage
+    item = {"name": "item_6", "owner_id": dump["admin_id"], "token": dump["admin_jwt"]}
+    fingerprint = hashlib.sha256(json.dumps(item, sort_keys = True).encode()).hexdigest()
+    assert storage.db_reserve_response("k2", "/items/new", fingerprint) is None
+    headers = {"token": dump["admin_jwt"], "Idempotency-Key": "k2"}
+    item = {"name": "item_6", "owner_id": dump["admin_id"]}
+    response = client.post("/items/new", json = item, headers = headers)
+    assert response.status_code == 409 and response.json()["status_code"] == "15"
+    response = client.get("/items", headers = {"token": dump["admin_jwt"]}).json()
+    assert "item_6" not in [item["name"] for item in response["data"]]
+
+    # резерв снят (первый запрос не удался) - повтор выполняется; сохранённый ответ не снимается
+    storage.db_release_response("k2", "/items/new")
+    first = client.post("/items/new", json = item, headers = headers).json()
+    assert first["status_code"] == "0"
+    storage.db_release_response("k2", "/items/new")
+    assert client.post("/items/new", json = item, headers = headers).json() == first
+
+
+def test_14_batch(client, dump):
+    """Тест маршрута /batch.
+    """
+    headers = {"token": dump["admin_jwt"]}
+    operations = [
+        {"method": "POST", "path": "/items/new", "body": {"name": "item_5", "owner_id": dump["admin_id"]}},
+        {"method": "POST", "path": "/items/new_p", "body": {"name": "item_6", "owner_id": dump["admin_id"]}},
+        {"method": "GET", "path": "/items"}]
+    response = client.post("/batch", json = {"operations": operations}, headers = headers)
+    assert response.status_code == 200
+
+    data = response.json()
+    assert data["status_code"] == "0"
+    assert [result["status_code"] for result in data["data"]] == ["0", "0", "0"]
+    assert len(data["data"][2]["data"]) == 2
+    item_id = data["data"][0]["data"]["id"]
+
+    # передача объекта и удаление в одном пакете
+    operations = [
+        {"method": "POST", "path": "/send", "body": {"id": item_id, "new_owner_login": "user_1"}},
+        {"method": "DELETE", "path": f"/items/{item_id}"}]
+    data = client.post("/batch", json = {"operations": operations}, headers = headers).json()
+    assert data["status_code"] == "0"
+    assert "url" in data["data"][0]
+
+    # неудачная операция откатывает весь пакет
+    operations = [
+        {"method": "POST", "path": "/items/new", "body": {"name": "item_7", "owner_id": dump["admin_id"]}},
+        {"method": "POST", "path": "/items/new", "body": {"name": "item_6", "owner_id": dump["admin_id"]}},
+        {"method": "POST", "path": "/items/new", "body": {"name": "item_8", "owner_id": dump["admin_id"]}}]
+    data = client.post("/batch", json = {"operations": operations}, headers = headers).json()
+    assert data["status_code"] == "9"
+    assert [result["status_code"] for result in data["data"]] == ["0", "1"]
+    names = [item["name"] for item in client.get("/items", headers = headers).json()["data"]]
+    assert sorted(names) == ["item_6"]
+
+    # без atomic откатываются только неудачные операции
+    data = client.post("/batch", json = {"operations": operations, "atomic": False}, headers = headers).json()
+    assert data["status_code"] == "0"
+    assert [result["status_code"] for result in data["data"]] == ["0", "1", "0"]
+    names = [item["name"] for item in client.get("/items", headers = headers).json()["data"]]
+    assert sorted(names) == ["item_6", "item_7", "item_8"]
+
+    # неизвестный маршрут и неправильный токен
+    data = client.post("/batch", json = {"operations": [{"method": "GET", "path": "/batch"}]},
+        headers = headers).json()
+    assert data["status_code"] == "9"
+    assert data["data"][0]["status_code"] == "2"
+    data = client.post("/batch", json = {"operations": []}, headers = {"token": "Zzz"}).json()
+    assert data["status_code"] == "4"
+
+    # операции проверяются как отдельные запросы: неверное тело, параметр пути, не объект
+    for operation, text in [
+            ({"path": "/items/new", "body": {"name": "item_9", "owner_id": "notint"}}, "body.owner_id"),
+            ({"method": "DELETE", "path": "/items/x"}, "path.id"),
+            ("/items", "operation 0 is not an object")]:
+        data = client.post("/batch", json = {"operations": [operation]}, headers = headers).json()
+        assert data["status_code"] == "9"
+        assert data["data"][0]["status_code"] == "9"
+        assert data["data"][0]["status_message"].startswith("Batch failed: operation 0")
+        assert text in data["data"][0]["status_message"]
+
+    # строка запроса операции передаётся обработчику
+    data = client.post("/batch", json = {"operations": [{"method": "GET", "path": "/items/search?q=item_6"}]},
+        headers = headers).json()
+    assert data["status_code"] == "0"
+    assert [item["name"] for item in data["data"][0]["data"]] == ["item_6"]
+
+
+@pytest.mark.usefixtures("dump_items")
+def test_15_item_send_many(client, dump):
+    """Тест передачи нескольких объектов одной ссылкой (/send с ids и /get).
+    """
+    ids = [dump["item_1_id"], dump["item_2_id"]]
+    response = client.post(
+        "/send",
+        json = {"ids": ids, "new_owner_login": "user_2"},
+        headers = {"token": dump["admin_jwt"]})
+    data = response.json()
+    assert data["status_code"] == "0"
+    url = urlsplit(data["url"]).path
+
+    response = client.get(url, headers = {"token": dump["user_2_jwt"]})
+    data = response.json()
+    assert data["status_code"] == "0"
+    assert sorted(item["id"] for item in data["data"]) == sorted(ids)
+    assert all(item["owner_id"] == dump["user_2_id"] for item in data["data"])
+
+    # повтор ссылки: объекты уже не принадлежат отправителю
+    data = client.get(url, headers = {"token": dump["user_2_jwt"]}).json()
+    assert data["status_code"] == "5"
+
+    # в списке чужой объект - ссылка не выдаётся
+    data = client.post(
+        "/send",
+        json = {"ids": [dump["item_1_id"], dump["item_3_id"]], "new_owner_login": "admin"},
+        headers = {"token": dump["user_2_jwt"]}).json()
+    assert data["status_code"] == "5"
+
+    # объект передан по другой ссылке после выдачи - не передаётся ни один объект
+    ids = [dump["item_1_id"], dump["item_2_id"]]
+    url = urlsplit(client.post(
+        "/send",
+        json = {"ids": ids, "new_owner_login": "user_3"},
+        headers = {"token": dump["user_2_jwt"]}).json()["url"]).path
+    other = urlsplit(client.post(
+        "/send",
+        json = {"id": dump["item_2_id"], "new_owner_login": "user_1"},
+        headers = {"token": dump["user_2_jwt"]}).json()["url"]).path
+    assert client.get(other, headers = {"token": dump["user_1_jwt"]}).json()["status_code"] == "0"
+    data = client.get(url, headers = {"token": dump["user_3_jwt"]}).json()
+    assert data["status_code"] == "5"
+    data = client.get("/items", headers = {"token": dump["user_3_jwt"]}).json()
+    assert all(item["owner_id"] != dump["user_3_id"] for item in data["data"])
+
+    # слишком много объектов в одной ссылке - ошибка лимита, а не пакета /batch
+    from constants import SEND_MAX_ITEMS
+    data = client.post(
+        "/send",
+        json = {"ids": list(range(1, SEND_MAX_ITEMS + 2)), "new_owner_login": "user_1"},
+        headers = {"token": dump["user_2_jwt"]}).json()
+    assert data["status_code"] == "14"
+
+
+@pytest.mark.usefixtures("dump_items")
+def test_16_item_version(dump):
+    """Тест версий объектов: изменение по устаревшей версии отклоняется.
+    """
+    import database
+    from constants import VersionConflictError
+
+    item = database.db_read_item_by_id(dump["item_1_id"])
+    rebased = database.db_rebase_item(item.id, dump["user_1_id"], version = item.version)
+    assert rebased.version == item.version + 1
+
+    # версия, прочитанная до передачи, устарела
+    with pytest.raises(VersionConflictError):
+        database.db_update_item(item.id, "item_1_new", dump["admin_id"], version = item.version)
+    with pytest.raises(VersionConflictError):
+        database.db_rebase_item(item.id, dump["admin_id"], version = item.version)
+
+    # параллельная запись между чтением и UPDATE в другой сессии
+    with database.DBSession() as session:
+        stale = session.query(database.DBItem).filter(database.DBItem.id == item.id).one()
+        database.db_rebase_item(item.id, dump["user_2_id"])
+        stale.owner_id = dump["admin_id"]
+        with pytest.raises(database.StaleDataError):
+            session.commit()
+    assert database.db_read_item_by_id(item.id).owner_id == dump["user_2_id"]
+
+    # массовая передача тоже увеличивает версию
+    items = database.db_rebase_items([item.id], dump["user_2_id"], dump["user_3_id"])
+    assert items[0].version == rebased.version + 2
+
+
+def test_17_user_delete_deferred(client, dump_items):
+    """Тест отложенного удаления объектов пользователя (DELETE /users/{id}).
+    """
+    import database
+    from constants import NoValueFoundError
+
+    # пользователь помечается удалённым: он и его объекты сразу скрыты
+    database.db_delete_user(dump_items["admin_id"])
+    users = {user.id for user in database.db_user_list()}
+    items = {item.id for item in database.db_item_list()}
+    assert dump_items["admin_id"] not in users
+    assert dump_items["item_1_id"] not in items and dump_items["item_2_id"] not in items
+    assert dump_items["item_3_id"] in items
+    with pytest.raises(NoValueFoundError):
+        database.db_read_item_by_id(dump_items["item_1_id"])
+    with pytest.raises(NoValueFoundError):
+        database.db_read_user("admin")
+    with pytest.raises(NoValueFoundError):
+        database.db_delete_user(dump_items["admin_id"])
+
+    # ход удаления
+    progress = database.db_deletion_progress(dump_items["admin_id"])
+    assert progress["deleting"] and progress["items_left"] == 2
+
+    # очистка частями по одному объекту, затем удаляется сама запись
+    while database.db_purge_user(dump_items["admin_id"], 1):
+        pass
+    with pytest.raises(NoValueFoundError):
+        database.db_deletion_progress(dump_items["admin_id"])
+    assert len(database.db_item_list()) == 2
+
+    # маршруты: удаление и ход удаления
+    response = client.delete(f"/users/{dump_items['user_1_id']}",
+        headers = {"token": dump_items["user_2_jwt"]})
+    assert response.json()["status_code"] == "0"
+    response = client.get(f"/users/{dump_items['user_2_id']}/deletion",
+        headers = {"token": dump_items["user_2_jwt"]})
+    assert response.json()["status_code"] == "0"
+    assert response.json()["data"] == {"deleting": False, "deleted_at": None, "items_left": 1}
+    response = client.get(f"/users/{dump_items['user_1_id']}/deletion",
+        headers = {"token": "Zzz"})
+    assert response.json()["status_code"] == "4"
+
+    # фоновая очистка: объекты и запись пользователя удаляются
+    from purge import purger
+    assert purger.purge() == 1
+    with pytest.raises(NoValueFoundError):
+        database.db_deletion_progress(dump_items["user_1_id"])
+    assert len(database.db_item_list()) == 1
+
+
+def test_18_item_events(client, dump):
+    """Тест событий объектов (LISTEN/NOTIFY, /items/events).
+    """
+    import asyncio
+    import database
+    from feed import ItemFeed
+
+    async def scenario():
+        feed = ItemFeed()
+        admin = feed.subscribe(dump["admin_id"])
+        user_1 = feed.subscribe(dump["user_1_id"])
+        item = database.db_create_item("item_events", dump["admin_id"])
+        event = await asyncio.wait_for(admin.get(), 5)
+        assert event == {"event": "create", "ids": [item.id], "owner_id": None, "new_owner_id": dump["admin_id"]}
+
+        # перепривязка - событие получают оба владельца
+        database.db_rebase_items([item.id], dump["admin_id"], dump["user_1_id"])
+        for queue in (admin, user_1):
+            event = await asyncio.wait_for(queue.get(), 5)
+            assert event["event"] == "rebase" and event["new_owner_id"] == dump["user_1_id"]
+
+        # откат транзакции - события нет
+        with pytest.raises(RuntimeError):
+            with database.db_transaction():
+                database.db_delete_item(item.id)
+                raise RuntimeError
+        database.db_delete_item(item.id)
+        event = await asyncio.wait_for(user_1.get(), 5)
+        assert event["event"] == "delete" and event["owner_id"] == dump["user_1_id"]
+        assert admin.empty()
+        feed.unsubscribe(dump["admin_id"], admin)
+        feed.unsubscribe(dump["user_1_id"], user_1)
+        assert feed.subscribers == {}
+        feed.close()
+
+    asyncio.run(scenario())
+
+    # без токена поток не открывается
+    response = client.get("/items/events", headers = {"token": "Zzz"})
+    assert response.json()["status_code"] == "4"
+
+
+def test_19_item_search(client, dump_items):
+    """Тест маршрута /items/search.
+    """
+    for name, owner in [("Apple pie", "user_1"), ("pineapple", "admin"), ("apple", "admin"),
+            ("grape", "user_2"), ("100%_cotton", "user_2")]:
+        client.post("/items/new", json = {"name": name, "owner_id": dump_items[owner + "_id"]},
+            headers = {"token": dump_items[owner + "_jwt"]})
+    headers = {"token": dump_items["user_3_jwt"]}
+
+    def search(**params):
+        data = client.get("/items/search", params = params, headers = headers).json()
+        assert data["status_code"] == "0"
+        return [item["name"] for item in data["data"]], data["next_offset"]
+
+    # подстрока: совпадение в начале, затем более короткое наименование
+    assert search(q = "APPLE") == (["apple", "Apple pie", "pineapple"], None)
+    assert search(q = "apple", owner_id = dump_items["admin_id"]) == (["apple", "pineapple"], None)
+    assert search(q = "item", limit = 3) == (["item_1", "item_2", "item_3"], 3)
+    assert search(q = "item", limit = 3, offset = 3) == (["item_4"], None)
+    assert search(q = "app", mode = "prefix") == (["apple", "Apple pie"], None)
+    assert search(q = "ape", mode = "prefix") == ([], None)
+    # спецсимволы LIKE ищутся как обычные символы
+    assert search(q = "%_c") == (["100%_cotton"], None)
+    assert search(q = "m_") == (["item_1", "item_2", "item_3", "item_4"], None)
+    assert search(q = "%", mode = "prefix") == ([], None)
+
+    # объекты удалённого пользователя не находятся
+    client.delete(f"/users/{dump_items['admin_id']}", headers = headers)
+    assert search(q = "apple") == (["Apple pie"], None)
+
+    response = client.get("/items/search", params = {"q": "a", "mode": "exact"}, headers = headers)
+    assert response.status_code == 422
+    response = client.get("/items/search", params = {"q": "a"}, headers = {"token": "Zzz"})
+    assert response.json()["status_code"] == "4"
+
+
+def test_20_item_stats(client, dump_items):
+    """Тест счётчиков объектов по владельцам (/items/stats).
+    """
+    import database
+    from sqlalchemy import text
+
+    headers = {"token": dump_items["user_3_jwt"]}
+
+    def stats(**params):
+        data = client.get("/items/stats", params = params, headers = headers).json()
+        assert data["status_code"] == "0"
+        return data["data"]["items"], {int(owner): count for owner, count in data["data"]["owners"].items()}
+
+    admin, user_1, user_2 = dump_items["admin_id"], dump_items["user_1_id"], dump_items["user_2_id"]
+    assert stats() == (4, {admin: 2, user_1: 1, user_2: 1})
+    assert stats(owner_id = dump_items["user_3_id"]) == (0, {dump_items["user_3_id"]: 0})
+
+    # передача, удаление объекта и откат транзакции
+    database.db_rebase_items([dump_items["item_1_id"], dump_items["item_2_id"]], admin, user_2)
+    client.delete(f"/items/{dump_items['item_3_id']}", headers = {"token": dump_items["user_1_jwt"]})
+    with pytest.raises(RuntimeError):
+        with database.db_transaction():
+            database.db_create_item("item_5", user_1)
+            raise RuntimeError
+    assert stats() == (3, {user_2: 3})
+    assert stats(owner_id = user_2) == (3, {user_2: 3})
+
+    # удаление пользователя: объекты скрыты сразу, счётчик уменьшается по мере очистки
+    database.db_delete_user(user_2)
+    assert stats() == (0, {})
+    while database.db_purge_user(user_2, 1):
+        pass
+    with database.engine.connect() as connection:
+        assert connection.execute(text("SELECT count(*) FROM item_counts WHERE owner_id = :id"),
+            {"id": user_2}).scalar() == 0
+
+    # сверка исправляет расхождения
+    database.db_create_item("item_5", admin)
+    with database.engine.begin() as connection:
+        connection.execute(text("UPDATE item_counts SET count = 7 WHERE owner_id = :id"), {"id": admin})
+    after_id, repaired = database.db_reconcile_item_counts(0, 100)
+    assert after_id == max(admin, user_1, dump_items["user_3_id"]) and repaired == 1
+    assert stats() == (1, {admin: 1})
+    assert database.db_reconcile_item_counts(after_id) == (None, 0)
+
+
+@pytest.mark.parametrize("backend", ["database", "memory"])
+def test_21_storage_backend(backend):
+    """Тест хранилищ: одинаковые результаты и исключения в PostgreSQL и в памяти.
+    """
+    import importlib
+    from constants import DuplicateValueError, NoValueFoundError, OwnerError, VersionConflictError
+
+    storage = importlib.import_module(backend)
+    storage.db_clear_all()
+    admin = storage.db_create_user("admin", "admin")
+    user = storage.db_create_user("user", "password")
+    with pytest.raises(DuplicateValueError):
+        storage.db_create_user("admin", "other")
+    assert storage.db_read_user("admin").id == admin.id
+    assert storage.db_read_user_by_id(user.id).login == "user"
+    with pytest.raises(NoValueFoundError):
+        storage.db_read_user("nobody")
+    with pytest.raises(DuplicateValueError):
+        storage.db_update_user(user.id, "admin", "password")
+    assert storage.db_update_user(user.id, "user_1", "password").to_dict() == \
+        {"id": user.id, "login": "user_1", "password": "password", "deleted_at": None}
+
+    apple = storage.db_create_item("apple", admin.id)
+    pie = storage.db_create_item("Apple pie", user.id)
+    with pytest.raises(DuplicateValueError):
+        storage.db_create_item("apple", user.id)
+    assert apple.to_dict() == {"id": apple.id, "name": "apple", "owner_id": admin.id, "version": 1}
+    assert storage.db_read_item("apple").id == apple.id
+    with pytest.raises(NoValueFoundError):
+        storage.db_read_item_by_id(0)
+
+    # версии и передача объектов
+    assert storage.db_rebase_item(apple.id, user.id, version = 1).version == 2
+    with pytest.raises(VersionConflictError):
+        storage.db_update_item(apple.id, "apple", admin.id, version = 1)
+    with pytest.raises(OwnerError):
+        storage.db_rebase_items([apple.id, pie.id], admin.id, user.id)
+    assert {item.version for item in storage.db_rebase_items([apple.id, pie.id], user.id, admin.id)} == {2, 3}
+    assert storage.db_item_counts() == {admin.id: 2}
+    assert storage.db_read_transfer([pie.id, 0], "user_1") == ({pie.id: admin.id}, user.id)
+    assert storage.db_read_transfer([apple.id], "nobody") == ({apple.id: admin.id}, None)
+    assert [item.name for item in storage.db_search_items("apple")] == ["apple", "Apple pie"]
+    assert [item.name for item in storage.db_search_items("APP", admin.id, False)] == ["apple", "Apple pie"]
+
+    # транзакция и точка сохранения
+    with pytest.raises(RuntimeError):
+        with storage.db_transaction():
+            storage.db_delete_item(apple.id)
+            raise RuntimeError
+    with storage.db_transaction() as session:
+        savepoint = session.begin_nested()
+        storage.db_create_item("grape", user.id)
+        savepoint.rollback()
+        storage.db_create_item("pear", user.id)
+    assert sorted(item.name for item in storage.db_item_list()) == ["Apple pie", "apple", "pear"]
+
+    # удаление пользователя и ответы по ключу идемпотентности
+    storage.db_delete_user(admin.id)
+    assert [item.name for item in storage.db_item_list()] == ["pear"]
+    assert storage.db_deletion_progress(admin.id)["items_left"] == 2
+    while storage.db_purge_user(admin.id, 1):
+        pass
+    with pytest.raises(NoValueFoundError):
+        storage.db_deletion_progress(admin.id)
+    with pytest.raises(NoValueFoundError):
+        storage.db_delete_item(apple.id)
+    assert storage.db_reserve_response("key", "/items/new", "request") is None
+    assert storage.db_reserve_response("key", "/items/new", "other").response is None
+    storage.db_store_response("key", "/items/new", "response")
+    stored = storage.db_reserve_response("key", "/items/new", "other")
+    assert (stored.request, stored.response) == ("request", "response")
+    assert storage.db_reserve_response("key", "/registration", "request") is None
+    storage.db_release_response("key", "/registration")
+    assert storage.db_reserve_response("key", "/registration", "other") is None
+
+
+@pytest.mark.usefixtures("dump_items")
+def test_22_circuit_breaker(client, dump):
+    """Тест автомата защиты БД и выдачи сохранённых ответов при его размыкании.
+    """
+    import storage
+    from sqlalchemy.exc import OperationalError
+    from breaker import CircuitBreaker
+    from constants import NoValueFoundError, UnavailableError
+
+    # размыкание по доле ошибок, пробное обращение после паузы
+    now = [0.0]
+    breaker = CircuitBreaker(window = 4, failure_rate = 0.5, slow = 1.0, open_time = 5.0, clock = lambda: now[0])
+    calls = []
+
+    @breaker.guard
+    def query(fail = False, duration = 0.0):
+        calls.append(fail)
+        now[0] += duration
+        if fail:
+            raise OperationalError("SELECT 1", {}, Exception("connection refused"))
+        return "ok"
+
+    assert query() == "ok"
+    with pytest.raises(UnavailableError):
+        query(fail = True)
+    query(duration = 2.0)
+    assert breaker.state == "closed"
+    query()
+    assert breaker.state == "open"
+    assert breaker.retry_after() == 5.0
+    with pytest.raises(UnavailableError):
+        query()
+    assert len(calls) == 4
+
+    now[0] += 5.0
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+    now[0] += 5.0
+    assert query() == "ok"
+    assert breaker.state == "closed"
+
+    # ошибки предметной области - ответ БД, автомат не размыкают
+    @breaker.guard
+    def missing():
+        raise NoValueFoundError("id")
+
+    for _ in range(8):
+        with pytest.raises(NoValueFoundError):
+            missing()
+    assert breaker.state == "closed"
+
+    # разомкнутый автомат: чтение - сохранённый ответ, изменение - сразу 503
+    fresh = client.get("/items", headers = {"token": dump["admin_jwt"]}).json()
+    assert "stale" not in fresh
+    storage.breaker._open()
+    try:
+        response = client.get("/items", headers = {"token": dump["admin_jwt"]})
+        data = response.json()
+        assert data["stale"] == True
+        assert data["data"] == fresh["data"]
+        assert response.headers["warning"] == '110 - "Response is Stale"'
+
+        data = client.get("/items/stats", headers = {"token": dump["admin_jwt"]}).json()
+        assert data["status_code"] == "11"
+
+        response = client.post("/items/new", json = {"name": "item_5", "owner_id": dump["admin_id"]},
+            headers = {"token": dump["admin_jwt"]})
+        assert response.status_code == 503
+        assert response.json()["status_code"] == "11"
+        assert int(response.headers["retry-after"]) > 0
+    finally:
+        storage.breaker.reset()
+    data = client.get("/items/stats", headers = {"token": dump["admin_jwt"]}).json()
+    assert data["status_code"] == "0"
+
+
+def test_23_health(client):
+    """Тест проверок живости и готовности: прогрев, кэш проверки БД, вывод из балансировки.
+    """
+    import time
+    import database
+    from health import Health, health
+    from constants import NotReadyError
+
+    now = [0.0]
+    state = Health(interval = 1.0, clock = lambda: now[0])
+    with pytest.raises(NotReadyError):
+        state.check()
+    primed = []
+    state.warm_up(database.engine, [lambda: primed.append(True)])
+    assert primed == [True]
+    assert database.engine.pool.checkedin() >= database.engine.pool.size()
+
+    # проверка БД выполняется не чаще раза в interval секунд
+    checks = []
+    check = state._check
+    state._check = lambda: checks.append(True) or check()
+    result = state.check()
+    assert result["state"] == "ready"
+    assert result["pool"]["size"] == database.engine.pool.size()
+    state.check()
+    assert len(checks) == 1
+    now[0] += 1.0
+    state.check()
+    assert len(checks) == 2
+
+    state.drain()
+    with pytest.raises(NotReadyError):
+        state.check()
+
+    # маршруты: живость отвечает всегда, готовность - после прогрева
+    response = client.get("/health/live")
+    assert response.status_code == 200
+    assert response.json()["status_code"] == "0"
+    for _ in range(100):
+        if health.state == "ready":
+            break
+        time.sleep(0.05)
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json()["data"]["state"] == "ready"
+    health.drain()
+    try:
+        response = client.get("/health/ready")
+        assert response.status_code == 503
+        assert response.json()["status_code"] == "12"
+    finally:
+        health.state = "ready"
+
+
+def test_24_profiler(client, monkeypatch):
+    """Тест профилировщика: стеки работающих потоков, маршрут потока, служебный токен.
+    """
+    import threading
+    import auth
+    import context
+    from profiler import Sampler
+
+    stop = threading.Event()
+
+    def busy():
+        while not stop.is_set():
+            sum(range(1000))
+
+    def request():
+        token = context.request_route.set("/busy")
+        try:
+            context.routed(busy)
+        finally:
+            context.request_route.reset(token)
+
+    thread = threading.Thread(target = request)
+    thread.start()
+    try:
+        profile = Sampler().profile(0.3, 0.005, endpoints = {})
+    finally:
+        stop.set()
+        thread.join()
+    assert profile["samples"] > 10
+    assert profile["routes"]["/busy"] > 0
+    assert any(stack.startswith("/busy;") and ";tests_pt:busy" in stack for stack in profile["stacks"])
+    assert Sampler.collapsed(profile["stacks"]).splitlines()[0].rsplit(" ", 1)[1].isdigit()
+    assert context.thread_routes == {}
+
+    # служебные маршруты - только с admin-token
+    response = client.get("/admin/profile", params = {"seconds": 0.05})
+    assert response.json()["status_code"] == "13"
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", "secret")
+    response = client.get("/admin/profile", params = {"seconds": 0.05}, headers = {"admin-token": "wrong"})
+    assert response.json()["status_code"] == "13"
+    response = client.get("/admin/profile", params = {"seconds": 0.05}, headers = {"admin-token": "secret"})
+    data = response.json()
+    assert data["status_code"] == "0"
+    assert data["data"]["samples"] > 0
+    response = client.get("/admin/profile", params = {"seconds": 0.05, "format": "collapsed", "idle": True},
+        headers = {"admin-token": "secret"})
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "thread:" in response.text
+
+
+def test_25_allocations(client, dump, monkeypatch):
+    """Тест учёта памяти: итоги по маршрутам, места выделения, включение через /admin/memory.
+    """
+    import auth
+    from memprof import AllocationTracker, allocations
+
+    tracker = AllocationTracker()
+    assert tracker.begin() is None
+    tracker.start(5)
+    try:
+        mark = tracker.begin()
+        retained = [bytearray(1000) for _ in range(100)]
+        tracker.end("GET /test", mark)
+        stats = tracker.report(top = 50)["routes"]["GET /test"]
+        assert stats["requests"] == 1
+        assert stats["net_bytes"] >= 100000
+        assert stats["peak_bytes"] >= stats["net_bytes"]
+        sites = tracker.report(top = 50)["top"]
+        assert any(site["site"].startswith(__file__) and site["size_diff"] >= 100000 for site in sites)
+    finally:
+        tracker.stop()
+    del retained
+
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", "secret")
+    headers = {"admin-token": "secret"}
+    assert client.post("/admin/memory", json = {"enabled": True}).json()["status_code"] == "13"
+    try:
+        assert client.post("/admin/memory", json = {"enabled": True}, headers = headers).json() == \
+            {"status_code": "0", "status_message": "Success", "data": {"tracing": True}}
+        client.get("/items", headers = {"token": dump["admin_jwt"]})
+        data = client.get("/admin/memory", params = {"group": "traceback"}, headers = headers).json()["data"]
+        assert data["routes"]["GET /items"]["requests"] == 1
+        assert data["current"] > 0
+        assert isinstance(data["top"][0]["site"], list)
+    finally:
+        client.post("/admin/memory", json = {"enabled": False}, headers = headers)
+    assert not allocations.tracing
+
+
+def test_26_loop_monitor(client, monkeypatch):
+    """Тест замера задержки цикла событий: остановка, её маршрут, стек и длительность.
+    """
+    import time
+    import asyncio
+    import auth
+    from loopmon import LoopMonitor
+
+    monitor = LoopMonitor()
+
+    async def blocking_route():
+        time.sleep(0.3)
+
+    async def scenario():
+        monitor.start(asyncio.get_running_loop(), 0.01, 0.05, {blocking_route.__code__: "/blocking"})
+        await asyncio.sleep(0.1)
+        await blocking_route()
+        await asyncio.sleep(0.05)
+        monitor.stop()
+
+    asyncio.run(scenario())
+    stats = monitor.stats()
+    assert stats["stalls"] == 1
+    stall = stats["recent"][0]
+    assert stall["route"] == "/blocking"
+    assert stall["duration_ms"] >= 250
+    assert any(line.endswith(" blocking_route") for line in stall["stack"])
+    assert stats["lag_ms"]["max"] >= 250
+    assert "event_loop_stalls_total 1" in monitor.prometheus()
+
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", "secret")
+    assert client.get("/admin/loop").json()["status_code"] == "13"
+    data = client.get("/admin/loop", headers = {"admin-token": "secret"}).json()
+    assert data["status_code"] == "0"
+    assert "p99" in data["data"]["lag_ms"]
+
+
+def test_27_capture(tmp_path):
+    """Тест журнала трафика: псевдонимы, связывание цепочек и подмена идентификаторов при воспроизведении,
+    в том числе в операциях /batch.
+    """
+    import json
+    import asyncio
+    import auth
+    from capture import CaptureLog, link_id, pseudonym
+    from replay import Replayer
+
+    log = CaptureLog(str(tmp_path / "capture.log"), "salt")
+    token = auth.jwt_encode({"user_id": 7})
+    registration = log._record(0.0, "POST", "/registration", {}, None,
+        json.dumps({"login": "alice", "password": "secret"}).encode(), 200,
+        json.dumps({"status_code": "0", "data": {"id": 7}}).encode())
+    assert registration["body"] == {"login": pseudonym("alice", "salt"), "password": pseudonym("secret", "salt")}
+    assert registration["created"] == 7
+    login = log._record(0.1, "POST", "/login", {}, None,
+        json.dumps({"login": "alice", "password": "secret"}).encode(), 200,
+        json.dumps({"status_code": "0", "token": token}).encode())
+    assert login["body"] == registration["body"] and login["token_user"] == 7
+    send = log._record(0.2, "POST", "/send", {}, token,
+        json.dumps({"id": 9, "new_owner_login": "bob"}).encode(), 200,
+        json.dumps({"status_code": "0", "url": "http://localhost:8000/get/abc"}).encode())
+    assert send["user"] == 7 and send["link"] == link_id("abc")
+    assert send["body"] == {"id": 9, "new_owner_login": pseudonym("bob", "salt")}
+    get = log._record(0.3, "GET", "/get/{params}", {"params": "abc"}, None, b"", 200, b"")
+    assert get["params"] == {} and get["link"] == send["link"]
+
+    # при воспроизведении идентификаторы, токены и ссылки берутся из ответов цели
+    async def scenario():
+        replayer = Replayer("http://localhost:8000", 1.0, timeout = 1.0)
+        replayer._future(replayer.users, 7)
+        replayer._future(replayer.items, 9)
+        replayer._learn(registration, {"status_code": "0", "data": {"id": 70}})
+        replayer._learn(login, {"status_code": "0", "token": "target-token"})
+        replayer.items[9].set_result(90)
+        assert await replayer._token(7) == "target-token"
+        assert await replayer._body({"route": "/items/new", "body": {"name": "x", "owner_id": 7}}) == \
+            {"name": "x", "owner_id": 70}
+        assert (await replayer._body(send))["id"] == 90
+        replayer._learn(send, {"status_code": "0", "url": "http://target/get/xyz"})
+        assert await replayer._path(get) == "/get/xyz"
+
+    asyncio.run(scenario())
+
+    # операции /batch: псевдонимы в телах, маршруты и связывание по результатам операций
+    log = CaptureLog(str(tmp_path / "capture.log"), "salt",
+        ["/registration", "/items/new", "/items/search", "/items/{id}", "/login", "/send", "/get/{params}", "/batch"])
+    body = {"atomic": True, "operations": [
+        {"path": "/registration", "body": {"login": "alice", "password": "secret"}},
+        {"path": "/items/new", "body": {"name": "apple", "owner_id": 7}},
+        {"method": "delete", "path": "/items/5"},
+        {"path": "/login", "body": {"login": "alice", "password": "secret"}}]}
+    response = {"status_code": "0", "data": [
+        {"status_code": "0", "data": {"id": 7}},
+        {"status_code": "0", "data": {"id": 9}},
+        {"status_code": "0"},
+        {"status_code": "0", "token": auth.jwt_encode({"user_id": 7})}]}
+    record = log._record(0.0, "POST", "/batch", {}, None, json.dumps(body).encode(), 200,
+        json.dumps(response).encode())
+    text = json.dumps(record)
+    assert "alice" not in text and "secret" not in text and "apple" not in text
+    operations = record["body"]["operations"]
+    assert [operation["route"] for operation in operations] == ["/registration", "/items/new", "/items/{id}", "/login"]
+    assert operations[0]["created"] == 7 and operations[1]["created"] == 9
+    assert operations[2] == {"method": "DELETE", "route": "/items/{id}", "params": {"id": "5"}, "body": None}
+    assert operations[3]["token_user"] == 7
+
+    # при воспроизведении созданное в пакете получает идентификаторы цели
+    async def batch_scenario():
+        replayer = Replayer("http://localhost:8000", 1.0, timeout = 1.0)
+        for created in Replayer._records([record]):
+            if "created" in created:
+                replayer._future(replayer.users if created["route"] == "/registration" else replayer.items,
+                    created["created"])
+        replayer._future(replayer.items, 5)
+        replayer._learn(record, {"status_code": "0", "data": [
+            {"status_code": "0", "data": {"id": 70}},
+            {"status_code": "0", "data": {"id": 90}},
+            {"status_code": "0"},
+            {"status_code": "0", "token": "target-token"}]})
+        replayer.items[5].set_result(50)
+        assert replayer.tokens[7] == "target-token"
+        replayed = await replayer._body({"route": "/batch", "body": {"operations": [
+            {"method": "POST", "route": "/items/new", "params": {}, "body": {"name": "x", "owner_id": 7}},
+            {"method": "DELETE", "route": "/items/{id}", "params": {"id": "9"}, "body": None},
+            operations[2]]}})
+        assert replayed["operations"] == [
+            {"method": "POST", "path": "/items/new", "body": {"name": "x", "owner_id": 70}},
+            {"method": "DELETE", "path": "/items/90", "body": None},
+            {"method": "DELETE", "path": "/items/50", "body": None}]
+
+    asyncio.run(batch_scenario())
+
+
+def test_28_slow_query_log():
+    """Тест журнала медленных запросов: запись о запросе, форма параметров, маршрут и план выполнения;
+    запрос с ошибкой журналируется и не оставляет состояния в соединении.
+    """
+    import queue
+    from sqlalchemy import create_engine, event, text
+    from sqlalchemy.exc import ProgrammingError
+    import context
+    import database
+    from slowlog import SlowQueryLog
+
+    engine = create_engine(database.engine.url, pool_size = 1)
+    log = SlowQueryLog(engine, 0, explain = True)
+    log._records = queue.Queue()
+    event.listen(engine, "before_cursor_execute", log._before)
+    event.listen(engine, "after_cursor_execute", log._after)
+    event.listen(engine, "handle_error", log._error)
+    token = context.request_route.set("/items")
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT :value AS value"), {"value": 1})
+            # служебные запросы журнала (EXPLAIN) не журналируются
+            connection.execution_options(slow_query_log = False).execute(text("SELECT 2"))
+        records = []
+        while not log._records.empty():
+            records.append(log._records.get_nowait())
+        assert [record["statement"] for record in records] == ["SELECT %(value)s AS value"]
+        assert records[0]["parameters"] == {"value": "int"}
+        assert records[0]["route"] == "/items"
+        plan = log._explain(records[0]["statement"], records[0]["explain"])
+        assert plan is not None and "EXPLAIN failed" not in plan
+
+        # запрос с ошибкой
+        with engine.connect() as connection:
+            with pytest.raises(ProgrammingError):
+                connection.execute(text("SELECT * FROM no_such_table"))
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            assert "query_start" not in connection.info
+        records = {}
+        while not log._records.empty():
+            record = log._records.get_nowait()
+            records[record["statement"]] = record
+        assert records["SELECT * FROM no_such_table"]["error"] == "UndefinedTable"
+        assert records["SELECT 1"]["error"] is None
+    finally:
+        context.request_route.reset(token)
+        engine.dispose()
+
+
+def test_29_trace_sql(monkeypatch):
+    """Тест трассировки SQL: span на каждый запрос внутри трассируемого запроса, формат OTLP/JSON;
+    span запроса с ошибкой завершается со статусом ERROR.
+    """
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.exc import ProgrammingError
+    import database
+    from tracing import Span, SPAN_KIND_CLIENT, STATUS_CODE_ERROR, instrument_engine, tracer
+
+    engine = create_engine(database.engine.url, pool_size = 1)
+    instrument_engine(engine)
+    exported = []
+    monkeypatch.setattr(tracer, "export", exported.append)
+    try:
+        with engine.connect() as connection:
+            # вне трассировки span не создаётся
+            connection.execute(text("SELECT 1"))
+            with Span("request") as root:
+                connection.execute(text("SELECT 2"))
+        spans = {span.attributes.get("db.statement", span.name): span.to_otlp() for span in exported}
+        assert sorted(spans) == ["SELECT 2", "request"]
+        sql = spans["SELECT 2"]
+        assert (sql["traceId"], sql["parentSpanId"]) == (root.trace_id, root.span_id)
+        assert sql["kind"] == SPAN_KIND_CLIENT
+        assert int(sql["startTimeUnixNano"]) <= int(sql["endTimeUnixNano"])
+        assert "parentSpanId" not in spans["request"]
+        assert "status" not in sql
+
+        # запрос с ошибкой
+        exported.clear()
+        with Span("request") as root:
+            with engine.connect() as connection:
+                with pytest.raises(ProgrammingError):
+                    connection.execute(text("SELECT * FROM no_such_table"))
+                connection.execute(text("SELECT 1"))
+        spans = {span.attributes.get("db.statement", span.name): span.to_otlp() for span in exported}
+        failed = spans["SELECT * FROM no_such_table"]
+        assert failed["status"]["code"] == STATUS_CODE_ERROR
+        assert "no_such_table" in failed["status"]["message"]
+        assert failed["parentSpanId"] == root.span_id
+        assert "status" not in spans["SELECT 1"]
+    finally:
+        engine.dispose()
+
+
+def test_30_capture_query(tmp_path):
+    """Тест журнала трафика: строка запроса записывается с псевдонимом поиска и воспроизводится.
+    """
+    import asyncio
+    from capture import CaptureLog, pseudonym
+    from replay import Replayer
+
+    log = CaptureLog(str(tmp_path / "capture.log"), "salt", ["/items/search", "/items/stats"])
+    record = log._record(0.0, "GET", "/items/search", {}, None, b"", 200, b"[]", b"q=apple&limit=5")
+    assert "apple" not in record["query"]
+    assert record["query"] == f"q={pseudonym('apple', 'salt')}&limit=5"
+    record = log._record(0.0, "GET", "/items/stats", {}, None, b"", 200, b"{}", b"owner_id=7")
+    assert record["query"] == "owner_id=7"
+    assert "query" not in log._record(0.0, "GET", "/items/stats", {}, None, b"", 200, b"{}")
+
+    # при воспроизведении владелец в строке запроса заменяется идентификатором цели
+    async def scenario():
+        replayer = Replayer("http://localhost:8000", 1.0, timeout = 1.0)
+        replayer._future(replayer.users, 7).set_result(70)
+        assert await replayer._path(record) == "/items/stats?owner_id=70"
+
+    asyncio.run(scenario())
+
+
+def test_31_budget_prepared_repeats():
+    """Тест подготовленных запросов: повтор на чтение считается N+1, план снимается.
+    """
+    from fastapi import FastAPI
+    import context
+    import database
+    from querycount import QueryCounter, check_budget, query_budget
+
+    app = FastAPI()
+
+    @app.get("/users/{id}")
+    @query_budget(5)
+    async def read(id: int) -> dict:
+        return {}
+
+    token = context.request_route.set("/users/{id}")
+    try:
+        with QueryCounter(database.engine) as counter, database.engine.connect() as connection:
+            connection.execute(database._prepared("read_user_by_id", 1))
+            connection.execute(database._prepared("read_user_by_id", 1))
+    finally:
+        context.request_route.reset(token)
+    if database.PREPARED_STATEMENTS:
+        assert counter.statements[0].startswith("EXECUTE read_user_by_id")
+    with pytest.raises(AssertionError, match = "N\\+1"):
+        check_budget(app, "GET", "/users/1", counter)
+
+    # журнал медленных запросов снимает план подготовленного запроса
+    from slowlog import SlowQueryLog
+    plan = SlowQueryLog(database.engine, 0, explain = True)._explain(counter.statements[0], {"p1": 1})
+    assert plan is not None and "EXPLAIN failed" not in plan
+
+
+def test_32_memory_transactions():
+    """Тест транзакций хранилища в памяти: чередующиеся транзакции не смешиваются, откат не трогает чужие изменения.
+    """
+    import asyncio
+    import threading
+    import memory
+    from constants import UnavailableError
+
+    memory.db_clear_all()
+
+    # две сопрограммы одного потока: вторая не входит в открытую транзакцию первой
+    async def first(opened: asyncio.Event, done: asyncio.Event):
+        with pytest.raises(RuntimeError):
+            with memory.db_transaction():
+                memory.db_create_user("first", "password")
+                opened.set()
+                await done.wait()
+                raise RuntimeError("rollback")
+
+    async def second(opened: asyncio.Event, done: asyncio.Event):
+        await opened.wait()
+        with pytest.raises(UnavailableError):
+            with memory.db_transaction():
+                memory.db_create_user("second", "password")
+        with pytest.raises(UnavailableError):
+            memory.db_create_user("second", "password")
+        done.set()
+
+    async def scenario():
+        opened, done = asyncio.Event(), asyncio.Event()
+        await asyncio.gather(first(opened, done), second(opened, done))
+        memory.db_create_user("second", "password")
+
+    try:
+        asyncio.run(scenario())
+        assert [user.login for user in memory.db_user_list()] == ["second"]
+
+        # другой поток ждёт конца транзакции; откат не трогает его изменения
+        opened = threading.Event()
+        thread = threading.Thread(target = lambda: (opened.wait(), memory.db_create_user("third", "password")))
+        thread.start()
+        with pytest.raises(RuntimeError):
+            with memory.db_transaction():
+                memory.db_create_user("fourth", "password")
+                opened.set()
+                thread.join(0.2)
+                assert thread.is_alive()
+                raise RuntimeError("rollback")
+        thread.join()
+        assert sorted(user.login for user in memory.db_user_list()) == ["second", "third"]
+    finally:
+        memory.db_clear_all()
+
+
 if __name__ == "__main__":
     sys.exit(pytest.main(["-v", "-x", "tests_pt.py"]))
\ No newline at end of file
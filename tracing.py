@@ -0,0 +1,305 @@
+import json
+import time
+import queue
+import random
+import functools
+import threading
+import asyncio
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+import context
+
+################################################################################
+# tracing
+################################################################################
+
+# текущий span запроса; None - запрос не попал в выборку и не трассируется
+_current: ContextVar = ContextVar("trace_span", default = None)
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+STATUS_CODE_ERROR = 2
+
+
+class Span:
+    """Отрезок трассировки: имя, идентификаторы, время начала и конца, атрибуты.
+    """
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind",
+        "start", "end", "attributes", "error", "_token")
+
+    def __init__(self, name: str, parent: "Span" = None, kind: int = SPAN_KIND_INTERNAL,
+            attributes: dict = None) -> None:
+        self.trace_id = parent.trace_id if parent else "%032x" % random.getrandbits(128)
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+        self._token = None
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc is not None:
+            self.fail(exc)
+        _current.reset(self._token)
+        self.finish()
+
+    def fail(self, exc: BaseException) -> None:
+        """Отметить span завершившимся ошибкой (статус ERROR в OTLP).
+        """
+        self.error = repr(exc)
+        self.attributes["error"] = self.error
+
+    def finish(self) -> None:
+        self.end = time.time_ns()
+        tracer.export(self)
+
+    def to_otlp(self) -> dict:
+        """Преобразовать в span формата OTLP/JSON.
+        """
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [_attribute(key, value) for key, value in self.attributes.items()]
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            span["status"] = {"code": STATUS_CODE_ERROR, "message": self.error}
+        return span
+
+
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class _NoopSpan:
+    """Заглушка для запросов вне выборки - ничего не замеряет.
+    """
+    attributes = {}
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        return None
+
+
+_NOOP = _NoopSpan()
+
+
+class Tracer:
+    """Сборщик span'ов с асинхронной выгрузкой в файл.
+
+    Файл пишется фоновым потоком пачками, по одному JSON-документу OTLP
+    (resourceSpans) на строку - так же, как его пишет file exporter
+    OpenTelemetry Collector, поэтому файл открывается его просмотрщиками.
+    """
+    def __init__(self) -> None:
+        self.path = None
+        self.sample_rate = 0.0
+        self.service = "t22_api"
+        self._spans = queue.Queue(maxsize = 10000)
+        self._thread = None
+
+    def configure(self, path: str, sample_rate: float, service: str = "t22_api") -> None:
+        """Включить трассировку.
+
+        Args:
+            path (str): Файл для выгрузки span'ов.
+            sample_rate (float): Доля трассируемых запросов, от 0 до 1.
+            service (str, optional): Имя сервиса в ресурсе OTLP.
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.service = service
+        if self._thread is None:
+            self._thread = threading.Thread(target = self._run, name = "trace-exporter", daemon = True)
+            self._thread.start()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and self.sample_rate > 0
+
+    def start_trace(self, name: str, attributes: dict = None):
+        """Начать трассировку запроса с учётом выборки.
+
+        Returns:
+            Span либо заглушка, если запрос не попал в выборку.
+        """
+        if not self.enabled or random.random() >= self.sample_rate:
+            return _NOOP
+        return Span(name, kind = SPAN_KIND_SERVER, attributes = attributes)
+
+    def export(self, span: Span) -> None:
+        try:
+            self._spans.put_nowait(span)
+        except queue.Full:
+            pass
+
+    def _run(self, batch_size: int = 512, interval: float = 1.0) -> None:
+        while True:
+            spans = [self._spans.get()]
+            deadline = time.monotonic() + interval
+            while len(spans) < batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    spans.append(self._spans.get(timeout = timeout))
+                except queue.Empty:
+                    break
+            self._write(spans)
+
+    def _write(self, spans: list) -> None:
+        document = {"resourceSpans": [{
+            "resource": {"attributes": [_attribute("service.name", self.service)]},
+            "scopeSpans": [{
+                "scope": {"name": "tracing"},
+                "spans": [span.to_otlp() for span in spans]
+            }]
+        }]}
+        with open(self.path, "a") as file:
+            file.write(json.dumps(document, separators = (",", ":")) + "\n")
+
+
+tracer = Tracer()
+
+
+def span(name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+    """Открыть дочерний span текущего запроса.
+
+    Вне трассируемого запроса возвращает заглушку, так что стоимость вызова
+    для запросов вне выборки - одно чтение ContextVar.
+
+    Args:
+        name (str): Имя span'а.
+        kind (int, optional): Вид span'а по OTLP.
+        **attributes: Атрибуты span'а.
+    """
+    parent = _current.get()
+    if parent is None:
+        return _NOOP
+    return Span(name, parent, kind, attributes)
+
+
+def traced(name: str = None):
+    """Декоратор - обернуть вызов функции в span.
+
+    Args:
+        name (str, optional): Имя span'а, по умолчанию - имя функции.
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if _current.get() is None:
+                    return await func(*args, **kwargs)
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+################################################################################
+# instrumentation
+################################################################################
+
+class TracedQueuePool(QueuePool):
+    """Пул соединений, замеряющий время выдачи соединения (checkout).
+    """
+    def connect(self):
+        if _current.get() is None:
+            return super().connect()
+        with span("pool.checkout"):
+            return super().connect()
+
+
+def instrument_engine(engine) -> None:
+    """Добавить span на каждый SQL-запрос engine.
+
+    Args:
+        engine: SQLAlchemy engine.
+    """
+    # span хранится в контексте выполнения запроса: он не переживает запрос,
+    # и span запроса с ошибкой завершается в handle_error
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, ctx, executemany):
+        parent = _current.get()
+        if parent is not None and ctx is not None:
+            ctx.trace_span = Span("sql", parent, SPAN_KIND_CLIENT,
+                {"db.system": "postgresql", "db.statement": statement})
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, ctx, executemany):
+        span = getattr(ctx, "trace_span", None)
+        if span is not None:
+            ctx.trace_span = None
+            span.finish()
+
+    @event.listens_for(engine, "handle_error")
+    def error(exception_context):
+        ctx = exception_context.execution_context
+        span = getattr(ctx, "trace_span", None)
+        if span is not None:
+            ctx.trace_span = None
+            span.fail(exception_context.original_exception)
+            span.finish()
+
+
+class TracingMiddleware:
+    """ASGI middleware - корневой span на каждый запрос из выборки.
+
+    Должен стоять внутри RouteContextMiddleware, чтобы имя span'а
+    строилось по шаблону маршрута.
+    """
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = context.request_route.get() or scope["path"]
+        root = tracer.start_trace(f"{scope['method']} {route}",
+            {"http.method": scope["method"], "http.route": route})
+        if root is _NOOP:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                root.attributes["http.status_code"] = message["status"]
+            await send(message)
+
+        with root:
+            await self.app(scope, receive, send_wrapper)